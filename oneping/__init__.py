@@ -6,6 +6,7 @@ from .curl import (
     stream as stream_url,
     stream_async as stream_async_url,
     embed as embed_url,
+    embed_async as embed_async_url,
 )
 from .native import (
     reply as reply_native,
@@ -14,6 +15,12 @@ from .native import (
     stream_async as stream_async_native,
     embed as embed_native,
 )
-from .api import reply, reply_async, stream, stream_async, embed, tokenize
+from .api import reply, reply_async, stream, stream_async, embed, embed_async, tokenize
 from .chat import Chat
-from .server import start_llama_cpp, start_router
+from .store import ConvoStore
+from .cache import EmbedCache
+from .index import VectorIndex
+from .corpus import embed_corpus, embed_corpus_async, load_corpus
+from .transport import close_sockets
+from .server import start_llama_cpp, start_router, make_router
+from .pool import LlamaPool, start_llama_pool
@@ -3,7 +3,9 @@ import fire
 
 from .utils import streamer, load_image_uri
 from .api import reply, stream, embed
+from .corpus import embed_corpus
 from .server import start_llama_cpp, start_router
+from .pool import start_llama_pool
 
 def get_content(query=None, image=None):
     # get query/image from stdin
@@ -35,7 +37,11 @@ class ChatCLI:
 
     def embed(self, text=None, **kwargs):
         content = get_content(text)
-        return embed(**content, **kwargs)
+        return embed(**content, **kwargs).tolist()
+
+    # reads jsonl from stdin when no paths are given
+    def embed_corpus(self, *paths, output, **kwargs):
+        return embed_corpus(list(paths) or ['-'], output, **kwargs)
 
     def console(self, **kwargs):
         from .interface.textual import main as main_textual
@@ -52,6 +58,9 @@ class ChatCLI:
     def server(self, model, **kwargs):
         start_llama_cpp(model, **kwargs)
 
+    def pool(self, *models, **kwargs):
+        start_llama_pool(list(models), **kwargs)
+
     def router(self, **kwargs):
         start_router(**kwargs)
 
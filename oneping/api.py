@@ -1,6 +1,11 @@
 # combined interface
 
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
 from .native import has_native
+from .providers import get_provider, provider_config
 
 from .curl import (
     reply as reply_url,
@@ -8,6 +13,7 @@ from .curl import (
     stream as stream_url,
     stream_async as stream_async_url,
     embed as embed_url,
+    embed_async as embed_async_url,
     tokenize as tokenize_url,
 )
 from .native import (
@@ -20,6 +26,10 @@ from .native import (
     transcribe as transcribe_native,
 )
 
+##
+## chat
+##
+
 def reply(query, provider=None, native=True, **kwargs):
     if native and has_native(provider):
         return reply_native(query, provider, **kwargs)
@@ -44,12 +54,109 @@ def stream_async(query, provider=None, native=True, **kwargs):
     else:
         return stream_async_url(query, provider=provider, **kwargs)
 
-def embed(text, provider=None, native=True, **kwargs):
+##
+## embeddings
+##
+
+# unique texts split into batches of the provider's embed_batch size
+def embed_batches(texts, provider):
+    prov = get_provider(provider)
+    unique = list(dict.fromkeys(texts))
+    size = prov.embed_batch or max(1, len(unique))
+    batches = [unique[i:i+size] for i in range(0, len(unique), size)]
+    return unique, batches, prov.embed_concurrency or 1
+
+# map batch results back onto the original (possibly repeated) texts
+def embed_gather(texts, unique, results):
+    vecs = np.concatenate(results) if len(results) != 1 else results[0]
+    if len(unique) == len(texts):
+        return vecs
+    index = {t: i for i, t in enumerate(unique)}
+    return vecs[[index[t] for t in texts]]
+
+# keep the leading dims (for matryoshka models) and rescale to unit length
+def embed_output(vecs, normalize=False, dims=None):
+    if dims is not None:
+        vecs = vecs[:, :dims]
+        normalize = True
+    if normalize:
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        vecs = vecs / np.maximum(norms, 1e-12)
+    return np.ascontiguousarray(vecs, dtype=np.float32)
+
+def embed_request(text, provider=None, native=True, **kwargs):
     if native and has_native(provider):
         return embed_native(text, provider, **kwargs)
     else:
         return embed_url(text, provider=provider, **kwargs)
 
+async def embed_request_async(text, provider=None, native=True, **kwargs):
+    if native and has_native(provider):
+        return await asyncio.to_thread(embed_native, text, provider, **kwargs)
+    else:
+        return await embed_async_url(text, provider=provider, **kwargs)
+
+# lists of texts are deduplicated and sent as concurrent batches
+def embed_list(texts, provider=None, native=True, concurrency=None, **kwargs):
+    unique, batches, workers = embed_batches(texts, provider)
+    workers = min(concurrency or workers, len(batches))
+    if workers <= 1:
+        results = [embed_request(b, provider=provider, native=native, **kwargs) for b in batches]
+    else:
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(
+                lambda b: embed_request(b, provider=provider, native=native, **kwargs), batches
+            ))
+    return embed_gather(texts, unique, results)
+
+async def embed_list_async(texts, provider=None, native=True, concurrency=None, **kwargs):
+    unique, batches, workers = embed_batches(texts, provider)
+    limit = asyncio.Semaphore(concurrency or workers)
+    async def run(batch):
+        async with limit:
+            return await embed_request_async(batch, provider=provider, native=native, **kwargs)
+    results = await asyncio.gather(*[run(b) for b in batches])
+    return embed_gather(texts, unique, results)
+
+# cache spaces are keyed by provider, endpoint, model, and requested dimensions
+# pooled backends serve one model, so they share the configured url
+def cache_begin(cache, texts, provider, kwargs):
+    prov = provider_config(provider)
+    if (model := kwargs.get('model') or prov.embed_model) is None:
+        raise ValueError(f'Provider {provider or "default"} has no embed_model, pass model= to use a cache')
+    base_url = kwargs.get('base_url') or prov.base_url
+    return cache.begin(texts, provider or 'default', model, kwargs.get('dimensions'), base_url=base_url)
+
+# returns a float32 matrix with one row per text
+# with a cache, only texts missing from it are sent upstream
+def embed(text, provider=None, native=True, normalize=False, dims=None, cache=None, **kwargs):
+    texts = [text] if type(text) is str else text
+    if len(texts) == 0:
+        return np.empty((0, dims or 0), dtype=np.float32)
+    if cache is None:
+        vecs = embed_list(texts, provider=provider, native=native, **kwargs)
+    else:
+        space, keys, misses = cache_begin(cache, texts, provider, kwargs)
+        found = embed_list(misses, provider=provider, native=native, **kwargs) if len(misses) > 0 else None
+        vecs = cache.end(space, keys, misses, found)
+    return embed_output(vecs, normalize=normalize, dims=dims)
+
+async def embed_async(text, provider=None, native=True, normalize=False, dims=None, cache=None, **kwargs):
+    texts = [text] if type(text) is str else text
+    if len(texts) == 0:
+        return np.empty((0, dims or 0), dtype=np.float32)
+    if cache is None:
+        vecs = await embed_list_async(texts, provider=provider, native=native, **kwargs)
+    else:
+        space, keys, misses = await asyncio.to_thread(cache_begin, cache, texts, provider, kwargs)
+        found = await embed_list_async(misses, provider=provider, native=native, **kwargs) if len(misses) > 0 else None
+        vecs = await asyncio.to_thread(cache.end, space, keys, misses, found)
+    return embed_output(vecs, normalize=normalize, dims=dims)
+
+##
+## tokenize and transcribe
+##
+
 def tokenize(text, provider=None, native=True, **kwargs):
     if native and has_native(provider):
         return tokenize_native(text, provider, **kwargs)
@@ -0,0 +1,171 @@
+# persistent embedding cache
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+##
+## helpers
+##
+
+KEY_SIZE = 16
+
+def text_key(text):
+    return hashlib.sha256(text.encode()).digest()[:KEY_SIZE]
+
+def space_id(provider, model, dimensions, base_url=None):
+    ident = json.dumps([provider, base_url, model, dimensions])
+    return hashlib.sha256(ident.encode()).hexdigest()[:16]
+
+##
+## embedding space
+##
+
+# one provider/endpoint/model/dimensions combination
+#
+# layout:
+#   {path}/meta.json    provider, base_url, model, dimensions, width
+#   {path}/vectors.f32  float32 rows, append only
+#   {path}/keys.bin     16 byte text hash per row, append only
+#
+# vectors are written before their keys, so a crash mid-append leaves at most
+# some unreferenced rows, which are dropped on the next load
+class EmbedSpace:
+    def __init__(self, path, provider, model, dimensions=None, base_url=None):
+        self.path = path
+        self.meta_path = os.path.join(path, 'meta.json')
+        self.vecs_path = os.path.join(path, 'vectors.f32')
+        self.keys_path = os.path.join(path, 'keys.bin')
+        self.lock = threading.Lock()
+        self.view = None
+        os.makedirs(path, exist_ok=True)
+
+        # load or write metadata
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as fid:
+                self.meta = json.load(fid)
+        else:
+            self.meta = {
+                'provider': provider, 'base_url': base_url, 'model': model,
+                'dimensions': dimensions, 'width': None,
+            }
+        self.width = self.meta['width']
+
+        # load keys for complete rows only
+        self.index = {}
+        self.size = 0
+        if self.width is not None:
+            self.load()
+
+    def __len__(self):
+        return self.size
+
+    def load(self):
+        row_bytes = 4 * self.width
+        nvecs = os.path.getsize(self.vecs_path) // row_bytes if os.path.exists(self.vecs_path) else 0
+        data = b''
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'rb') as fid:
+                data = fid.read()
+        self.size = min(nvecs, len(data) // KEY_SIZE)
+        self.index = {
+            data[i*KEY_SIZE:(i+1)*KEY_SIZE]: i for i in range(self.size)
+        }
+
+        # trim torn appends
+        for path, size in [(self.vecs_path, self.size * row_bytes), (self.keys_path, self.size * KEY_SIZE)]:
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+    def save_meta(self):
+        temp = f'{self.meta_path}.tmp'
+        with open(temp, 'w') as fid:
+            json.dump(self.meta, fid)
+        os.replace(temp, self.meta_path)
+
+    # read only memory map over all rows, remapped after appends
+    def vectors(self):
+        if self.view is None or len(self.view) < self.size:
+            if self.size == 0:
+                return np.empty((0, self.width or 0), dtype=np.float32)
+            self.view = np.memmap(self.vecs_path, dtype='<f4', mode='r', shape=(self.size, self.width))
+        return self.view[:self.size]
+
+    # row for each key, -1 if missing
+    def lookup(self, keys):
+        index = self.index
+        return np.array([index.get(k, -1) for k in keys], dtype=np.int64)
+
+    def get(self, rows):
+        return self.vectors()[rows]
+
+    def add(self, keys, vecs):
+        vecs = np.ascontiguousarray(vecs, dtype='<f4')
+        with self.lock:
+            if self.width is None:
+                self.width = self.meta['width'] = vecs.shape[1]
+                self.save_meta()
+            elif vecs.shape[1] != self.width:
+                raise ValueError(f'Embedding width {vecs.shape[1]} does not match cache width {self.width}')
+
+            # skip keys already present
+            new = [i for i, k in enumerate(keys) if k not in self.index]
+            if len(new) == 0:
+                return
+            keys = [keys[i] for i in new]
+            vecs = vecs[new]
+
+            # append vectors then keys
+            with open(self.vecs_path, 'ab') as fid:
+                fid.write(vecs.tobytes())
+            with open(self.keys_path, 'ab') as fid:
+                fid.write(b''.join(keys))
+            for i, k in enumerate(keys):
+                self.index[k] = self.size + i
+            self.size += len(keys)
+
+##
+## embedding cache
+##
+
+# content addressed embeddings keyed by (provider, base_url, model, dimensions, text hash)
+# a directory of embedding spaces, opened on first use
+# one process should write to a cache at a time
+class EmbedCache:
+    def __init__(self, root):
+        self.root = os.path.expanduser(root)
+        self.spaces = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def space(self, provider, model, dimensions=None, base_url=None):
+        sid = space_id(provider, model, dimensions, base_url=base_url)
+        with self.lock:
+            if (space := self.spaces.get(sid)) is None:
+                path = os.path.join(self.root, sid)
+                space = self.spaces[sid] = EmbedSpace(path, provider, model, dimensions, base_url=base_url)
+        return space
+
+    def list(self):
+        spaces = []
+        for sid in sorted(os.listdir(self.root)):
+            if os.path.exists(path := os.path.join(self.root, sid, 'meta.json')):
+                with open(path) as fid:
+                    spaces.append({'id': sid, **json.load(fid)})
+        return spaces
+
+    # split texts into cached rows and unique misses
+    def begin(self, texts, provider, model, dimensions=None, base_url=None):
+        space = self.space(provider, model, dimensions, base_url=base_url)
+        keys = [text_key(t) for t in texts]
+        rows = space.lookup(keys)
+        misses = list(dict.fromkeys(t for t, r in zip(texts, rows) if r < 0))
+        return space, keys, misses
+
+    # store embeddings for misses and gather all rows in order
+    def end(self, space, keys, misses, vecs):
+        if len(misses) > 0:
+            space.add([text_key(t) for t in misses], vecs)
+        return space.get(space.lookup(keys))
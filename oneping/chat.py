@@ -1,7 +1,103 @@
 # chat interface
 
-from .providers import CONFIG as C, content_oneping
+import os
+import copy
+import time
+import asyncio
+import threading
+from contextlib import closing, aclosing
+
+from .providers import CONFIG as C, content_oneping, get_provider, HistoryCache
+from .native import has_native
+from .utils import StatsLog, timed_stream, timed_stream_async
 from .api import reply, reply_async, stream, stream_async
+from .curl import slot_save, slot_restore, warmup, warmup_async
+
+# stored responses expire or get deleted, the server then rejects the id
+def state_expired(args, error):
+    if 'previous_response_id' not in args:
+        return False
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(error, 'status', None)
+    return status in (400, 404)
+
+##
+## kv cache slots
+##
+
+# conversation each (server, slot) last held in this process, a
+# conversation still holding its slot can skip the restore
+SLOT_OWNERS = {}
+
+##
+## context budget
+##
+
+# rough but fast, about 4 characters per token plus a flat cost per image
+IMAGE_TOKENS = 1024
+
+def count_tokens(content):
+    if content is None:
+        return 0
+    elif type(content) is str:
+        return len(content) // 4 + 1
+    tokens = count_tokens(content.get('text'))
+    if content.get('image') is not None:
+        tokens += IMAGE_TOKENS
+    return tokens
+
+def content_text(content):
+    return content if type(content) is str else content.get('text', '')
+
+SUMMARY_PROMPT = 'Summarize the following conversation between a user and an assistant. Keep any facts, decisions, and open questions that later turns may rely on. Respond with the summary only.'
+
+def summary_query(summary, turns):
+    convo = '\n\n'.join(f'{item["role"]}: {content_text(item["content"])}' for item in turns)
+    prior = f'Summary of the conversation before this point:\n{summary}\n\n' if summary is not None else ''
+    return f'{SUMMARY_PROMPT}\n\n{prior}Conversation:\n{convo}'
+
+##
+## history tree
+##
+
+# immutable message node, branches share their common prefix
+class Node:
+    __slots__ = ('message', 'parent', 'depth')
+
+    def __init__(self, message, parent=None):
+        self.message = message
+        self.parent = parent
+        self.depth = 1 if parent is None else parent.depth + 1
+
+    def ancestor(self, depth):
+        node = self
+        while node is not None and node.depth > depth:
+            node = node.parent
+        return node
+
+def node_depth(node):
+    return 0 if node is None else node.depth
+
+def node_messages(node):
+    messages = []
+    while node is not None:
+        messages.append(node.message)
+        node = node.parent
+    return messages[::-1]
+
+def extend_node(node, messages):
+    for message in messages:
+        node = Node(message, node)
+    return node
+
+# deepest node shared by two branches
+def common_prefix(node1, node2):
+    depth = min(node_depth(node1), node_depth(node2))
+    node1 = node1.ancestor(depth) if node1 is not None else None
+    node2 = node2.ancestor(depth) if node2 is not None else None
+    while node1 is not node2:
+        node1, node2 = node1.parent, node2.parent
+    return node1
 
 def history_update(query, text, image=None):
     return [
@@ -11,67 +107,375 @@ def history_update(query, text, image=None):
 
 # chat interface
 class Chat:
-    def __init__(self, system=None, **kwargs):
+    def __init__(self, system=None, slot=None, convo_id=None, budget=None, keep=2, summarize=None, store=None, **kwargs):
         self.system = C.system if system is None else system
+        self.slot = slot
+        self.convo_id = os.urandom(8).hex() if convo_id is None else convo_id
+        self.budget = budget
+        self.keep = keep
+        self.summarize = summarize
+        self.store = store
         self.kwargs = kwargs
+        self.memo = HistoryCache()
+        self.branches = {}
+        self.perf = StatsLog()
         self.clear()
 
+        # resume a stored conversation
+        if store is not None and self.convo_id in store:
+            self.load(self.convo_id, system=system)
+
     def __call__(self, query, **kwargs):
         return self.reply(query, **kwargs)
 
     def clear(self):
-        self.history = []
+        self.head = None
+        self.base = None
+        self.saved = None
+        self.path = (None, [])
+        self.response_id = None
+        self.response_head = None
+        self.start = 0
+        self.summary = (None, 0)
+        self.compacting = False
+
+    ## history tree
+
+    # cached message list for the current head, don't mutate
+    def messages(self):
+        head, messages = self.path
+        if head is not self.head:
+            messages = node_messages(self.head)
+            self.path = (self.head, messages)
+        return messages
+
+    @property
+    def history(self):
+        return list(self.messages())
+
+    # reuses nodes for any unchanged prefix (so `chat.history += ...` is cheap)
+    @history.setter
+    def history(self, history):
+        current = self.messages()
+        n = 0
+        while n < min(len(current), len(history)) and current[n] is history[n]:
+            n += 1
+        head = self.head.ancestor(n) if self.head is not None else None
+        self.move(extend_node(head, history[n:]))
+
+    def append(self, messages):
+        self.head = extend_node(self.head, messages)
+
+    # switch to another node, invalidating context state past the shared prefix
+    def move(self, node):
+        shared = node_depth(common_prefix(self.head, node))
+        self.head = node
+        self.base = common_prefix(self.base, node)
+        self.start = min(self.start, shared)
+        if self.summary[1] > shared:
+            self.summary = (None, 0)
+
+    # name the current node so it can be checked out later
+    def branch(self, name):
+        self.branches[name] = self.head
+        return self.head
+
+    # move to a named branch or node, marking the shared prefix for prompt caching
+    def checkout(self, target):
+        node = self.branches[target] if type(target) is str else target
+        base = common_prefix(self.head, node)
+        self.move(node)
+        self.base = base
+
+    # drop the last few turns (e.g. to regenerate a reply)
+    def rewind(self, turns=1):
+        self.checkout(self.head.ancestor(node_depth(self.head) - 2 * turns))
+
+    # new chat continuing from the current node, the two share all history nodes
+    def fork(self, **kwargs):
+        other = copy.copy(self)
+        other.kwargs = {**self.kwargs, **kwargs}
+        other.convo_id = os.urandom(8).hex()
+        other.saved = None
+        other.branches = dict(self.branches)
+        other.compacting = False
+        other.perf = StatsLog()
+        self.base = other.base = self.head
+        return other
+
+    ## persistence
+
+    # switch to a stored conversation
+    def load(self, convo_id, system=None):
+        convo = self.store.load(convo_id)
+        self.clear()
+        self.convo_id = convo_id
+        if system is not None or convo['system'] is not None:
+            self.system = system if system is not None else convo['system']
+        self.head = self.saved = extend_node(None, convo['messages'])
+
+    # write whatever changed since the last save (just the new turn, usually)
+    def save(self):
+        if self.store is None:
+            return
+        shared = node_depth(common_prefix(self.saved, self.head))
+        messages = self.messages()[shared:]
+        self.store.append(self.convo_id, messages, start=shared, system=self.system)
+        self.saved = self.head
+
+    ## context budget
+
+    # explicit budget, else provider max_input_tokens (a number or a table by model)
+    def budget_for(self, opts):
+        if self.budget is not None:
+            return self.budget
+        prov = get_provider(opts.get('provider'))
+        limit = prov.max_input_tokens
+        if type(limit) is dict:
+            model = opts.get('model') or prov.chat_model
+            limit = limit.get(model, limit.get('default'))
+        return limit
+
+    def system_prompt(self):
+        summary, _ = self.summary
+        if summary is None:
+            return self.system
+        context = f'Summary of the earlier conversation:\n{summary}'
+        return context if self.system is None else f'{self.system}\n\n{context}'
+
+    # once over budget, drop the oldest turns down to half the budget (keeping the
+    # last `keep` turns) so the prompt prefix stays stable for a while afterwards
+    def context(self, opts, query=None, image=None):
+        history = self.messages()
+        self.start = min(self.start, len(history))
+        if (budget := self.budget_for(opts)) is None:
+            return self.system_prompt(), history[self.start:]
+
+        # count tokens in the current window
+        counts = [ count_tokens(item['content']) for item in history[self.start:] ]
+        fixed = count_tokens(self.system_prompt()) + count_tokens(content_oneping(query or '', image))
+        used = fixed + sum(counts)
+
+        # advance the window by whole turns
+        if used > budget:
+            limit = max(self.start, len(history) - 2 * self.keep)
+            start = self.start
+            while used > budget // 2 and start < limit:
+                used -= sum(counts[start-self.start:start-self.start+2])
+                start += 2
+            self.start = start
+            self.compact(opts)
+
+        return self.system_prompt(), history[self.start:]
+
+    # summarize dropped turns in the background with a (cheap) model
+    def compact(self, opts):
+        summary, covered = self.summary
+        if self.summarize is None or self.compacting or covered >= self.start:
+            return
+        sopts = opts if self.summarize is True else self.summarize
+        sopts = {k: v for k, v in sopts.items() if k not in ('id_slot', 'stats', 'memo')}
+        query = summary_query(summary, self.messages()[covered:self.start])
+        self.compacting = True
+        thread = threading.Thread(target=self.compact_turns, args=(query, self.start, sopts), daemon=True)
+        thread.start()
+
+    def compact_turns(self, query, start, opts):
+        try:
+            text = reply(query, **opts)
+            self.summary = (text, start)
+        except Exception:
+            pass # turns stay dropped, retry on next compaction
+        finally:
+            self.compacting = False
+
+    ## kv cache slots (llama.cpp)
+
+    @property
+    def slot_file(self):
+        return f'{self.convo_id}.bin'
+
+    # pin a backend and restore this conversation's kv cache into our slot
+    def slot_begin(self, kwargs):
+        opts = {**self.kwargs, **kwargs}
+        if self.slot is None:
+            return opts
+        provider = opts.get('provider')
+        if opts.get('base_url') is None:
+            opts['base_url'] = get_provider(provider).base_url
+        key = (opts['base_url'], self.slot)
+        if self.head is not None and SLOT_OWNERS.get(key) != self.convo_id:
+            try:
+                slot_restore(self.slot, self.slot_file, provider=provider, base_url=opts['base_url'])
+            except Exception:
+                pass # not saved on this server, history gets reprocessed
+        SLOT_OWNERS[key] = self.convo_id
+        return {**opts, 'id_slot': self.slot}
+
+    # persist the kv cache so the next turn can pick it up anywhere
+    def slot_end(self, opts):
+        if self.slot is None:
+            return
+        try:
+            slot_save(self.slot, self.slot_file, provider=opts.get('provider'), base_url=opts['base_url'])
+        except Exception:
+            pass # slot caching is best effort
+
+    ## prompt cache warmup
+
+    def warmup_opts(self, kwargs):
+        opts = {**self.kwargs, **kwargs}
+        if not get_provider(opts.get('provider')).warmup:
+            return None
+        opts = self.slot_begin(kwargs)
+        opts.pop('native', None)
+        return {**opts, 'memo': self.memo}
+
+    # prefill the local server's prompt cache with the current history
+    # so the next reply only has to process the new user message
+    def warmup(self, **kwargs):
+        if (opts := self.warmup_opts(kwargs)) is None:
+            return
+        system, history = self.context(opts)
+        try:
+            warmup(system=system, history=history, **opts)
+        except Exception:
+            pass # warmup is best effort
+
+    async def warmup_async(self, **kwargs):
+        if (opts := await asyncio.to_thread(self.warmup_opts, kwargs)) is None:
+            return
+        system, history = self.context(opts)
+        try:
+            await warmup_async(system=system, history=history, **opts)
+        except Exception:
+            pass # warmup is best effort
+
+    ## server side state (responses api)
+
+    # send only the new turn when the server holds the rest of the conversation
+    def state_begin(self, opts, query, image=None, full=False):
+        prov = get_provider(opts.get('provider'))
+        system, history = self.context(opts, query, image)
+        args = {**opts, 'system': system, 'history': history}
+        if not (opts.get('native', True) and has_native(opts.get('provider'))):
+            args['memo'] = self.memo # reuse converted history on the url path
+        if prov.cache is not None and self.base is not None:
+            if (index := self.base.depth - 1 - self.start) >= 0:
+                args['cache_prefix'] = index # end of prefix shared with other branches
+        args['stats'] = opts.get('stats', {}) # timing and usage for this reply
+        if not prov.stored:
+            return args
+        if not full and self.response_id is not None and self.response_head is self.head:
+            args.update(history=None, previous_response_id=self.response_id)
+        return args
+
+    def state_end(self, args):
+        stats = args['stats']
+        if 'response_id' in stats:
+            self.response_id = stats['response_id']
+            self.response_head = self.head
+        model = args.get('model') or get_provider(args.get('provider')).chat_model
+        self.perf.add(stats, provider=args.get('provider'), model=model)
+
+    ## generation
 
     def reply(self, query, image=None, **kwargs):
-        # get full history and text
-        text = reply(
-            query, image=image, system=self.system, history=self.history, **self.kwargs, **kwargs
-        )
+        # get full history and text (resending it all if the stored state expired)
+        opts = self.slot_begin(kwargs)
+        args = self.state_begin(opts, query, image)
+        start = time.perf_counter()
+        try:
+            text = reply(query, image=image, **args)
+        except Exception as e:
+            if not state_expired(args, e):
+                raise
+            args = self.state_begin(opts, query, image, full=True)
+            text = reply(query, image=image, **args)
+        args['stats']['latency'] = time.perf_counter() - start
+        self.slot_end(opts)
 
         # update history
-        self.history += history_update(query, text, image)
+        self.append(history_update(query, text, image))
+        self.save()
+        self.state_end(args)
 
         # return text
         return text
 
     async def reply_async(self, query, image=None, **kwargs):
-        # get full history and text
-        text = await reply_async(
-            query, image=image, system=self.system, history=self.history, **self.kwargs, **kwargs
-        )
+        # get full history and text (resending it all if the stored state expired)
+        opts = await asyncio.to_thread(self.slot_begin, kwargs)
+        args = self.state_begin(opts, query, image)
+        start = time.perf_counter()
+        try:
+            text = await reply_async(query, image=image, **args)
+        except Exception as e:
+            if not state_expired(args, e):
+                raise
+            args = self.state_begin(opts, query, image, full=True)
+            text = await reply_async(query, image=image, **args)
+        args['stats']['latency'] = time.perf_counter() - start
+        await asyncio.to_thread(self.slot_end, opts)
 
         # update history
-        self.history += history_update(query, text, image)
+        self.append(history_update(query, text, image))
+        self.save()
+        self.state_end(args)
 
         # return text
         return text
 
     def stream(self, query, image=None, **kwargs):
         # get input history (plus prefill) and stream
-        replies = stream(
-            query, image=image, system=self.system, history=self.history, **self.kwargs, **kwargs
-        )
+        opts = self.slot_begin(kwargs)
+        args = self.state_begin(opts, query, image)
 
-        # yield text stream
+        # yield text stream (resending history if the stored state expired)
         reply = ''
-        for chunk in replies:
-            yield chunk
-            reply += chunk
+        try:
+            with closing(timed_stream(stream(query, image=image, **args), args['stats'])) as timed:
+                for chunk in timed:
+                    yield chunk
+                    reply += chunk
+        except Exception as e:
+            if len(reply) > 0 or not state_expired(args, e):
+                raise
+            args = self.state_begin(opts, query, image, full=True)
+            with closing(timed_stream(stream(query, image=image, **args), args['stats'])) as timed:
+                for chunk in timed:
+                    yield chunk
+                    reply += chunk
+        self.slot_end(opts)
 
         # update final history (reply includes prefill)
-        self.history += history_update(query, reply, image)
+        self.append(history_update(query, reply, image))
+        self.save()
+        self.state_end(args)
 
     async def stream_async(self, query, image=None, **kwargs):
         # get input history (plus prefill) and stream
-        replies = stream_async(
-            query, image=image, system=self.system, history=self.history, **self.kwargs, **kwargs
-        )
+        opts = await asyncio.to_thread(self.slot_begin, kwargs)
+        args = self.state_begin(opts, query, image)
 
-        # yield text stream
+        # yield text stream (resending history if the stored state expired)
         reply = ''
-        async for chunk in replies:
-            yield chunk
-            reply += chunk
+        try:
+            async with aclosing(timed_stream_async(stream_async(query, image=image, **args), args['stats'])) as timed:
+                async for chunk in timed:
+                    yield chunk
+                    reply += chunk
+        except Exception as e:
+            if len(reply) > 0 or not state_expired(args, e):
+                raise
+            args = self.state_begin(opts, query, image, full=True)
+            async with aclosing(timed_stream_async(stream_async(query, image=image, **args), args['stats'])) as timed:
+                async for chunk in timed:
+                    yield chunk
+                    reply += chunk
+        await asyncio.to_thread(self.slot_end, opts)
 
         # update final history (reply includes prefill)
-        self.history += history_update(query, reply, image)
+        self.append(history_update(query, reply, image))
+        self.save()
+        self.state_end(args)
@@ -0,0 +1,345 @@
+# corpus embedding pipeline
+
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import asyncio
+import functools
+import numpy as np
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+from .providers import get_provider
+from .api import embed_async, tokenize
+from .index import RowFile
+
+##
+## documents
+##
+
+def read_jsonl_docs(fid, name, text_key, id_key):
+    for i, line in enumerate(fid):
+        if len(line.strip()) == 0:
+            continue
+        rec = json.loads(line)
+        yield rec.get(id_key, f'{name}:{i}'), rec[text_key]
+
+def walk_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+# stream (id, text) pairs: jsonl files give one document per line,
+# other files are one document each, and '-' reads jsonl from stdin
+def read_documents(paths, text_key='text', id_key='id'):
+    paths = [paths] if type(paths) is str else paths
+    for path in walk_paths(paths):
+        if path == '-':
+            yield from read_jsonl_docs(sys.stdin, 'stdin', text_key, id_key)
+        elif path.endswith('.jsonl'):
+            with open(path) as fid:
+                yield from read_jsonl_docs(fid, path, text_key, id_key)
+        else:
+            with open(path, errors='replace') as fid:
+                yield path, fid.read()
+
+##
+## chunking
+##
+
+# tiktoken encoding names or callables returning token lists
+@functools.cache
+def load_tokenizer(name):
+    import tiktoken
+    return tiktoken.get_encoding(name).encode
+
+# stable name for checkpoints, callables may lack a module (str.split)
+def tokenizer_name(tokenizer):
+    if tokenizer is None or type(tokenizer) is str:
+        return tokenizer
+    parts = [getattr(tokenizer, k, None) for k in ('__module__', '__qualname__')]
+    return '.'.join(p for p in parts if p is not None) or repr(tokenizer)
+
+# tokenizers are sent to chunking processes, so they need to pickle
+def picklable(obj):
+    try:
+        pickle.dumps(obj)
+        return True
+    except Exception:
+        return False
+
+# whitespace-delimited units with their token counts, either exact from a
+# local tokenizer or from the document's tokens per character
+def count_units(text, rate=None, tokenizer=None):
+    units = [(m.start(), m.end()) for m in re.finditer(r'\S+\s*', text)]
+    if tokenizer is not None:
+        encode = load_tokenizer(tokenizer) if type(tokenizer) is str else tokenizer
+        counts = [len(encode(text[s:e])) for s, e in units]
+    else:
+        counts = [(e - s) * rate for s, e in units]
+    return units, counts
+
+# split a unit that would not fit in any chunk into equal parts
+def split_unit(start, end, count, max_tokens):
+    parts = int(-(-count // max_tokens))
+    size = -(-(end - start) // parts)
+    for s in range(start, end, size):
+        e = min(s + size, end)
+        yield s, e, count * (e - s) / (end - start)
+
+# greedy packing of units into chunks of at most max_tokens, with the next
+# chunk starting about overlap tokens before the previous one ended
+def chunk_document(text, max_tokens=512, overlap=0, rate=None, tokenizer=None):
+    units, counts = count_units(text, rate=rate, tokenizer=tokenizer)
+    pieces = []
+    for (s, e), n in zip(units, counts):
+        if n > max_tokens:
+            pieces.extend(split_unit(s, e, n, max_tokens))
+        else:
+            pieces.append((s, e, n))
+
+    chunks = []
+    i = 0
+    while i < len(pieces):
+        j, total = i, 0
+        while j < len(pieces) and total + pieces[j][2] <= max_tokens:
+            total += pieces[j][2]
+            j += 1
+        j = max(j, i + 1)
+        start, end = pieces[i][0], pieces[j-1][1]
+        end = start + len(text[start:end].rstrip())
+        chunks.append((start, end, int(round(total))))
+        if j == len(pieces):
+            break
+
+        # step back for overlap, always making progress
+        k, back = j, 0
+        while k > i + 1 and back + pieces[k-1][2] <= overlap:
+            back += pieces[k-1][2]
+            k -= 1
+        i = k
+    return chunks
+
+##
+## token counting
+##
+
+# tokens per character for each document from the provider's tokenize endpoint
+# tokenize_batch is the number of texts per request for providers that take lists
+async def token_rates(texts, provider=None, concurrency=8, **kwargs):
+    prov = get_provider(provider)
+    limit = asyncio.Semaphore(concurrency)
+    async def run(batch):
+        async with limit:
+            return await asyncio.to_thread(tokenize, batch, provider=provider, **kwargs)
+    if prov.tokenize_batch:
+        size = prov.tokenize_batch if type(prov.tokenize_batch) is int else len(texts)
+        batches = [texts[i:i+size] for i in range(0, len(texts), size)]
+        results = await asyncio.gather(*[run(b) for b in batches])
+        tokens = [t for r in results for t in r]
+    else:
+        tokens = await asyncio.gather(*[run(t) for t in texts])
+    return [len(t) / max(1, len(x)) for t, x in zip(tokens, texts)]
+
+##
+## output
+##
+
+# embeddings are appended in document order and a checkpoint is written
+# after each group, so an interrupted run resumes from the last checkpoint
+#
+# layout:
+#   {path}/vectors.f32      float32 rows, one per chunk
+#   {path}/chunks.jsonl     {id, chunk, start, end, tokens} per row
+#   {path}/checkpoint.json  config, documents done, rows and bytes written
+class CorpusWriter:
+    def __init__(self, path, config):
+        self.path = path = os.path.expanduser(path)
+        os.makedirs(path, exist_ok=True)
+        self.chunks_path = os.path.join(path, 'chunks.jsonl')
+        self.check_path = os.path.join(path, 'checkpoint.json')
+        self.state = {'config': config, 'dim': None, 'docs': 0, 'rows': 0, 'bytes': 0}
+
+        # resume from checkpoint, dropping anything written after it
+        if os.path.exists(self.check_path):
+            with open(self.check_path) as fid:
+                state = json.load(fid)
+            if state['config'] != config:
+                raise ValueError(f'Corpus output {path} was written with different settings: {state["config"]}')
+            self.state = state
+        elif os.path.exists(self.chunks_path):
+            raise ValueError(f'Corpus output {path} has no checkpoint')
+        else:
+            self.checkpoint()
+
+        # the first write may have reached disk before any checkpoint had a dim
+        self.vectors = None
+        vecs_path = os.path.join(path, 'vectors.f32')
+        if self.dim is not None:
+            self.open(self.dim)
+            self.vectors.truncate(self.rows)
+        elif os.path.exists(vecs_path):
+            os.truncate(vecs_path, 0)
+        if os.path.exists(self.chunks_path):
+            os.truncate(self.chunks_path, self.state['bytes'])
+
+    @property
+    def dim(self):
+        return self.state['dim']
+
+    @property
+    def docs(self):
+        return self.state['docs']
+
+    @property
+    def rows(self):
+        return self.state['rows']
+
+    def open(self, dim):
+        self.state['dim'] = dim
+        self.vectors = RowFile(os.path.join(self.path, 'vectors.f32'), '<f4', dim)
+
+    def write(self, ndocs, records, vecs):
+        if self.vectors is None:
+            self.open(vecs.shape[1])
+        self.vectors.append(vecs)
+        with open(self.vectors.path, 'rb') as fid:
+            os.fsync(fid.fileno())
+        with open(self.chunks_path, 'a') as fid:
+            for rec in records:
+                fid.write(json.dumps(rec) + '\n')
+            fid.flush()
+            os.fsync(fid.fileno())
+        self.state['docs'] += ndocs
+        self.state['rows'] += len(records)
+        self.state['bytes'] = os.path.getsize(self.chunks_path)
+        self.checkpoint()
+
+    def skip(self, ndocs):
+        self.state['docs'] += ndocs
+        self.checkpoint()
+
+    def checkpoint(self):
+        temp = f'{self.check_path}.tmp'
+        with open(temp, 'w') as fid:
+            json.dump(self.state, fid)
+        os.replace(temp, self.check_path)
+
+# memory mapped vectors and chunk records of a finished (or partial) run
+def load_corpus(path):
+    path = os.path.expanduser(path)
+    with open(os.path.join(path, 'checkpoint.json')) as fid:
+        state = json.load(fid)
+    if state['dim'] is None:
+        return np.empty((0, 0), dtype=np.float32), []
+    vectors = RowFile(os.path.join(path, 'vectors.f32'), '<f4', state['dim'])
+    vectors.size = min(len(vectors), state['rows'])
+    with open(os.path.join(path, 'chunks.jsonl')) as fid:
+        records = [json.loads(line) for line in islice(fid, state['rows'])]
+    return vectors.array(), records
+
+##
+## pipeline
+##
+
+def batched(items, size):
+    items = iter(items)
+    while len(batch := list(islice(items, size))) > 0:
+        yield batch
+
+# token counting (async io) and chunking (process pool) for one group
+async def prepare_group(docs, pool, max_tokens, overlap, tokenizer, provider, concurrency, tokenize_args):
+    texts = [text for _, text in docs]
+    if tokenizer is None:
+        rates = await token_rates(texts, provider=provider, concurrency=concurrency, **tokenize_args)
+    else:
+        rates = [None] * len(texts)
+    func = functools.partial(chunk_document, max_tokens=max_tokens, overlap=overlap, tokenizer=tokenizer)
+    args = [(text, rate) for text, rate in zip(texts, rates)]
+    if pool is None:
+        spans = [func(text, rate=rate) for text, rate in args]
+    else:
+        loop = asyncio.get_running_loop()
+        spans = await asyncio.gather(*[
+            loop.run_in_executor(pool, functools.partial(func, text, rate=rate)) for text, rate in args
+        ])
+    return docs, spans
+
+# chunk and embed a corpus into output, resuming from its checkpoint.
+# the next group is tokenized and chunked while the current one is embedded
+async def embed_corpus_async(
+    paths, output, provider=None, max_tokens=512, overlap=0, tokenizer=None, text_key='text',
+    id_key='id', keep_text=False, group=1024, workers=None, concurrency=None, verbose=False, **kwargs
+):
+    if overlap >= max_tokens:
+        raise ValueError(f'Overlap {overlap} must be less than max_tokens {max_tokens}')
+    prov = get_provider(provider)
+    if tokenizer is None and prov.tokenize_payload is None:
+        raise ValueError(f'Provider {provider or "default"} has no tokenize endpoint, pass tokenizer= to count tokens locally')
+    concurrency = concurrency or prov.embed_concurrency or 1
+    tokenize_args = {k: kwargs[k] for k in ('native', 'base_url', 'api_key', 'model', 'timeout') if k in kwargs}
+
+    # resume after the documents already written
+    config = {
+        'provider': provider, 'model': kwargs.get('model') or prov.embed_model,
+        'max_tokens': max_tokens, 'overlap': overlap, 'tokenizer': tokenizer_name(tokenizer),
+    }
+    writer = CorpusWriter(output, config)
+    documents = islice(read_documents(paths, text_key=text_key, id_key=id_key), writer.docs, None)
+    groups = batched(documents, group)
+    start_docs, start_rows, start = writer.docs, writer.rows, time.monotonic()
+
+    # chunk inline when the tokenizer can't be sent to other processes
+    pool = ProcessPoolExecutor(workers) if workers != 0 and picklable(tokenizer) else None
+    def prepare(docs):
+        return asyncio.create_task(prepare_group(
+            docs, pool, max_tokens, overlap, tokenizer, provider, concurrency, tokenize_args
+        ))
+
+    try:
+        task = prepare(docs) if (docs := next(groups, None)) is not None else None
+        while task is not None:
+            docs, spans = await task
+            task = prepare(nxt) if (nxt := next(groups, None)) is not None else None
+
+            # embed all chunks in the group together
+            records, texts = [], []
+            for (id, text), chunks in zip(docs, spans):
+                for i, (s, e, n) in enumerate(chunks):
+                    rec = {'id': id, 'chunk': i, 'start': s, 'end': e, 'tokens': n}
+                    if keep_text:
+                        rec['text'] = text[s:e]
+                    records.append(rec)
+                    texts.append(text[s:e])
+            if len(texts) > 0:
+                vecs = await embed_async(texts, provider=provider, concurrency=concurrency, **kwargs)
+                await asyncio.to_thread(writer.write, len(docs), records, vecs)
+            else:
+                writer.skip(len(docs))
+
+            if verbose:
+                elapsed = time.monotonic() - start
+                rate = (writer.rows - start_rows) / max(elapsed, 1e-9)
+                print(f'{writer.docs} docs · {writer.rows} chunks · {rate:.1f} chunks/s', file=sys.stderr)
+    finally:
+        if task is not None:
+            task.cancel()
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    return {
+        'docs': writer.docs - start_docs, 'chunks': writer.rows - start_rows,
+        'total_docs': writer.docs, 'total_chunks': writer.rows, 'dim': writer.dim,
+        'seconds': round(time.monotonic() - start, 3),
+    }
+
+def embed_corpus(paths, output, **kwargs):
+    return asyncio.run(embed_corpus_async(paths, output, **kwargs))
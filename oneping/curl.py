@@ -4,9 +4,12 @@ import os
 import json
 import requests
 import aiohttp
+from urllib.parse import urlsplit
+from contextlib import asynccontextmanager
 
-from .providers import get_provider, convert_history
-from .utils import ensure_image_uri
+from .providers import get_provider, convert_history, record_usage
+from .utils import ensure_image_uri, content_encodings, encode_body, decode_body
+from .transport import get_socket
 
 ##
 ## printing
@@ -45,7 +48,7 @@ def prepare_auth(prov, api_key=None):
 
 def prepare_request(
     query, provider=None, system=None, image=None, prefill=None, prediction=None, history=None,
-    base_url=None, path=None, api_key=None, model=None, max_tokens=None, **kwargs
+    base_url=None, path=None, api_key=None, model=None, max_tokens=None, cache_key=None, cache_prefix=None, memo=None, **kwargs
 ):
     # external provider details
     prov = get_provider(provider)
@@ -53,7 +56,7 @@ def prepare_request(
     payload_model = prepare_model(prov, 'chat_model', model=model)
 
     # convert history to provider format
-    history = convert_history(history, prov.content)
+    history = convert_history(history, prov.content, memo=memo)
 
     # get extra headers
     headers_auth = prepare_auth(prov, api_key=api_key)
@@ -75,20 +78,136 @@ def prepare_request(
     if max_tokens is not None:
         payload[prov.max_tokens_name] = max_tokens
 
+    # add prompt cache hints
+    if (cache_func := prov.cache) is not None:
+        payload = cache_func(payload, key=cache_key, breakpoints=prov.cache_breakpoints, prefix=cache_prefix)
+
     # return url, headers, payload
     return url, headers, payload
 
+# only connection-level headers, so every request kind shares one router socket
+def socket_headers(prov, api_key=None, **kwargs):
+    return {**prepare_auth(prov, api_key=api_key), **prov.get('headers', {})}
+
+##
+## compression
+##
+
+# request encodings each server has advertised, keyed by origin
+# bodies are sent uncompressed until a response lists a shared encoding
+SERVER_ENCODINGS = {}
+
+def url_origin(url):
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}'
+
+def learn_encodings(url, headers, rejected=False):
+    if (accept := headers.get('Accept-Encoding')) is not None:
+        SERVER_ENCODINGS[url_origin(url)] = [e.strip() for e in accept.split(',') if e.strip()]
+    elif rejected:
+        SERVER_ENCODINGS[url_origin(url)] = []
+
+# preferring the provider's configured encoding
+def request_encoding(prov, url):
+    offered = SERVER_ENCODINGS.get(url_origin(url), [])
+    shared = [e for e in [prov.compress, *content_encodings()] if e in offered and e in content_encodings()]
+    return shared[0] if len(shared) > 0 else None
+
+def serialize(payload, memo=None):
+    return (json.dumps(payload) if memo is None else memo.dumps(payload)).encode('utf-8')
+
+# serialize payload (reusing cached history json if given a memo),
+# compressing large bodies for providers that support it
+def prepare_body(prov, headers, payload, memo=None, url=None):
+    body = serialize(payload, memo=memo)
+    if prov.compress is None:
+        return body
+    headers['Accept-Encoding'] = ', '.join(content_encodings())
+    if url is None or len(body) < prov.get('compress_min', 0):
+        return body
+    if (encoding := request_encoding(prov, url)) is not None:
+        headers['Content-Encoding'] = encoding
+        body = encode_body(body, encoding)
+    return body
+
+def uncompressed(headers):
+    return {k: v for k, v in headers.items() if k != 'Content-Encoding'}
+
+# post a body, retrying uncompressed if the server rejects its encoding
+def post_request(prov, url, headers, payload, memo=None, **kwargs):
+    body = prepare_body(prov, headers, payload, memo=memo, url=url)
+    response = requests.post(url, headers=headers, data=body, **kwargs)
+    if prov.compress is None:
+        return response
+    rejected = response.status_code == 415 and 'Content-Encoding' in headers
+    learn_encodings(url, response.headers, rejected=rejected)
+    if rejected:
+        response.close()
+        response = requests.post(url, headers=uncompressed(headers), data=serialize(payload, memo=memo), **kwargs)
+        learn_encodings(url, response.headers)
+    return response
+
+@asynccontextmanager
+async def post_request_async(session, prov, url, headers, payload, memo=None):
+    body = prepare_body(prov, headers, payload, memo=memo, url=url)
+    response = await session.post(url, headers=headers, data=body)
+    try:
+        if prov.compress is not None:
+            rejected = response.status == 415 and 'Content-Encoding' in headers
+            learn_encodings(url, response.headers, rejected=rejected)
+            if rejected:
+                response.release()
+                response = await session.post(url, headers=uncompressed(headers), data=serialize(payload, memo=memo))
+                learn_encodings(url, response.headers)
+        yield response
+    finally:
+        response.release()
+
+# compressed responses are decoded here rather than by requests/aiohttp
+def read_json(prov, response):
+    if prov.compress is None:
+        return response.json()
+    raw = response.raw.read(decode_content=False)
+    return json.loads(decode_body(raw, response.headers.get('Content-Encoding')))
+
+async def read_json_async(prov, response):
+    if prov.compress is None:
+        return await response.json()
+    raw = await response.read()
+    return json.loads(decode_body(raw, response.headers.get('Content-Encoding')))
+
+def post_json(prov, url, headers, payload, timeout=None, memo=None):
+    compress = prov.compress is not None
+    response = post_request(prov, url, headers, payload, memo=memo, timeout=timeout, stream=compress)
+    response.raise_for_status()
+    return read_json(prov, response)
+
+##
+## usage
+##
+
+def prepare_stream(prov, headers, payload, stats=None):
+    headers['Accept'] = 'text/event-stream'
+    payload['stream'] = True
+    if stats is not None and prov.include_usage:
+        payload['stream_options'] = {'include_usage': True}
+
+def parse_chunk(prov, parsed, stats=None):
+    if stats is not None and prov.stream_usage is not None:
+        record_usage(stats, prov.stream_usage(parsed))
+    return prov.stream(parsed)
+
 ##
 ## requests
 ##
 
-def reply(query, provider=None, history=None, prefill=None, dryrun=False, **kwargs):
+def reply(query, provider=None, history=None, prefill=None, dryrun=False, stats=None, memo=None, **kwargs):
     # get provider
     prov = get_provider(provider)
 
     # prepare request
     url, headers, payload = prepare_request(
-        query, provider=provider, history=history, prefill=prefill, **kwargs
+        query, provider=prov, history=history, prefill=prefill, memo=memo, **kwargs
     )
 
     # just print the request
@@ -97,12 +216,10 @@ def reply(query, provider=None, history=None, prefill=None, dryrun=False, **kwar
         return
 
     # request response and return
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
-    response.raise_for_status()
-
-    # extract text
-    data = response.json()
+    data = post_json(prov, url, headers, payload, memo=memo)
     text = prov.response(data)
+    if prov.usage is not None:
+        record_usage(stats, prov.usage(data))
 
     # add in prefill
     if prefill is not None:
@@ -111,23 +228,30 @@ def reply(query, provider=None, history=None, prefill=None, dryrun=False, **kwar
     # return text
     return text
 
-async def reply_async(query, provider=None, history=None, prefill=None, **kwargs):
+async def reply_async(query, provider=None, history=None, prefill=None, stats=None, memo=None, **kwargs):
     # get provider
     prov = get_provider(provider)
 
     # prepare request
     url, headers, payload = prepare_request(
-        query, provider=provider, history=history, prefill=prefill, **kwargs
+        query, provider=prov, history=history, prefill=prefill, memo=memo, **kwargs
     )
 
     # request response and return
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, data=json.dumps(payload)) as response:
-            response.raise_for_status()
+    if prov.transport == 'websocket':
+        sock = get_socket(prepare_url(prov, 'ws_path', base_url=kwargs.get('base_url')), headers=socket_headers(prov, **kwargs))
+        data = await sock.result('chat', payload)
+        text = prov.response(data)
+    else:
+        async with aiohttp.ClientSession(auto_decompress=prov.compress is None) as session:
+            async with post_request_async(session, prov, url, headers, payload, memo=memo) as response:
+                response.raise_for_status()
 
-            # extract text
-            data = await response.json()
-            text = prov.response(data)
+                # extract text
+                data = await read_json_async(prov, response)
+                text = prov.response(data)
+                if prov.usage is not None:
+                    record_usage(stats, prov.usage(data))
 
     # add in prefill
     if prefill is not None:
@@ -158,21 +282,20 @@ async def iter_lines(inputs):
     if len(buffer) > 0:
         yield buffer
 
-def stream(query, provider=None, history=None, prefill=None, **kwargs):
+def stream(query, provider=None, history=None, prefill=None, stats=None, memo=None, **kwargs):
     # get provider
     prov = get_provider(provider)
 
     # prepare request
     url, headers, payload = prepare_request(
-        query, provider=provider, history=history, prefill=prefill, **kwargs
+        query, provider=prov, history=history, prefill=prefill, memo=memo, **kwargs
     )
 
     # augment headers/payload
-    headers['Accept'] = 'text/event-stream'
-    payload['stream'] = True
+    prepare_stream(prov, headers, payload, stats=stats)
 
     # make the request
-    with requests.post(url, headers=headers, data=json.dumps(payload), stream=True) as response:
+    with post_request(prov, url, headers, payload, memo=memo, stream=True) as response:
         # check for errors
         response.raise_for_status()
 
@@ -184,26 +307,35 @@ def stream(query, provider=None, history=None, prefill=None, **kwargs):
         for line in response.iter_lines():
             if (data := parse_sse(line)) is not None:
                 parsed = json.loads(data)
-                text = prov.stream(parsed)
+                text = parse_chunk(prov, parsed, stats=stats)
                 if text is not None:
                     yield text
 
-async def stream_async(query, provider=None, history=None, prefill=None, **kwargs):
+async def stream_async(query, provider=None, history=None, prefill=None, stats=None, memo=None, **kwargs):
     # get provider
     prov = get_provider(provider)
 
     # prepare request
     url, headers, payload = prepare_request(
-        query, provider=provider, history=history, prefill=prefill, **kwargs
+        query, provider=prov, history=history, prefill=prefill, memo=memo, **kwargs
     )
 
     # augment headers/payload
-    headers['Accept'] = 'text/event-stream'
-    payload['stream'] = True
+    prepare_stream(prov, headers, payload, stats=stats)
+
+    # multiplexed router transport
+    if prov.transport == 'websocket':
+        sock = get_socket(prepare_url(prov, 'ws_path', base_url=kwargs.get('base_url')), headers=socket_headers(prov, **kwargs))
+        if prefill is not None:
+            yield prefill
+        async for chunk in sock.request('chat', payload):
+            if (text := prov.stream(chunk)) is not None:
+                yield text
+        return
 
     # request stream object
     async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, data=json.dumps(payload)) as response:
+        async with post_request_async(session, prov, url, headers, payload, memo=memo) as response:
             # check for errors
             response.raise_for_status()
             chunks = response.content.iter_any()
@@ -216,15 +348,40 @@ async def stream_async(query, provider=None, history=None, prefill=None, **kwarg
             async for line in iter_lines(chunks):
                 if (data := parse_sse(line)) is not None:
                     parsed = json.loads(data)
-                    text = prov.stream(parsed)
+                    text = parse_chunk(prov, parsed, stats=stats)
                     if text is not None:
                         yield text
 
+##
+## prompt cache warmup
+##
+
+# evaluate system + history into the server's prompt cache without generating
+def prepare_warmup(provider=None, system=None, history=None, **kwargs):
+    url, headers, payload = prepare_request(
+        '', provider=provider, system=system, history=history, max_tokens=0, **kwargs
+    )
+    payload['n_predict'] = 0
+    payload['cache_prompt'] = True
+    return url, headers, payload
+
+def warmup(provider=None, memo=None, **kwargs):
+    prov = get_provider(provider)
+    url, headers, payload = prepare_warmup(provider=prov, memo=memo, **kwargs)
+    post_json(prov, url, headers, payload, memo=memo)
+
+async def warmup_async(provider=None, memo=None, **kwargs):
+    prov = get_provider(provider)
+    url, headers, payload = prepare_warmup(provider=prov, memo=memo, **kwargs)
+    async with aiohttp.ClientSession(auto_decompress=prov.compress is None) as session:
+        async with post_request_async(session, prov, url, headers, payload, memo=memo) as response:
+            response.raise_for_status()
+
 ##
 ## embeddings
 ##
 
-def embed(text, provider=None, base_url=None, path=None, api_key=None, model=None, timeout=None, **kwargs):
+def prepare_embed(text, provider=None, base_url=None, path=None, api_key=None, model=None, **kwargs):
     # get provider details
     prov = get_provider(provider)
     url = prepare_url(prov, f'embed_path', base_url=base_url, path=path)
@@ -237,16 +394,47 @@ def embed(text, provider=None, base_url=None, path=None, api_key=None, model=Non
     payload_model = prepare_model(prov, 'embed_model', model=model)
     payload_message = prov.embed_payload(text)
 
+    # ask for packed float32 rather than json floats
+    payload_encoding = {'encoding_format': 'base64'} if prov.embed_encoding == 'base64' else {}
+
     # compose request
     headers = {'Content-Type': 'application/json', **headers_auth, **headers_extra}
-    payload = {**payload_model, **payload_message, **kwargs}
+    payload = {**payload_model, **payload_message, **payload_encoding, **kwargs}
+
+    # return url, headers, payload
+    return url, headers, payload
+
+def embed(text, provider=None, timeout=None, **kwargs):
+    # prepare request
+    prov = get_provider(provider)
+    url, headers, payload = prepare_embed(text, provider=prov, **kwargs)
 
     # make the request
-    response = requests.post(url, headers=headers, data=json.dumps(payload), timeout=timeout)
-    response.raise_for_status()
+    data = post_json(prov, url, headers, payload, timeout=timeout)
+
+    # extract result
+    result = prov.embed_response(data)
+
+    # return result
+    return result
+
+async def embed_async(text, provider=None, timeout=None, **kwargs):
+    # prepare request
+    prov = get_provider(provider)
+    url, headers, payload = prepare_embed(text, provider=prov, **kwargs)
+
+    # make the request
+    if prov.transport == 'websocket':
+        sock = get_socket(prepare_url(prov, 'ws_path', base_url=kwargs.get('base_url')), headers=socket_headers(prov, **kwargs))
+        data = await sock.result('embed', payload)
+    else:
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        async with aiohttp.ClientSession(auto_decompress=prov.compress is None, timeout=client_timeout) as session:
+            async with post_request_async(session, prov, url, headers, payload) as response:
+                response.raise_for_status()
+                data = await read_json_async(prov, response)
 
     # extract result
-    data = response.json()
     result = prov.embed_response(data)
 
     # return result
@@ -270,12 +458,38 @@ def tokenize(text, provider=None, base_url=None, path=None, api_key=None, model=
     payload = {**payload_model, **payload_message, **kwargs}
 
     # make the request
-    response = requests.post(url, headers=headers, data=json.dumps(payload), timeout=timeout)
-    response.raise_for_status()
+    data = post_json(prov, url, headers, payload, timeout=timeout)
 
     # extract result
-    data = response.json()
     result = prov.tokenize_response(data)
 
     # return result
     return result
+
+##
+## kv cache slots
+##
+
+# save or restore a server slot's kv cache to a file in the server's slot directory
+def slot_action(action, slot, filename, provider=None, base_url=None, api_key=None, timeout=None):
+    # get provider details
+    prov = get_provider(provider)
+    url = prepare_url(prov, 'slot_path', base_url=base_url, path=f'{prov.slot_path}/{slot}')
+
+    # compose request
+    headers_auth = prepare_auth(prov, api_key=api_key)
+    headers = {'Content-Type': 'application/json', **headers_auth}
+    payload = {'filename': filename}
+
+    # make the request
+    response = requests.post(f'{url}?action={action}', headers=headers, data=json.dumps(payload), timeout=timeout)
+    response.raise_for_status()
+
+    # return result
+    return response.json()
+
+def slot_save(slot, filename, **kwargs):
+    return slot_action('save', slot, filename, **kwargs)
+
+def slot_restore(slot, filename, **kwargs):
+    return slot_action('restore', slot, filename, **kwargs)
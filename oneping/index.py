@@ -0,0 +1,492 @@
+# local vector index
+
+import os
+import json
+import threading
+import numpy as np
+
+from .api import embed, embed_async
+from .store import open_append
+
+##
+## helpers
+##
+
+QUANTIZE = (None, 'int8', 'binary')
+METRICS = ('cosine', 'dot')
+
+# set bits per byte value, for hamming distances on packed vectors
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# score matrix entries per search block, bounds temporary memory
+BLOCK_SIZE = 2**24
+
+def as_list(ids):
+    return [ids] if type(ids) in (str, int) else list(ids)
+
+def as_matrix(vecs):
+    vecs = np.asarray(vecs, dtype=np.float32)
+    return vecs[None, :] if vecs.ndim == 1 else vecs
+
+def normalize(vecs):
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs / np.maximum(norms, 1e-12)
+
+##
+## row storage
+##
+
+# append-only matrix, memory mapped when backed by a file
+class RowFile:
+    def __init__(self, path, dtype, width):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.width = width
+        self.row_bytes = self.dtype.itemsize * width
+        self.view = None
+        if path is None:
+            self.buffer = np.empty((0, width), dtype=self.dtype)
+            self.size = 0
+        else:
+            self.size = os.path.getsize(path) // self.row_bytes if os.path.exists(path) else 0
+
+    def __len__(self):
+        return self.size
+
+    def truncate(self, size):
+        self.size = min(self.size, size)
+        self.view = None
+        if self.path is not None and os.path.exists(self.path):
+            os.truncate(self.path, self.size * self.row_bytes)
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape(-1, self.width)
+        if self.path is None:
+            # grow by doubling
+            if self.size + len(rows) > len(self.buffer):
+                capacity = max(1024, 2 * len(self.buffer), self.size + len(rows))
+                buffer = np.empty((capacity, self.width), dtype=self.dtype)
+                buffer[:self.size] = self.buffer[:self.size]
+                self.buffer = buffer
+            self.buffer[self.size:self.size+len(rows)] = rows
+        else:
+            with open(self.path, 'ab') as fid:
+                fid.write(rows.tobytes())
+        self.size += len(rows)
+
+    # rewrite in place (used for reassignments and compaction)
+    def replace(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape(-1, self.width)
+        self.view = None
+        if self.path is None:
+            self.buffer = rows.copy()
+        else:
+            temp = f'{self.path}.tmp'
+            with open(temp, 'wb') as fid:
+                fid.write(rows.tobytes())
+            os.replace(temp, self.path)
+        self.size = len(rows)
+
+    def array(self):
+        if self.path is None:
+            return self.buffer[:self.size]
+        if self.size == 0:
+            return np.empty((0, self.width), dtype=self.dtype)
+        if self.view is None or len(self.view) < self.size:
+            self.view = np.memmap(self.path, dtype=self.dtype, mode='r', shape=(self.size, self.width))
+        return self.view[:self.size]
+
+##
+## vector index
+##
+
+# embeddings stored by id with top-k cosine or dot search
+#
+# layout (or all in memory with path=None):
+#   {path}/meta.json      dim, metric, quantize, nlist
+#   {path}/vectors.bin    float32, int8, or packed sign bits per row
+#   {path}/scales.f32     per row scale for int8
+#   {path}/lists.i32      coarse partition per row (after train)
+#   {path}/centroids.npy  coarse partition centers (after train)
+#   {path}/ids.jsonl      [id, row] records, row is null for deletes
+#
+# rows are only appended, so upserts and deletes leave dead rows behind
+# until compact is called. one process should write to an index at a time
+class VectorIndex:
+    def __init__(self, path=None, dim=None, metric='cosine', quantize=None, provider=None, **kwargs):
+        if metric not in METRICS:
+            raise ValueError(f'Unknown metric: {metric}')
+        if quantize not in QUANTIZE:
+            raise ValueError(f'Unknown quantization: {quantize}')
+        self.path = path = os.path.expanduser(path) if path is not None else None
+        self.provider = provider
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.meta = {'dim': dim, 'metric': metric, 'quantize': quantize, 'nlist': None}
+
+        # load existing metadata
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            if os.path.exists(meta_path := self.file('meta.json')):
+                with open(meta_path) as fid:
+                    self.meta = json.load(fid)
+
+        # id mappings
+        self.rows = {}
+        self.row_ids = []
+        self.centroids = None
+        self.members = None
+        if self.dim is not None:
+            self.open()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, id):
+        return id in self.rows
+
+    @property
+    def dim(self):
+        return self.meta['dim']
+
+    @property
+    def metric(self):
+        return self.meta['metric']
+
+    @property
+    def quantize(self):
+        return self.meta['quantize']
+
+    @property
+    def nlist(self):
+        return self.meta['nlist']
+
+    def file(self, name):
+        return os.path.join(self.path, name) if self.path is not None else None
+
+    def save_meta(self):
+        if self.path is None:
+            return
+        temp = self.file('meta.json.tmp')
+        with open(temp, 'w') as fid:
+            json.dump(self.meta, fid)
+        os.replace(temp, self.file('meta.json'))
+
+    ## storage
+
+    def open(self):
+        dim = self.dim
+        if self.quantize == 'binary':
+            self.vectors = RowFile(self.file('vectors.bin'), np.uint8, (dim + 7) // 8)
+        elif self.quantize == 'int8':
+            self.vectors = RowFile(self.file('vectors.bin'), np.int8, dim)
+        else:
+            self.vectors = RowFile(self.file('vectors.bin'), np.float32, dim)
+        self.scales = RowFile(self.file('scales.f32'), np.float32, 1) if self.quantize == 'int8' else None
+        self.lists = RowFile(self.file('lists.i32'), np.int32, 1) if self.nlist is not None else None
+        if self.nlist is not None and self.path is not None:
+            self.centroids = np.load(self.file('centroids.npy'))
+
+        # rows whose ids were written are complete, trim anything after
+        files = [f for f in (self.vectors, self.scales, self.lists) if f is not None]
+        size = self.load_ids(min(len(f) for f in files))
+        for f in files:
+            f.truncate(size)
+
+    # returns the number of rows covered by id records
+    def load_ids(self, size):
+        records = []
+        path = self.file('ids.jsonl')
+        if path is not None and os.path.exists(path):
+            with open(path) as fid:
+                for line in fid:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue # torn final line
+        size = min(size, max((row + 1 for _, row in records if row is not None), default=0))
+        self.rows = {}
+        self.row_ids = [None] * size
+        for id, row in records:
+            if (old := self.rows.pop(id, None)) is not None:
+                self.row_ids[old] = None
+            if row is not None and row < size:
+                self.rows[id] = row
+                self.row_ids[row] = id
+        self.live = RowFile(None, np.bool_, 1)
+        self.live.append(np.array([i is not None for i in self.row_ids], dtype=np.bool_))
+        return size
+
+    def write_ids(self, records):
+        if (path := self.file('ids.jsonl')) is None:
+            return
+        with open_append(path) as fid:
+            for rec in records:
+                fid.write(json.dumps(rec) + '\n')
+
+    def alive(self, start=0, end=None):
+        return self.live.array()[start:end, 0]
+
+    def kill(self, row):
+        self.row_ids[row] = None
+        self.live.array()[row] = False
+
+    ## quantization
+
+    def encode(self, vecs):
+        if self.quantize == 'binary':
+            return np.packbits(vecs > 0, axis=1), None
+        elif self.quantize == 'int8':
+            scales = np.maximum(np.abs(vecs).max(axis=1, keepdims=True), 1e-12) / 127
+            return np.round(vecs / scales).astype(np.int8), scales
+        return vecs, None
+
+    def dequantize(self, codes, scales=None):
+        if self.quantize == 'binary':
+            bits = np.unpackbits(codes, axis=1)[:, :self.dim]
+            return bits.astype(np.float32) * 2 - 1
+        elif self.quantize == 'int8':
+            return codes.astype(np.float32) * scales
+        return np.asarray(codes, dtype=np.float32)
+
+    def decode(self, rows):
+        scales = self.scales.array()[rows] if self.scales is not None else None
+        return self.dequantize(self.vectors.array()[rows], scales)
+
+    def prepare(self, vecs):
+        vecs = as_matrix(vecs)
+        if self.metric == 'cosine':
+            vecs = normalize(vecs)
+        return vecs
+
+    ## updates
+
+    def insert(self, ids, vecs, replace):
+        ids = as_list(ids)
+        vecs = as_matrix(vecs)
+        if len(ids) != len(vecs):
+            raise ValueError(f'Got {len(ids)} ids for {len(vecs)} vectors')
+        if len(set(ids)) != len(ids):
+            raise ValueError('Duplicate ids in one update')
+        with self.lock:
+            # set dimension on first insert
+            if self.dim is None:
+                self.meta['dim'] = vecs.shape[1]
+                self.save_meta()
+                self.open()
+            elif vecs.shape[1] != self.dim:
+                raise ValueError(f'Vector dimension {vecs.shape[1]} does not match index dimension {self.dim}')
+            if not replace and any(id in self.rows for id in ids):
+                raise ValueError('Ids already in index, use upsert to replace them')
+
+            # append vectors before ids
+            vecs = self.prepare(vecs)
+            codes, scales = self.encode(vecs)
+            start = len(self.vectors)
+            self.vectors.append(codes)
+            if self.scales is not None:
+                self.scales.append(scales)
+            if self.lists is not None:
+                self.lists.append(self.assign(normalize(self.dequantize(codes, scales))))
+                self.members = None
+
+            # point ids at new rows
+            self.row_ids.extend(ids)
+            self.live.append(np.ones(len(ids), dtype=np.bool_))
+            for i, id in enumerate(ids):
+                if (old := self.rows.get(id)) is not None:
+                    self.kill(old)
+                self.rows[id] = start + i
+            self.write_ids([id, start + i] for i, id in enumerate(ids))
+
+    def add(self, ids, vecs):
+        self.insert(ids, vecs, False)
+
+    def upsert(self, ids, vecs):
+        self.insert(ids, vecs, True)
+
+    def delete(self, ids):
+        with self.lock:
+            ids = [id for id in as_list(ids) if id in self.rows]
+            for id in ids:
+                self.kill(self.rows.pop(id))
+            self.write_ids([id, None] for id in ids)
+
+    # dequantized vectors by id
+    def get(self, ids):
+        return self.decode([self.rows[id] for id in as_list(ids)])
+
+    # rewrite storage with only live rows
+    def compact(self):
+        with self.lock:
+            if self.dim is None:
+                return
+            live = np.flatnonzero(self.alive())
+            ids = [self.row_ids[r] for r in live]
+            self.vectors.replace(self.vectors.array()[live])
+            if self.scales is not None:
+                self.scales.replace(self.scales.array()[live])
+            if self.lists is not None:
+                self.lists.replace(self.lists.array()[live])
+                self.members = None
+            self.rows = {id: i for i, id in enumerate(ids)}
+            self.row_ids = ids
+            self.live = RowFile(None, np.bool_, 1)
+            self.live.append(np.ones(len(ids), dtype=np.bool_))
+            if (path := self.file('ids.jsonl')) is not None:
+                temp = f'{path}.tmp'
+                with open(temp, 'w') as fid:
+                    for i, id in enumerate(ids):
+                        fid.write(json.dumps([id, i]) + '\n')
+                os.replace(temp, path)
+
+    ## coarse partition
+
+    def assign(self, vecs, block=65536):
+        lists = np.empty(len(vecs), dtype=np.int32)
+        for i in range(0, len(vecs), block):
+            lists[i:i+block] = np.argmax(vecs[i:i+block] @ self.centroids.T, axis=1)
+        return lists
+
+    # spherical k-means on a sample of live rows, then assign every row
+    def train(self, nlist=None, iters=10, sample=65536, seed=0):
+        with self.lock:
+            if self.dim is None or len(self) == 0:
+                raise ValueError('Cannot train an empty index')
+            live = np.flatnonzero(self.alive())
+            rng = np.random.default_rng(seed)
+            rows = np.sort(rng.choice(live, size=min(sample, len(live)), replace=False))
+            data = normalize(self.decode(rows))
+            nlist = max(1, int(np.sqrt(len(live)))) if nlist is None else nlist
+            nlist = min(nlist, len(data))
+
+            # lloyd iterations
+            centroids = data[rng.choice(len(data), size=nlist, replace=False)]
+            for _ in range(iters):
+                labels = np.argmax(data @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, data)
+                empty = np.bincount(labels, minlength=nlist) == 0
+                sums[empty] = data[rng.choice(len(data), size=empty.sum())]
+                centroids = normalize(sums)
+
+            # assign all rows in blocks
+            self.centroids = centroids.astype(np.float32)
+            size = len(self.vectors)
+            lists = np.empty(size, dtype=np.int32)
+            for i in range(0, size, 65536):
+                chunk = normalize(self.decode(np.arange(i, min(i + 65536, size))))
+                lists[i:i+len(chunk)] = self.assign(chunk)
+            if self.path is not None:
+                np.save(self.file('centroids.npy'), self.centroids)
+            if self.lists is None:
+                self.lists = RowFile(self.file('lists.i32'), np.int32, 1)
+            self.lists.replace(lists)
+            self.members = None
+            self.meta['nlist'] = nlist
+            self.save_meta()
+
+    # rows of each list, rebuilt after updates
+    def list_members(self):
+        if self.members is None:
+            lists = self.lists.array()[:, 0]
+            order = np.argsort(lists, kind='stable')
+            bounds = np.searchsorted(lists[order], np.arange(self.nlist + 1))
+            self.members = (order, bounds)
+        return self.members
+
+    ## search
+
+    def score(self, queries, codes, scales=None):
+        if self.quantize == 'binary':
+            bits = np.packbits(queries > 0, axis=1)
+            dist = POPCOUNT[bits[:, None, :] ^ codes[None, :, :]].sum(axis=2, dtype=np.int32)
+            return 1 - 2 * dist / self.dim
+        scores = queries @ np.asarray(codes, dtype=np.float32).T
+        if scales is not None:
+            scores *= scales[:, 0]
+        return scores
+
+    # bounded by the score matrix (or xor temporaries) and the decoded rows
+    def block_size(self, nq):
+        width = self.vectors.width if self.quantize == 'binary' else 1
+        return max(256, BLOCK_SIZE // max(nq * width, self.dim))
+
+    # exhaustive search in blocks, merging top k as we go
+    def search_all(self, queries, k):
+        nq = len(queries)
+        best_scores = np.full((nq, 0), -np.inf, dtype=np.float32)
+        best_rows = np.empty((nq, 0), dtype=np.int64)
+        codes, size = self.vectors.array(), len(self.vectors)
+        scales = self.scales.array() if self.scales is not None else None
+        block = self.block_size(nq)
+        for start in range(0, size, block):
+            end = min(start + block, size)
+            scores = self.score(queries, codes[start:end], scales[start:end] if scales is not None else None)
+            scores[:, ~self.alive(start, end)] = -np.inf
+            scores = np.concatenate([best_scores, scores.astype(np.float32)], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, end), (nq, end - start))], axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                rows = np.take_along_axis(rows, top, axis=1)
+            best_scores, best_rows = scores, rows
+        return best_scores, best_rows
+
+    # search only the rows in the nprobe closest lists
+    def search_lists(self, queries, k, nprobe):
+        order, bounds = self.list_members()
+        coarse = np.where(queries > 0, 1, -1).astype(np.float32) if self.quantize == 'binary' else queries
+        probes = np.argsort(-(coarse @ self.centroids.T), axis=1)[:, :nprobe]
+        codes = self.vectors.array()
+        scales = self.scales.array() if self.scales is not None else None
+        results = []
+        for query, lists in zip(queries, probes):
+            rows = np.concatenate([order[bounds[l]:bounds[l+1]] for l in lists])
+            rows = np.sort(rows[self.live.array()[rows, 0]])
+            scores = self.score(query[None, :], codes[rows], scales[rows] if scales is not None else None)[0]
+            top = np.argpartition(-scores, min(k, len(rows)) - 1)[:k] if len(rows) > k else np.arange(len(rows))
+            results.append((scores[top].astype(np.float32), rows[top]))
+        return results
+
+    # top k (id, score) pairs per query, best first
+    # a single query vector gives a single list
+    def search(self, queries, k=10, nprobe=8):
+        single = np.ndim(queries) == 1
+        if self.dim is None or len(self) == 0:
+            return [] if single else [[] for _ in range(len(queries))]
+        queries = self.prepare(queries)
+        k = min(k, len(self))
+        if self.nlist is None or nprobe >= self.nlist:
+            scores, rows = self.search_all(queries, k)
+            results = list(zip(scores, rows))
+        else:
+            results = self.search_lists(queries, k, nprobe)
+        output = []
+        for scores, rows in results:
+            rank = np.argsort(-scores, kind='stable')
+            output.append([
+                (self.row_ids[rows[i]], float(scores[i]))
+                for i in rank if np.isfinite(scores[i])
+            ])
+        return output[0] if single else output
+
+    ## text interface
+
+    def embed(self, texts):
+        return embed(texts, provider=self.provider, **self.kwargs)
+
+    def add_texts(self, ids, texts):
+        self.add(ids, self.embed(texts))
+
+    def upsert_texts(self, ids, texts):
+        self.upsert(ids, self.embed(texts))
+
+    def search_texts(self, texts, k=10, nprobe=8):
+        results = self.search(self.embed(texts), k=k, nprobe=nprobe)
+        return results[0] if type(texts) is str else results
+
+    async def search_texts_async(self, texts, k=10, nprobe=8):
+        vecs = await embed_async(texts, provider=self.provider, **self.kwargs)
+        results = self.search(vecs, k=k, nprobe=nprobe)
+        return results[0] if type(texts) is str else results
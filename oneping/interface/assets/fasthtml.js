@@ -12,6 +12,46 @@ function renderBox(box) {
     display.innerHTML = marked.parse(data);
 }
 
+// incremental render for streaming messages, blocks before the last one
+// are final so they're rendered once and only the tail is re-parsed
+function renderTail(box) {
+    const data = box.querySelector('.message-data').textContent;
+    const display = box.querySelector('.message-display');
+    if (box.streamDone == null) {
+        box.streamDone = 0;
+        display.innerHTML = '<div class="md-stable"></div><div class="md-tail"></div>';
+    }
+    const stable = display.querySelector('.md-stable');
+    const tail = display.querySelector('.md-tail');
+
+    // find the last non-space block, everything before it is complete
+    const tokens = marked.lexer(data.slice(box.streamDone));
+    let last = tokens.length - 1;
+    while (last > 0 && tokens[last].type == 'space') last--;
+    if (last > 0) {
+        const done = tokens.slice(0, last);
+        stable.insertAdjacentHTML('beforeend', marked.parser(done));
+        box.streamDone += done.reduce((n, t) => n + t.raw.length, 0);
+        tokens.splice(0, last);
+    }
+    tail.innerHTML = marked.parser(tokens);
+}
+
+// batch renders to one per animation frame
+let pending = null;
+function scheduleRender(box) {
+    const first = pending == null;
+    pending = box;
+    if (!first) return;
+    requestAnimationFrame(() => {
+        const chat = document.getElementById('chat');
+        const follow = chat.scrollTop + chat.clientHeight >= chat.scrollHeight - 10;
+        renderTail(pending);
+        pending = null;
+        if (follow) chat.scrollTop = chat.scrollHeight;
+    });
+}
+
 // handle websocket events - hide and show query box
 document.addEventListener('htmx:wsBeforeMessage', event => {
     const message = event.detail.message;
@@ -29,8 +69,7 @@ document.addEventListener('htmx:wsAfterMessage', event => {
     const chat = document.getElementById('chat');
     const last = chat.querySelector('.chat-box:last-child > .message');
     if (last == null) return;
-    renderBox(last);
-    chat.scrollTop = chat.scrollHeight;
+    scheduleRender(last);
 });
 
 // render markdown in all messages and set focus on query box
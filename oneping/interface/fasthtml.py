@@ -1,16 +1,21 @@
 # fasthtml chat interface
 
 import os
-import asyncstdlib as a
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import aclosing, asynccontextmanager
 
 from fasthtml.components import Use
+from starlette.responses import JSONResponse
 from fasthtml.common import (
     serve, FastHTML, Script, Style, Title, Body, Div, Span, Hidden,
     Form, Button, Input, Textarea, Svg, ScriptX, StyleX
 )
 
-from ..utils import sprint
+from ..utils import sprint, reply_metrics, format_metrics
 from ..chat import Chat
+from ..store import ConvoStore
 
 ##
 ## global
@@ -37,10 +42,15 @@ def ChatBox(role, content, query=False):
     title = Div(Span(role, cls='relative top-[-5px]'), cls='absolute top-[-10px] left-[10px] h-[20px] font-bold pl-1 pr-1 border border-gray-400 rounded bg-white small-caps cursor-default select-none')
     return Div(id=boxid, cls=f'chat-box relative border border-gray-400 rounded m-2 p-2 pt-3 bg-gray-100 {extra}')(title, content)
 
-def ChatMessage(id=None, message=''):
+def ChatStats(id=None, text='', oob=False):
+    swap = 'true' if oob else None
+    return Div(text, id=id, cls='message-stats text-xs text-gray-500 text-right', hx_swap_oob=swap)
+
+def ChatMessage(id=None, message='', stats=None):
     hidden = Div(id=id, cls='message-data hidden')(message)
     display = Div(cls='message-display')
-    return Div(cls='message')(hidden, display)
+    extra = [ChatStats(id=stats)] if stats is not None else []
+    return Div(cls='message')(hidden, display, *extra)
 
 def ChatPrompt(route, trigger=None, hx_vals=None):
     query = ChatInput()
@@ -78,7 +88,9 @@ def ChatWindow(system=None, history=None, route='/generate', trigger=scoped_ente
 def randhex():
     return os.urandom(4).hex()
 
-async def websocket(query, stream, send):
+# chunks are coalesced into one frame per interval (or sooner past max_chars)
+# stats are filled in by the stream and shown under the reply
+async def websocket(query, stream, send, stats=None, interval=0.05, max_chars=4096, verbose=False):
     await send('ONEPING_START')
 
     # clear query input
@@ -90,17 +102,159 @@ async def websocket(query, stream, send):
 
     # start assistant message
     msg_asst = f'message-{randhex()}'
-    box_asst = ChatBox('assistant', ChatMessage(id=msg_asst, message='...'))
+    msg_stats = f'{msg_asst}-stats'
+    box_asst = ChatBox('assistant', ChatMessage(id=msg_asst, message='...', stats=msg_stats))
     await send(Div(box_asst, hx_swap_oob='beforeend', id='chat'))
 
-    # stream in assistant response
-    async for i, chunk in a.enumerate(stream):
-        sprint(chunk)
-        swap_op = 'innerHTML' if i == 0 else 'beforeend'
-        await send(Span(chunk, hx_swap_oob=swap_op, id=msg_asst))
+    # read stream in the background
+    start = time.perf_counter()
+    pending, size = [], 0
+    flush = asyncio.Event()
+    async def read():
+        nonlocal size
+        async with aclosing(stream):
+            async for chunk in stream:
+                pending.append(chunk)
+                size += len(chunk)
+                if size >= max_chars:
+                    flush.set()
+    reader = asyncio.create_task(read())
+
+    # send text and stats together, replacing the placeholder first
+    first, waiter = True, None
+    try:
+        while True:
+            if waiter is None or waiter.done():
+                flush.clear()
+                waiter = asyncio.create_task(flush.wait())
+            await asyncio.wait([reader, waiter], timeout=interval, return_when=asyncio.FIRST_COMPLETED)
+            if len(pending) > 0:
+                text = ''.join(pending)
+                pending.clear()
+                size = 0
+                if verbose:
+                    sprint(text)
+                swap_op = 'innerHTML' if first else 'beforeend'
+                first = False
+                frame = [Span(text, hx_swap_oob=swap_op, id=msg_asst)]
+                if stats is not None:
+                    metrics = reply_metrics(stats, time.perf_counter() - start)
+                    frame.append(ChatStats(msg_stats, format_metrics(metrics), oob=True))
+                await send(tuple(frame))
+            if reader.done():
+                break
+    finally:
+        reader.cancel()
+        waiter.cancel()
+
+    # show errors in place of the reply
+    if (error := reader.exception()) is not None:
+        print(f'ERROR: {error}')
+        swap_op = 'innerHTML' if first else 'beforeend'
+        await send(Span(f'\n\n**Error**: {error}', hx_swap_oob=swap_op, id=msg_asst))
+
+    # final timing and usage
+    if stats is not None:
+        await send(ChatStats(msg_stats, format_metrics(reply_metrics(stats)), oob=True))
 
     await send('ONEPING_DONE')
 
+##
+## sessions
+##
+
+# rough memory held by a chat, messages are kept as dicts and converted copies
+def message_size(message):
+    content = message['content']
+    if type(content) is str:
+        return 2 * len(content) + 256
+    return 2 * (len(content.get('text') or '') + len(content.get('image') or '')) + 256
+
+class Session:
+    def __init__(self, chat):
+        self.chat = chat
+        self.lock = asyncio.Lock()
+        self.used = time.monotonic()
+        self.size = sum(message_size(m) for m in chat.history)
+
+# one chat per browser session, turns within a session run one at a time
+# least recently used sessions are dropped when idle past ttl or over the
+# session or memory caps, with a store they are resumed from it on return
+class ChatSessions:
+    def __init__(self, store=None, max_sessions=256, max_memory=2**28, ttl=3600, **kwargs):
+        self.store = store
+        self.max_sessions = max_sessions
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.kwargs = kwargs
+        self.sessions = OrderedDict()
+        self.memory = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def find(self, sid):
+        return self.sessions.get(sid)
+
+    def get(self, sid):
+        if (session := self.sessions.get(sid)) is None:
+            chat = Chat(convo_id=sid, store=self.store, **self.kwargs)
+            session = self.sessions[sid] = Session(chat)
+            self.memory += session.size
+        else:
+            self.sessions.move_to_end(sid)
+        session.used = time.monotonic()
+        self.evict(keep=sid)
+        return session
+
+    # serialize turns and update the memory estimate afterwards
+    @asynccontextmanager
+    async def turn(self, sid):
+        session = self.get(sid)
+        async with session.lock:
+            try:
+                yield session.chat
+            finally:
+                size = sum(message_size(m) for m in session.chat.history)
+                self.memory += size - session.size
+                session.size = size
+                session.used = time.monotonic()
+        self.evict(keep=sid)
+
+    # drop idle sessions oldest first, skipping ones mid turn
+    def evict(self, keep=None):
+        expire = time.monotonic() - self.ttl
+        for sid, session in list(self.sessions.items()):
+            over = len(self.sessions) > self.max_sessions or self.memory > self.max_memory
+            if not over and session.used > expire:
+                break
+            if sid != keep and not session.lock.locked():
+                self.drop(sid)
+
+    def drop(self, sid):
+        session = self.sessions.pop(sid)
+        self.memory -= session.size
+
+# one shared chat for every browser session, for apps built around a single Chat
+class SingleSession(ChatSessions):
+    def __init__(self, chat):
+        super().__init__()
+        self.session = Session(chat)
+        self.memory = self.session.size
+
+    def __len__(self):
+        return 1
+
+    def find(self, sid):
+        return self.session
+
+    def get(self, sid):
+        self.session.used = time.monotonic()
+        return self.session
+
+    def evict(self, keep=None):
+        pass
+
 ##
 ## web content
 ##
@@ -120,7 +274,7 @@ def ChatJS():
 ## fasthtml app
 ##
 
-def FastHTMLChat(chat):
+def FastHTMLChat(sessions, prefetch=False, verbose=False, interval=0.05):
     # create app object
     hdrs = [
         Script(src="https://cdn.tailwindcss.com"),
@@ -128,9 +282,19 @@ def FastHTMLChat(chat):
     ]
     app = FastHTML(hdrs=hdrs, exts='ws')
 
+    # accept a bare chat as well as a session manager
+    if isinstance(sessions, Chat):
+        sessions = SingleSession(sessions)
+
+    # strong refs to background warmups so they aren't collected
+    background = set()
+
     # connect main
     @app.route('/')
-    def index():
+    def index(session):
+        if (sid := session.get('sid')) is None:
+            sid = session['sid'] = os.urandom(8).hex()
+        chat = sessions.get(sid).chat
         style = ChatCSS()
         script = ChatJS()
         title = Title('Oneping Chat')
@@ -140,23 +304,51 @@ def FastHTMLChat(chat):
 
     # connect websocket
     @app.ws('/generate')
-    async def generate(query: str, send):
-        print(f'GENERATE: {query}')
-        stream = chat.stream_async(query)
-        await websocket(query, stream, send)
-        print('\nDONE')
+    async def generate(query: str, send, session):
+        if (sid := session.get('sid')) is None:
+            return # page was not loaded through index
+        if verbose:
+            print(f'GENERATE [{sid}]: {query}')
+        stats = {}
+        async with sessions.turn(sid) as chat:
+            stream = chat.stream_async(query, stats=stats)
+            await websocket(query, stream, send, stats=stats, interval=interval, verbose=verbose)
+        if verbose:
+            print('\nDONE')
+
+        # warm up prompt cache while the user types
+        if prefetch:
+            task = asyncio.create_task(warmup(sid))
+            background.add(task)
+            task.add_done_callback(background.discard)
+
+    # holds the turn lock so the next turn can't move the context window mid warmup
+    async def warmup(sid):
+        async with sessions.turn(sid) as chat:
+            await chat.warmup_async()
+
+    # session aggregates and per reply metrics
+    @app.route('/stats')
+    def stats(session):
+        if (sid := session.get('sid')) is None or (entry := sessions.find(sid)) is None:
+            return JSONResponse(None)
+        return JSONResponse(entry.chat.perf.export())
 
     # return app
     return app
 
 # fasthtml powered chat interface
-def main(chat_host='127.0.0.1', chat_port=5000, reload=False, **kwargs):
+def main(
+    chat_host='127.0.0.1', chat_port=5000, reload=False, prefetch=False, verbose=False, interval=0.05,
+    store=None, max_sessions=256, max_memory=2**28, ttl=3600, **kwargs
+):
     import uvicorn
     from fasthtml.common import serve
 
     # make application
-    chat = Chat(**kwargs)
-    app = FastHTMLChat(chat)
+    store = ConvoStore(store) if store is not None else None
+    sessions = ChatSessions(store=store, max_sessions=max_sessions, max_memory=max_memory, ttl=ttl, **kwargs)
+    app = FastHTMLChat(sessions, prefetch=prefetch, verbose=verbose, interval=interval)
 
     # run server
     config = uvicorn.Config(app, host=chat_host, port=chat_port, reload=reload)
@@ -1,8 +1,10 @@
 # textual chat interface
 
-import re
-import os
-import datetime
+import time
+import asyncio
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from contextlib import aclosing
 
 from textual import work, Logger
 from textual.app import App
@@ -12,9 +14,9 @@ from textual.containers import Vertical, VerticalScroll
 from textual.reactive import reactive
 from textual.message import Message
 
-from ..providers import DEFAULT_PROVIDER
-from ..utils import cumcat
 from ..chat import Chat
+from ..utils import reply_metrics, format_metrics
+from ..store import ConvoStore
 
 ##
 ## globals
@@ -31,31 +33,40 @@ role_colors = {
 ## sidebar
 ##
 
+class ConvoLabel(Label):
+    class Selected(Message):
+        def __init__(self, convo_id):
+            self.convo_id = convo_id
+            super().__init__()
+
+    def __init__(self, convo_id, title, **kwargs):
+        super().__init__(title, **kwargs)
+        self.convo_id = convo_id
+
+    def on_click(self, event):
+        self.post_message(self.Selected(self.convo_id))
+
+# lists the store index only, conversations are loaded when clicked
 class Sidebar(Widget):
-    def __init__(self, convo, **kwargs):
+    def __init__(self, store, **kwargs):
         super().__init__(**kwargs)
-        self.convo = convo
+        self.store = store
 
     def compose(self):
         with Vertical():
             yield Label("Chat History", id='history_title')
-            for convo in self.convo.values():
-                if convo is None: continue
-                yield Label(convo['title'])
+            for convo in self.store.list():
+                yield ConvoLabel(convo['id'], convo['title'] or 'Untitled')
 
 ##
 ## widgets
 ##
 
-def make_text(text, gen=False):
-    return f'{text} {" ..." if gen else ""}'
-
 class ChatMessage(Markdown):
     generating = reactive(False)
 
     def __init__(self, title, text, gen=False, **kwargs):
-        text0 = make_text(text, gen)
-        super().__init__(text0, **kwargs)
+        super().__init__(text, **kwargs)
         self.border_title = title
         self.styles.border = ('round', role_colors[title])
         self._text = text
@@ -68,26 +79,163 @@ class ChatMessage(Markdown):
         except Exception:
             pass
 
-    def update_text(self, text=None):
-        if text is None:
-            text = self._text
-        else:
-            self._text = text
-        disp = make_text(text, self.generating)
-        return super().update(disp)
+    def update_text(self, text):
+        self._text = text
+        return super().update(text)
+
+    # only the trailing markdown blocks get re-parsed
+    def append_text(self, text):
+        self._text += text
+        return super().append(text)
 
     def watch_generating(self, generating):
-        self.update_text()
+        self.border_subtitle = '...' if generating else None
+
+def content_text(content):
+    return content if type(content) is str else content.get('text', '')
 
-# chat history widget
+class Spacer(Static):
+    pass
+
+# virtualized chat history, only messages near the viewport are mounted, the rest
+# are stood in for by two spacers sized from cached (or estimated) heights
 class ChatHistory(VerticalScroll):
-    def __init__(self, system=None, **kwargs):
+    def __init__(self, system=None, overscan=4, **kwargs):
         super().__init__(**kwargs)
-        self.system = system
+        self.overscan = overscan
+        self.items = [] # [role, text, generating]
+        self.heights = []
+        self.offsets = [0]
+        self.widgets = {}
+        self.window = (0, 0)
+        self.width = None
+        if system is not None:
+            self.add('system', system)
 
     def compose(self):
-        if self.system is not None:
-            yield ChatMessage('system', self.system)
+        yield Spacer(id='top')
+        yield Spacer(id='bottom')
+
+    def on_mount(self):
+        self.top = self.query_one('#top')
+        self.bottom = self.query_one('#bottom')
+        self.refresh_window()
+
+    ## layout
+
+    # wrapped line count plus border, replaced by the real height once mounted
+    def estimate(self, text):
+        width = max(10, (self.width or 80) - 4)
+        lines = sum(max(1, -(-len(line) // width)) for line in text.split('\n'))
+        return lines + 2
+
+    def update_offsets(self):
+        self.offsets = [0, *accumulate(self.heights)]
+
+    def on_resize(self, event):
+        if event.size.width != self.width:
+            self.width = event.size.width
+            self.heights = [ self.estimate(text) for _, text, _ in self.items ]
+            self.update_offsets()
+            self.refresh_window(force=True)
+
+    def measure(self):
+        changed = False
+        for i, widget in self.widgets.items():
+            if (height := widget.outer_size.height) > 0 and height != self.heights[i]:
+                self.heights[i] = height
+                changed = True
+        if changed:
+            follow = self.following()
+            self.update_offsets()
+            self.size_spacers()
+            if follow:
+                self.call_after_refresh(self.scroll_end, animate=False)
+
+    def size_spacers(self):
+        start, end = self.window
+        self.top.styles.height = self.offsets[start]
+        self.bottom.styles.height = self.offsets[-1] - self.offsets[end]
+
+    # mount messages in view (plus overscan) and unmount the rest
+    def refresh_window(self, force=False, end=False):
+        if not self.is_mounted:
+            return
+        height = self.size.height or 24
+        if end:
+            y = max(0, self.offsets[-1] - height)
+        else:
+            y = self.scroll_y
+        start = max(0, bisect_right(self.offsets, y) - 1 - self.overscan)
+        stop = min(len(self.items), bisect_left(self.offsets, y + height) + self.overscan)
+        if (start, stop) == self.window and not force:
+            return
+
+        # drop widgets out of view
+        for i in list(self.widgets):
+            if not start <= i < stop:
+                self.widgets.pop(i).remove()
+
+        # mount new widgets in order
+        for i in range(start, stop):
+            if i not in self.widgets:
+                role, text, gen = self.items[i]
+                widget = ChatMessage(role, text, gen=gen)
+                after = [ j for j in self.widgets if j > i ]
+                before = self.widgets[min(after)] if len(after) > 0 else self.bottom
+                self.mount(widget, before=before)
+                self.widgets[i] = widget
+
+        # resize spacers and measure once laid out
+        self.window = (start, stop)
+        self.size_spacers()
+        self.call_after_refresh(self.measure)
+
+    def watch_scroll_y(self, old_value, new_value):
+        super().watch_scroll_y(old_value, new_value)
+        self.refresh_window()
+
+    ## items
+
+    def set_items(self, system, messages):
+        for widget in self.widgets.values():
+            widget.remove()
+        self.widgets = {}
+        self.window = (0, 0)
+        items = [('system', system)] if system is not None else []
+        items += [ (msg['role'], content_text(msg['content'])) for msg in messages ]
+        self.items = [ [role, text, False] for role, text in items ]
+        self.heights = [ self.estimate(text) for _, text, _ in self.items ]
+        self.update_offsets()
+        self.refresh_window(end=True)
+        self.call_after_refresh(self.scroll_end, animate=False)
+
+    def add(self, role, text, gen=False):
+        self.items.append([role, text, gen])
+        self.heights.append(self.estimate(text))
+        self.offsets.append(self.offsets[-1] + self.heights[-1])
+        self.refresh_window(force=True, end=True)
+        self.call_after_refresh(self.scroll_end, animate=False)
+        return len(self.items) - 1
+
+    async def append_text(self, index, text):
+        self.items[index][1] += text
+        if (widget := self.widgets.get(index)) is not None:
+            await widget.append_text(text)
+            self.call_after_refresh(self.measure)
+
+    def set_generating(self, index, gen):
+        self.items[index][2] = gen
+        if (widget := self.widgets.get(index)) is not None:
+            widget.generating = gen
+
+    def following(self):
+        return self.scroll_y >= self.max_scroll_y - 1
+
+    # scroll straight to a message, materializing only what's around it
+    def jump(self, index):
+        self.scroll_to(y=self.offsets[index], animate=False)
+        self.refresh_window()
 
 class ChatInput(TextArea):
     class Submitted(Message):
@@ -95,8 +243,19 @@ class ChatInput(TextArea):
             self.text = text
             super().__init__()
 
+    class Typing(Message):
+        pass
+
     def __init__(self, **kwargs):
         super().__init__(highlight_cursor_line=False, **kwargs)
+        self.typing = False
+
+    def on_text_area_changed(self, event):
+        if len(self.text) == 0:
+            self.typing = False
+        elif not self.typing:
+            self.typing = True
+            self.post_message(self.Typing())
 
     def on_key(self, event):
         if event.key == 'ctrl+enter':
@@ -111,99 +270,106 @@ class ChatInput(TextArea):
 
 # textualize chat app
 class ChatWindow(Static):
-    def __init__(self, stream, system=None, **kwargs):
+    class Metrics(Message):
+        def __init__(self, metrics):
+            self.metrics = metrics
+            super().__init__()
+
+    def __init__(self, stream, system=None, warmup=None, fps=30, **kwargs):
         super().__init__(**kwargs)
         self.stream = stream
         self.system = system
+        self.warmup = warmup
+        self.warmed = False
+        self.interval = 1 / fps
 
     def compose(self):
         yield ChatHistory(system=self.system)
         yield ChatInput()
 
+    def load_history(self, system, messages):
+        history = self.query_one('ChatHistory')
+        history.set_items(system, messages)
+        self.warmed = False
+
     def on_key(self, event):
         history = self.query_one('ChatHistory')
         if event.key == 'pageup':
-            history.scroll_up(animate=False)
+            history.scroll_page_up(animate=False)
         elif event.key == 'pagedown':
-            history.scroll_down(animate=False)
+            history.scroll_page_down(animate=False)
+        elif event.key == 'ctrl+home':
+            history.jump(0)
+        elif event.key == 'ctrl+end':
+            history.scroll_end(animate=False)
 
     async def on_chat_input_submitted(self, message):
+        self.warmed = False
         await self.submit_query(message.text)
 
-    async def submit_query(self, query):
-        # make new messages
-        user = ChatMessage('user', query, gen=False)
-        response = ChatMessage('assistant', '', gen=True)
+    # warm up the prompt cache if it hasn't been since the last turn
+    def on_chat_input_typing(self, message):
+        if not self.warmed:
+            self.prefetch()
+
+    def prefetch(self):
+        if self.warmup is not None:
+            self.warmed = True
+            self.run_warmup()
 
-        # mount new messages
+    @work(exclusive=True, group='warmup')
+    async def run_warmup(self):
+        await self.warmup()
+
+    async def submit_query(self, query):
+        # add new messages
         history = self.query_one('ChatHistory')
-        await history.mount(user)
-        await history.mount(response)
-
-        # make update method
-        def update(reply):
-            if reply is None:
-                self.log.debug('STREAM DONE')
-                response.generating = False
-                return
-            response.update_text(reply)
-            history.scroll_end(animate=False)
+        history.add('user', query)
+        index = history.add('assistant', '', gen=True)
 
-        # send message
-        generate = self.stream(query)
+        # send message (stats are filled in as it streams)
+        stats = {}
+        generate = self.stream(query, stats=stats)
         self.log.debug(f'STARTING STREAM: {query}')
-        self.pipe_stream(generate, update)
+        self.pipe_stream(generate, index, stats)
 
-    @work(thread=True)
-    async def pipe_stream(self, generate, setter):
-        async for reply in cumcat(generate):
-            self.app.call_from_thread(setter, reply)
-        self.app.call_from_thread(setter, None)
-
-class ConvoStore:
-    def __init__(self, store):
-        self.store = store
-        self.load_store()
-
-    @staticmethod
-    def load_convo(path):
-        # read markdown file
-        timestamp = datetime.datetime.now()
-        with open(path, 'r') as fid:
-            markdown = fid.read().strip()
-
-        # match title (#!)
-        title_match = re.match(r'^#! (.*)\n', markdown)
-        if title_match is None: return None
-        title = title_match.group(1)
-
-        # match messages
-        chunks = re.split(r'\n\n(SYSTEM|USER|ASSISTANT): ', markdown)
-        if len(chunks) == 1 or len(chunks) % 2 == 0: return None
-
-        # message list format
-        messages = [
-            {'role': role, 'text': text}
-            for role, text in zip(chunks[1::2], chunks[2::2])
-        ]
-
-        # return title and messages
-        return {
-            'title': title,
-            'messages': messages,
-            'timestamp': timestamp,
-        }
+    # chunks are buffered as they arrive and rendered at most once per frame
+    @work(group='stream')
+    async def pipe_stream(self, generate, index, stats):
+        history = self.query_one('ChatHistory')
+        start = time.perf_counter()
+        pending = []
 
-    def load_store(self):
-        # check for exitence
-        self.convo = {}
-        if not os.path.exists(self.store):
-            return
+        async def read():
+            async with aclosing(generate):
+                async for chunk in generate:
+                    pending.append(chunk)
+        reader = asyncio.create_task(read())
 
-        # load all convos
-        for file in os.listdir(self.store):
-            path = os.path.join(self.store, file)
-            self.convo[file] = self.load_convo(path)
+        try:
+            while True:
+                await asyncio.wait([reader], timeout=self.interval)
+                if len(pending) > 0:
+                    text = ''.join(pending)
+                    pending.clear()
+                    follow = history.following()
+                    await history.append_text(index, text)
+                    if follow:
+                        history.scroll_end(animate=False)
+                    self.post_message(self.Metrics(reply_metrics(stats, time.perf_counter() - start)))
+                if reader.done():
+                    break
+        finally:
+            reader.cancel()
+
+        # show errors in place of the reply
+        if (error := reader.exception()) is not None:
+            await history.append_text(index, f'\n\n**Error**: {error}')
+
+        self.log.debug('STREAM DONE')
+        self.post_message(self.Metrics(reply_metrics(stats, time.perf_counter() - start)))
+        history.set_generating(index, False)
+        self.prefetch()
 
 class TextualChat(App):
     CSS = """
@@ -217,6 +383,10 @@ class TextualChat(App):
         scrollbar-size-vertical: 0;
     }
 
+    Spacer {
+        height: 0;
+    }
+
     ChatInput {
         background: transparent;
         border: round white;
@@ -265,28 +435,32 @@ class TextualChat(App):
 
     show_sidebar = reactive(False)
 
-    def __init__(self, chat, store=None, **kwargs):
+    def __init__(self, chat, prefetch=False, fps=30, **kwargs):
         super().__init__(**kwargs)
         self.chat = chat
-
-        # load conversation history
-        self.store = ConvoStore(store) if store is not None else None
+        self.prefetch = prefetch
+        self.fps = fps
+        self.store = chat.store
 
         # set window title
-        provider = self.chat.kwargs.get('provider', DEFAULT_PROVIDER)
+        provider = self.chat.kwargs.get('provider', 'default')
         model = self.chat.kwargs.get('model', "default")
         self.title = f'oneping: {provider} / {model}'
 
     def compose(self):
         yield Header(id='header')
         if self.store is not None:
-            yield Sidebar(convo=self.store.convo)
-        yield ChatWindow(self.chat.stream_async, system=self.chat.system)
+            yield Sidebar(self.store)
+        warmup = self.chat.warmup_async if self.prefetch else None
+        yield ChatWindow(self.chat.stream_async, system=self.chat.system, warmup=warmup, fps=self.fps)
 
     def on_mount(self):
         query = self.query_one('ChatInput')
         history = self.query_one('ChatHistory')
         self.set_focus(query)
+        if self.chat.head is not None:
+            window = self.query_one(ChatWindow)
+            window.load_history(self.chat.system, self.chat.history)
         history.scroll_end(animate=False)
 
     def on_key(self, event):
@@ -294,17 +468,41 @@ class TextualChat(App):
             if self.store is not None:
                 self.show_sidebar = not self.show_sidebar
             event.prevent_default()
+        elif event.key == 'ctrl+e':
+            self.export_stats()
+            event.prevent_default()
         elif event.key == 'ctrl+c':
             self.exit()
             event.prevent_default()
 
+    # live metrics for the current reply
+    def on_chat_window_metrics(self, message):
+        self.sub_title = format_metrics(message.metrics)
+
+    # session aggregates and per reply metrics as json
+    def export_stats(self, path=None):
+        path = f'oneping-stats-{self.chat.convo_id}.json' if path is None else path
+        self.chat.perf.export(path)
+        self.notify(f'Exported stats for {len(self.chat.perf)} replies to {path}')
+
     def watch_show_sidebar(self, show_sidebar):
         if self.store is not None:
             sidebar = self.query_one(Sidebar)
+            if show_sidebar:
+                sidebar.refresh(recompose=True)
             sidebar.set_class(show_sidebar, "-visible")
 
+    def on_convo_label_selected(self, message):
+        self.chat.load(message.convo_id)
+        window = self.query_one(ChatWindow)
+        window.load_history(self.chat.system, self.chat.history)
+        self.show_sidebar = False
+
 # textual powered chat interface
-def main(store=None, **kwargs):
-    chat = Chat(**kwargs)
-    app = TextualChat(chat, store=store)
+def main(store=None, prefetch=False, fps=30, export_stats=None, **kwargs):
+    store = ConvoStore(store) if store is not None else None
+    chat = Chat(store=store, **kwargs)
+    app = TextualChat(chat, prefetch=prefetch, fps=fps)
     app.run()
+    if export_stats is not None:
+        chat.perf.export(export_stats)
@@ -0,0 +1,169 @@
+# router metrics
+
+import os
+import time
+from contextlib import contextmanager, closing, aclosing
+
+from .utils import timed_stream, timed_stream_async
+
+try:
+    import prometheus_client as prom
+    from prometheus_client import multiprocess
+except ImportError:
+    prom = None
+
+##
+## helpers
+##
+
+def has_metrics():
+    return prom is not None
+
+def is_multiprocess():
+    return 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+# latency buckets in seconds, tuned for llm requests
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+
+##
+## metrics registry
+##
+
+# prometheus metrics for the router, all methods are no-ops if prometheus_client is missing
+class RouterMetrics:
+    def __init__(self):
+        self.enabled = has_metrics()
+        if not self.enabled:
+            return
+
+        # private registry so multiple routers can coexist
+        self.registry = prom.CollectorRegistry()
+        labels = ['endpoint', 'provider', 'model']
+        stream_labels = ['provider', 'model']
+
+        # request level metrics
+        self.requests = prom.Counter(
+            'oneping_requests', 'Requests received', labels, registry=self.registry
+        )
+        self.errors = prom.Counter(
+            'oneping_errors', 'Requests that failed', labels, registry=self.registry
+        )
+        self.latency = prom.Histogram(
+            'oneping_request_seconds', 'Total request latency', labels,
+            buckets=LATENCY_BUCKETS, registry=self.registry
+        )
+
+        # streaming metrics (tokens are approximated by stream chunks)
+        self.ttft = prom.Histogram(
+            'oneping_ttft_seconds', 'Time to first token', stream_labels,
+            buckets=LATENCY_BUCKETS, registry=self.registry
+        )
+        self.tokens = prom.Counter(
+            'oneping_output_tokens', 'Streamed output tokens', stream_labels, registry=self.registry
+        )
+        self.token_rate = prom.Histogram(
+            'oneping_tokens_per_second', 'Streamed output tokens per second', stream_labels,
+            buckets=RATE_BUCKETS, registry=self.registry
+        )
+        self.inflight = prom.Gauge(
+            'oneping_inflight_streams', 'Streams currently open', stream_labels,
+            multiprocess_mode='livesum', registry=self.registry
+        )
+
+        # batching and caching
+        self.queue = prom.Gauge(
+            'oneping_queue_depth', 'Texts waiting for a batch', ['endpoint'],
+            multiprocess_mode='livesum', registry=self.registry
+        )
+        self.cache = prom.Counter(
+            'oneping_cache', 'Response cache lookups', ['endpoint', 'result'], registry=self.registry
+        )
+
+    def render(self):
+        if is_multiprocess():
+            registry = prom.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = self.registry
+        return prom.generate_latest(registry), prom.CONTENT_TYPE_LATEST
+
+    def error(self, endpoint, provider, model):
+        if self.enabled:
+            self.errors.labels(endpoint, provider, model).inc()
+
+    def cache_lookup(self, endpoint, hit):
+        if self.enabled:
+            self.cache.labels(endpoint, 'hit' if hit else 'miss').inc()
+
+    def queue_depth(self, endpoint, depth):
+        if self.enabled:
+            self.queue.labels(endpoint).set(depth)
+
+    # time a non-streaming request, counting raised exceptions as errors
+    @contextmanager
+    def track(self, endpoint, provider, model):
+        if not self.enabled:
+            yield
+            return
+        labels = (endpoint, provider, model)
+        self.requests.labels(*labels).inc()
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors.labels(*labels).inc()
+            raise
+        finally:
+            self.latency.labels(*labels).observe(time.perf_counter() - start)
+
+    def stream_start(self, endpoint, provider, model):
+        self.requests.labels(endpoint, provider, model).inc()
+        self.inflight.labels(provider, model).inc()
+        return time.perf_counter()
+
+    # latency is missing if the stream was closed before it started
+    def stream_end(self, stats, start, endpoint, provider, model):
+        self.inflight.labels(provider, model).dec()
+        latency = stats.get('latency', time.perf_counter() - start)
+        self.latency.labels(endpoint, provider, model).observe(latency)
+        if (ttft := stats.get('ttft')) is not None:
+            self.ttft.labels(provider, model).observe(ttft)
+            self.tokens.labels(provider, model).inc(stats['chunks'])
+            if (gen_time := latency - ttft) > 0:
+                self.token_rate.labels(provider, model).observe(stats['chunks'] / gen_time)
+
+    # wrap a chunk stream, recording ttft and token rate when it finishes
+    def track_stream(self, stream, endpoint, provider, model):
+        if not self.enabled:
+            with closing(stream):
+                yield from stream
+            return
+        start = self.stream_start(endpoint, provider, model)
+        stats = {}
+        try:
+            with closing(timed_stream(stream, stats)) as timed:
+                yield from timed
+        except Exception:
+            self.errors.labels(endpoint, provider, model).inc()
+            raise
+        finally:
+            self.stream_end(stats, start, endpoint, provider, model)
+
+    async def track_stream_async(self, stream, endpoint, provider, model):
+        if not self.enabled:
+            async with aclosing(stream):
+                async for chunk in stream:
+                    yield chunk
+            return
+        start = self.stream_start(endpoint, provider, model)
+        stats = {}
+        try:
+            async with aclosing(timed_stream_async(stream, stats)) as timed:
+                async for chunk in timed:
+                    yield chunk
+        except Exception:
+            self.errors.labels(endpoint, provider, model).inc()
+            raise
+        finally:
+            self.stream_end(stats, start, endpoint, provider, model)
@@ -4,8 +4,20 @@
 ## local providers
 ##
 
+# local servers and providers only available through the url interface
+URL_PROVIDERS = ('llama-cpp', 'tei', 'vllm', 'oneping', 'openai-responses', 'xai-responses')
+
+# native clients that can fill in a stats dict with token usage
+USAGE_PROVIDERS = ('openai', 'anthropic')
+
 def has_native(provider):
-    return provider not in (None, 'llama-cpp', 'tei', 'vllm', 'oneping')
+    return provider not in (None, *URL_PROVIDERS)
+
+# other clients would pass stats on to the sdk, so drop it
+def usage_kwargs(provider, kwargs):
+    if provider not in USAGE_PROVIDERS:
+        kwargs.pop('stats', None)
+    return kwargs
 
 ##
 ## dummy function
@@ -190,6 +202,7 @@ def make_client(provider, **kwargs):
         raise Exception(f'Provider {provider} not found')
 
 def reply(query, provider, **kwargs):
+    kwargs = usage_kwargs(provider, kwargs)
     if provider == 'openai':
         return reply_openai(query, **kwargs)
     elif provider == 'anthropic':
@@ -210,6 +223,7 @@ def reply(query, provider, **kwargs):
         raise Exception(f'Provider {provider} not found')
 
 def reply_async(query, provider, **kwargs):
+    kwargs = usage_kwargs(provider, kwargs)
     if provider == 'openai':
         return reply_async_openai(query, **kwargs)
     elif provider == 'anthropic':
@@ -228,6 +242,7 @@ def reply_async(query, provider, **kwargs):
         raise Exception(f'Provider {provider} not found')
 
 def stream(query, provider, **kwargs):
+    kwargs = usage_kwargs(provider, kwargs)
     if provider == 'openai':
         return stream_openai(query, **kwargs)
     elif provider == 'anthropic':
@@ -248,6 +263,7 @@ def stream(query, provider, **kwargs):
         raise Exception(f'Provider {provider} not found')
 
 def stream_async(query, provider, **kwargs):
+    kwargs = usage_kwargs(provider, kwargs)
     if provider == 'openai':
         return stream_async_openai(query, **kwargs)
     elif provider == 'anthropic':
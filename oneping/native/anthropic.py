@@ -5,18 +5,24 @@ import anthropic
 
 from ..providers import (
     CONFIG as C, PROVIDERS as P,
-    content_anthropic, convert_history, payload_anthropic,
-    response_anthropic_native, stream_anthropic_native
+    content_anthropic, convert_history, payload_anthropic, cache_payload,
+    response_anthropic_native, stream_anthropic_native,
+    usage_anthropic, stream_usage_anthropic, record_usage
 )
 
 ##
 ## helper functions
 ##
 
-def make_payload(query, image=None, system=None, history=None):
+def make_payload(query, image=None, system=None, history=None, cache_key=None, cache_prefix=None):
     content = content_anthropic(query, image=image)
     history = convert_history(history, content_anthropic)
-    return payload_anthropic(content, system=system, history=history)
+    payload = payload_anthropic(content, system=system, history=history)
+    return cache_payload(payload, 'anthropic', key=cache_key, prefix=cache_prefix)
+
+def record_chunk(stats, chunk):
+    if stats is not None and chunk.type in ('message_start', 'message_delta'):
+        record_usage(stats, stream_usage_anthropic(chunk.model_dump()))
 
 ##
 ## common interface
@@ -27,36 +33,48 @@ def make_client(async_client=False, api_key=None):
     client_class = anthropic.AsyncAnthropic if async_client else anthropic.Anthropic
     return client_class(api_key=api_key, default_headers=P.anthropic.headers)
 
-def reply(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=P.anthropic.chat_model, max_tokens=C.max_tokens, **kwargs):
+def reply(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=P.anthropic.chat_model, max_tokens=C.max_tokens, cache_key=None, cache_prefix=None, stats=None, **kwargs):
     client = make_client(api_key=api_key)
-    payload = make_payload(query, image=image, system=system, history=history)
+    payload = make_payload(query, image=image, system=system, history=history, cache_key=cache_key, cache_prefix=cache_prefix)
     response = client.messages.create(model=model, max_tokens=max_tokens, **payload, **kwargs)
+    if stats is not None:
+        record_usage(stats, usage_anthropic(response.model_dump()))
     return response_anthropic_native(response)
 
-async def reply_async(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=None, max_tokens=C.max_tokens, **kwargs):
+async def reply_async(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=None, max_tokens=C.max_tokens, cache_key=None, cache_prefix=None, stats=None, **kwargs):
     model = model if model is not None else P.anthropic.chat_model
     client = make_client(async_client=True, api_key=api_key)
-    payload = make_payload(query, image=image, system=system, history=history)
+    payload = make_payload(query, image=image, system=system, history=history, cache_key=cache_key, cache_prefix=cache_prefix)
     response = await client.messages.create(model=model, max_tokens=max_tokens, **payload, **kwargs)
+    if stats is not None:
+        record_usage(stats, usage_anthropic(response.model_dump()))
     text = response_anthropic_native(response)
     return (prefill + text) if prefill is not None else text
 
-def stream(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=None, max_tokens=C.max_tokens, **kwargs):
+def stream(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=None, max_tokens=C.max_tokens, cache_key=None, cache_prefix=None, stats=None, **kwargs):
     model = model if model is not None else P.anthropic.chat_model
     client = make_client(api_key=api_key)
-    payload = make_payload(query, image=image, system=system, history=history)
+    payload = make_payload(query, image=image, system=system, history=history, cache_key=cache_key, cache_prefix=cache_prefix)
     response = client.messages.create(model=model, stream=True, max_tokens=max_tokens, **payload, **kwargs)
     if prefill is not None:
         yield prefill
-    for chunk in response:
-        yield stream_anthropic_native(chunk)
+    try:
+        for chunk in response:
+            record_chunk(stats, chunk)
+            yield stream_anthropic_native(chunk)
+    finally:
+        response.close()
 
-async def stream_async(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=None, max_tokens=C.max_tokens, **kwargs):
+async def stream_async(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=None, max_tokens=C.max_tokens, cache_key=None, cache_prefix=None, stats=None, **kwargs):
     model = model if model is not None else P.anthropic.chat_model
     client = make_client(async_client=True, api_key=api_key)
-    payload = make_payload(query, image=image, system=system, history=history)
+    payload = make_payload(query, image=image, system=system, history=history, cache_key=cache_key, cache_prefix=cache_prefix)
     response = await client.messages.create(model=model, stream=True, max_tokens=max_tokens, **payload, **kwargs)
     if prefill is not None:
         yield prefill
-    async for chunk in response:
-        yield stream_anthropic_native(chunk)
+    try:
+        async for chunk in response:
+            record_chunk(stats, chunk)
+            yield stream_anthropic_native(chunk)
+    finally:
+        await response.close()
@@ -7,7 +7,7 @@ from ..providers import (
     CONFIG as C, PROVIDERS as P,
     content_openai, convert_history, payload_openai,
     response_openai_native, stream_openai_native,
-    embed_response_openai, transcribe_response_openai,
+    embed_response_openai_native, transcribe_response_openai,
 )
 
 ##
@@ -52,8 +52,11 @@ def stream(
     client = make_client(azure_endpoint, api_key=api_key, azure_deployment=azure_deployment)
     payload = make_payload(query, image=image, prediction=prediction, system=system, history=history)
     response = client.chat.completions.create(model=model, stream=True, **payload, **kwargs)
-    for chunk in response:
-        yield stream_openai_native(chunk)
+    try:
+        for chunk in response:
+            yield stream_openai_native(chunk)
+    finally:
+        response.close()
 
 async def stream_async(
     query, image=None, history=None, prefill=None, prediction=None, system=C.system, model=P.azure.chat_model,
@@ -62,15 +65,18 @@ async def stream_async(
     client = make_client(azure_endpoint, api_key=api_key, azure_deployment=azure_deployment, async_client=True)
     payload = make_payload(query, image=image, prediction=prediction, system=system, history=history)
     response = await client.chat.completions.create(model=model, stream=True, **payload, **kwargs)
-    for chunk in response:
-        yield stream_openai_native(chunk)
+    try:
+        async for chunk in response:
+            yield stream_openai_native(chunk)
+    finally:
+        await response.close()
 
 def embed(
     query, model=P.azure.embed_model, azure_endpoint=None, azure_deployment=None, api_key=None, **kwargs
 ):
     client = make_client(azure_endpoint, api_key=api_key, azure_deployment=azure_deployment)
-    response = client.embeddings.create(model=model, **kwargs)
-    return embed_response_openai(response)
+    response = client.embeddings.create(input=query, model=model, encoding_format='base64', **kwargs)
+    return embed_response_openai_native(response)
 
 def transcribe(
     audio, model=P.azure.transcribe_model, azure_endpoint=None, azure_deployment=None, api_key=None, **kwargs
@@ -43,12 +43,18 @@ def stream(query, image=None, history=None, prefill=None, prediction=None, syste
     client = make_client(api_key=api_key)
     payload = make_payload(query, image=image, system=system, history=history)
     response = client.chat.completions.create(model=model, stream=True, **payload, **kwargs)
-    for chunk in response:
-        yield stream_openai_native(chunk)
+    try:
+        for chunk in response:
+            yield stream_openai_native(chunk)
+    finally:
+        response.close()
 
 async def stream_async(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=P.groq.chat_model, **kwargs):
     client = make_client(api_key=api_key, async_client=True)
     payload = make_payload(query, image=image, system=system, history=history)
     response = await client.chat.completions.create(model=model, stream=True, **payload, **kwargs)
-    async for chunk in response:
-        yield stream_openai_native(chunk)
+    try:
+        async for chunk in response:
+            yield stream_openai_native(chunk)
+    finally:
+        await response.close()
@@ -5,8 +5,8 @@ import openai
 
 from ..providers import (
     CONFIG as C, PROVIDERS as P,
-    content_openai, convert_history, payload_openai,
-    response_openai_native, stream_openai_native,
+    content_openai, convert_history, payload_openai, cache_payload,
+    response_openai_native, stream_openai_native, usage_openai, record_usage,
     embed_response_openai_native, transcribe_response_openai
 )
 
@@ -14,10 +14,18 @@ from ..providers import (
 ## helper functions
 ##
 
-def make_payload(query, image=None, prediction=None, system=None, history=None):
+def make_payload(query, image=None, prediction=None, system=None, history=None, cache_key=None, cache_prefix=None):
     content = content_openai(query, image=image)
     history = convert_history(history, content_openai)
-    return payload_openai(content, prediction=prediction, system=system, history=history)
+    payload = payload_openai(content, prediction=prediction, system=system, history=history)
+    return cache_payload(payload, 'openai', key=cache_key, prefix=cache_prefix)
+
+def record_chunk(stats, chunk):
+    if stats is not None and chunk.usage is not None:
+        record_usage(stats, usage_openai(chunk.model_dump()))
+
+def stream_options(stats):
+    return {'stream_options': {'include_usage': True}} if stats is not None else {}
 
 ##
 ## common interface
@@ -28,35 +36,47 @@ def make_client(async_client=False, base_url=None, api_key=None):
     client_class = openai.AsyncOpenAI if async_client else openai.OpenAI
     return client_class(api_key=api_key, base_url=base_url)
 
-def reply(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=P.openai.chat_model, max_tokens=None, base_url=None, **kwargs):
+def reply(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=P.openai.chat_model, max_tokens=None, base_url=None, cache_key=None, cache_prefix=None, stats=None, **kwargs):
     client = make_client(base_url=base_url, api_key=api_key)
-    payload = make_payload(query, image=image, prediction=prediction, system=system, history=history)
+    payload = make_payload(query, image=image, prediction=prediction, system=system, history=history, cache_key=cache_key, cache_prefix=cache_prefix)
     response = client.chat.completions.create(model=model, max_completion_tokens=max_tokens, **payload, **kwargs)
+    if stats is not None:
+        record_usage(stats, usage_openai(response.model_dump()))
     return response_openai_native(response)
 
-async def reply_async(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=P.openai.chat_model, max_tokens=None, base_url=None, **kwargs):
+async def reply_async(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=P.openai.chat_model, max_tokens=None, base_url=None, cache_key=None, cache_prefix=None, stats=None, **kwargs):
     client = make_client(async_client=True, base_url=base_url, api_key=api_key)
-    payload = make_payload(query, image=image, prediction=prediction, system=system, history=history)
+    payload = make_payload(query, image=image, prediction=prediction, system=system, history=history, cache_key=cache_key, cache_prefix=cache_prefix)
     response = await client.chat.completions.create(model=model, max_completion_tokens=max_tokens, **payload, **kwargs)
+    if stats is not None:
+        record_usage(stats, usage_openai(response.model_dump()))
     return response_openai_native(response)
 
-def stream(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=P.openai.chat_model, max_tokens=None, base_url=None, **kwargs):
+def stream(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=P.openai.chat_model, max_tokens=None, base_url=None, cache_key=None, cache_prefix=None, stats=None, **kwargs):
     client = make_client(base_url=base_url, api_key=api_key)
-    payload = make_payload(query, image=image, prediction=prediction, system=system, history=history)
-    response = client.chat.completions.create(model=model, stream=True, max_completion_tokens=max_tokens, **payload, **kwargs)
-    for chunk in response:
-        yield stream_openai_native(chunk)
+    payload = make_payload(query, image=image, prediction=prediction, system=system, history=history, cache_key=cache_key, cache_prefix=cache_prefix)
+    response = client.chat.completions.create(model=model, stream=True, max_completion_tokens=max_tokens, **payload, **stream_options(stats), **kwargs)
+    try:
+        for chunk in response:
+            record_chunk(stats, chunk)
+            yield stream_openai_native(chunk)
+    finally:
+        response.close()
 
-async def stream_async(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=P.openai.chat_model, max_tokens=None, base_url=None, **kwargs):
+async def stream_async(query, image=None, history=None, prefill=None, prediction=None, system=C.system, api_key=None, model=P.openai.chat_model, max_tokens=None, base_url=None, cache_key=None, cache_prefix=None, stats=None, **kwargs):
     client = make_client(async_client=True, base_url=base_url, api_key=api_key)
-    payload = make_payload(query, image=image, prediction=prediction, system=system, history=history)
-    response = await client.chat.completions.create(model=model, stream=True, max_completion_tokens=max_tokens, **payload, **kwargs)
-    async for chunk in response:
-        yield stream_openai_native(chunk)
+    payload = make_payload(query, image=image, prediction=prediction, system=system, history=history, cache_key=cache_key, cache_prefix=cache_prefix)
+    response = await client.chat.completions.create(model=model, stream=True, max_completion_tokens=max_tokens, **payload, **stream_options(stats), **kwargs)
+    try:
+        async for chunk in response:
+            record_chunk(stats, chunk)
+            yield stream_openai_native(chunk)
+    finally:
+        await response.close()
 
 def embed(query, model=P.openai.embed_model, api_key=None, base_url=None, **kwargs):
     client = make_client(base_url=base_url, api_key=api_key)
-    response = client.embeddings.create(input=query, model=model, **kwargs)
+    response = client.embeddings.create(input=query, model=model, encoding_format='base64', **kwargs)
     return embed_response_openai_native(response)
 
 def transcribe(audio, model=P.openai.transcribe_model, api_key=None, base_url=None, **kwargs):
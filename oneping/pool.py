@@ -0,0 +1,211 @@
+# managed pool of llama.cpp servers
+
+import os
+import time
+import threading
+import subprocess
+import requests
+from itertools import chain
+
+from .providers import register_backends, unregister_backends
+
+##
+## helpers
+##
+
+def split_cpus(n, cpus=None):
+    if cpus is None:
+        cpus = sorted(os.sched_getaffinity(0))
+    size = max(1, len(cpus) // n)
+    return [cpus[i*size:(i+1)*size] or cpus for i in range(n)]
+
+# options set to None are left out
+def make_args(**kwargs):
+    return chain(*[(f'--{k}', str(v)) for k, v in kwargs.items() if v is not None])
+
+# llama-server flags are hyphenated (slot_save_path -> --slot-save-path)
+def llama_server_command(model, host, port, threads=None, **kwargs):
+    opts = {k.replace('_', '-'): v for k, v in kwargs.items()}
+    args = make_args(model=model, host=host, port=port, threads=threads, **opts)
+    return ['llama-server', *args]
+
+##
+## server process
+##
+
+class ServerProcess:
+    def __init__(self, command, url, cpus=None, ready_path='health'):
+        self.command = [str(x) for x in command]
+        self.url = url
+        self.cpus = cpus
+        self.ready_path = ready_path
+        self.proc = None
+        self.started = None
+        self.failures = 0
+        self.restart_at = None
+
+    def start(self):
+        preexec = (lambda: os.sched_setaffinity(0, self.cpus)) if self.cpus is not None else None
+        self.proc = subprocess.Popen(self.command, preexec_fn=preexec)
+        self.started = time.monotonic()
+        self.restart_at = None
+
+    def stop(self, timeout=10):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def ready(self):
+        if not self.alive():
+            return False
+        try:
+            response = requests.get(f'{self.url}/{self.ready_path}', timeout=1)
+            return response.status_code == 200
+        except requests.RequestException:
+            return False
+
+##
+## supervisor
+##
+
+# launches n servers, registers ready ones as backends for a provider,
+# and restarts crashed ones with exponential backoff
+class LlamaPool:
+    def __init__(
+        self, models, n=None, host='127.0.0.1', base_port=8081, threads=None, affinity=True,
+        command=llama_server_command, provider='llama-cpp', ready_path='health', ready_timeout=300,
+        backoff=1.0, max_backoff=60.0, stable_time=60.0, poll_interval=1.0, **kwargs
+    ):
+        # one model per server
+        models = [models] if type(models) is str else list(models)
+        n = len(models) if n is None else n
+        models = [models[i % len(models)] for i in range(n)]
+
+        # partition cores across servers
+        cpus = split_cpus(n) if affinity else [None] * n
+
+        # make server processes
+        self.servers = []
+        for i, (model, group) in enumerate(zip(models, cpus)):
+            port = base_port + i
+            nthreads = threads if threads is not None else (len(group) if group is not None else None)
+            opts = {'threads': nthreads} if nthreads is not None else {}
+            cmd = command(model, host, port, **opts, **kwargs)
+            url = f'http://{host}:{port}'
+            self.servers.append(ServerProcess(cmd, url, cpus=group, ready_path=ready_path))
+
+        # store options
+        self.provider = provider
+        self.ready_timeout = ready_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_time = stable_time
+        self.poll_interval = poll_interval
+        self.ready = set()
+        self.stopping = threading.Event()
+        self.monitor = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def urls(self):
+        return [s.url for s in self.servers if s.url in self.ready]
+
+    def update_backends(self):
+        register_backends(self.provider, self.urls)
+
+    # servers are stopped if any fails to come up
+    def start(self, wait=True):
+        try:
+            for server in self.servers:
+                server.start()
+            if wait:
+                self.wait_ready()
+        except BaseException:
+            self.stop()
+            raise
+        self.monitor = threading.Thread(target=self.supervise, daemon=True)
+        self.monitor.start()
+
+    # a server that exits before it is ready fails the whole pool right away
+    def wait_ready(self):
+        deadline = time.monotonic() + self.ready_timeout
+        while time.monotonic() < deadline:
+            for server in self.servers:
+                if server.url in self.ready:
+                    continue
+                if not server.alive():
+                    code = server.proc.returncode
+                    raise RuntimeError(f'Server {server.url} exited ({code}) before becoming ready')
+                if server.ready():
+                    self.ready.add(server.url)
+                    self.update_backends()
+            if len(self.ready) == len(self.servers):
+                return
+            time.sleep(0.25)
+        raise TimeoutError(f'Only {len(self.ready)} of {len(self.servers)} servers became ready')
+
+    def stop(self):
+        self.stopping.set()
+        if self.monitor is not None:
+            self.monitor.join()
+        unregister_backends(self.provider)
+        self.ready.clear()
+        for server in self.servers:
+            server.stop()
+
+    def supervise(self):
+        while not self.stopping.wait(self.poll_interval):
+            now = time.monotonic()
+            for server in self.servers:
+                if server.alive():
+                    # register once ready, forgive failures once stable
+                    if server.url not in self.ready and server.ready():
+                        self.ready.add(server.url)
+                        self.update_backends()
+                    if server.failures > 0 and now - server.started > self.stable_time:
+                        server.failures = 0
+                elif server.restart_at is None:
+                    # crashed, take out of rotation and schedule restart
+                    self.ready.discard(server.url)
+                    self.update_backends()
+                    delay = min(self.max_backoff, self.backoff * 2 ** server.failures)
+                    server.failures += 1
+                    server.restart_at = now + delay
+                    print(f'Server {server.url} exited ({server.proc.returncode}), restarting in {delay:.1f}s')
+                elif now >= server.restart_at:
+                    server.start()
+
+    def join(self):
+        try:
+            while not self.stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+def start_llama_pool(models, router=False, router_host='127.0.0.1', router_port=5000, **kwargs):
+    pool = LlamaPool(models, **kwargs)
+    pool.start()
+    if router:
+        from .server import start_router
+        try:
+            start_router(host=router_host, port=router_port)
+        finally:
+            pool.stop()
+    else:
+        pool.join()
@@ -1,8 +1,14 @@
 # default arguments
 
 import os
+import json
+import base64
+import hashlib
 import tomllib
 from pathlib import Path
+from itertools import count
+
+import numpy as np
 
 from .utils import split_image_uri, ensure_image_uri, Config
 
@@ -46,6 +52,14 @@ def content_anthropic(text, image=None):
         { 'type': 'text', 'text': text },
     ]
 
+def content_responses(text, image=None):
+    if image is None:
+        return text
+    return [
+        { 'type': 'input_image', 'image_url': ensure_image_uri(image) },
+        { 'type': 'input_text', 'text': text },
+    ]
+
 def content_oneping(text, image=None):
     if image is None:
         return text
@@ -59,16 +73,59 @@ def convert_content(content, content_func):
     data = { 'text': content } if type(content) is str else content
     return content_func(**data)
 
-def convert_history(history, content_func):
+def convert_message(item, content_func):
+    return {
+        'role': item['role'],
+        'content': convert_content(item['content'], content_func)
+    }
+
+def convert_history(history, content_func, memo=None):
     if history is None:
         return None
-    return [
-        {
-            'role': item['role'],
-            'content': convert_content(item['content'], content_func)
-        }
-        for item in history
-    ]
+    if memo is not None:
+        return memo.convert(history, content_func)
+    return [ convert_message(item, content_func) for item in history ]
+
+# caches converted history messages and their serialized json across turns, keyed
+# by the identity of the history items (which must not be mutated once added)
+# can be shared by chat branches, entries not used by the latest call are dropped
+# once the cache grows well past the history size
+class HistoryCache:
+    def __init__(self):
+        self.entries = {}
+        self.current = []
+        self.calls = 0
+
+    def convert(self, history, content_func):
+        self.calls += 1
+        current = []
+        for item in history:
+            key = (id(item), content_func)
+            entry = self.entries.get(key)
+            if entry is None or entry[0] is not item:
+                entry = self.entries[key] = [item, convert_message(item, content_func), None, 0]
+            entry[3] = self.calls
+            current.append(entry)
+        if len(self.entries) > 2 * len(current) + 64:
+            self.entries = { k: e for k, e in self.entries.items() if e[3] == self.calls }
+        self.current = current
+        return [ entry[1] for entry in current ]
+
+    # same output as json.dumps, splicing in cached fragments for history messages
+    def dumps(self, payload):
+        frags = { id(entry[1]): entry for entry in self.current }
+        def encode(obj):
+            if (entry := frags.get(id(obj))) is not None and entry[1] is obj:
+                if entry[2] is None:
+                    entry[2] = json.dumps(obj)
+                return entry[2]
+            elif type(obj) is dict:
+                return '{' + ', '.join(f'{json.dumps(k)}: {encode(v)}' for k, v in obj.items()) + '}'
+            elif type(obj) is list:
+                return '[' + ', '.join(encode(v) for v in obj) + ']'
+            else:
+                return json.dumps(obj)
+        return encode(payload)
 
 ##
 ## message payloads
@@ -100,6 +157,65 @@ def payload_anthropic(content, system=None, prefill=None, prediction=None, histo
         }]
     return payload
 
+# responses api (openai/xai), history can be None when continuing from previous_response_id
+def payload_responses(content, system=None, prefill=None, prediction=None, history=None):
+    messages = [*history] if history is not None else []
+    messages.append({'role': 'user', 'content': content})
+    payload = {'input': messages, 'store': True}
+    if system is not None:
+        payload['instructions'] = system
+    return payload
+
+##
+## prompt caching
+##
+
+CACHE_CONTROL = {'type': 'ephemeral'}
+
+def cache_block(message):
+    content = message['content']
+    if type(content) is str:
+        content = [{'type': 'text', 'text': content}]
+    *head, last = content
+    return {**message, 'content': [*head, {**last, 'cache_control': CACHE_CONTROL}]}
+
+# put breakpoints on the most recent user turns (the system prompt uses one)
+# so the growing history prefix is read from cache on the next turn, plus one at
+# the end of a prefix shared with other branches (message index) if given
+def cache_anthropic(payload, key=None, breakpoints=4, prefix=None):
+    messages = payload['messages']
+    if 'system' in payload:
+        breakpoints -= 1
+    marks = set()
+    if prefix is not None and 0 <= prefix < len(messages):
+        marks.add(prefix)
+    users = [i for i, msg in enumerate(messages) if msg['role'] == 'user']
+    for i in users[::-1]:
+        if len(marks) >= breakpoints:
+            break
+        marks.add(i)
+    for i in marks:
+        messages[i] = cache_block(messages[i])
+    return payload
+
+# text parts only, so large images aren't rehashed every turn
+def message_text(message):
+    content = message['content']
+    if type(content) is str:
+        return content
+    return [ part.get('text') for part in content ]
+
+# route requests sharing a prefix to the same cache, defaults to a
+# hash of the system prompt and first user message (stable over a conversation)
+def cache_openai(payload, key=None, breakpoints=None, prefix=None):
+    if key is None:
+        messages = payload['messages']
+        first = next((i for i, msg in enumerate(messages) if msg['role'] == 'user'), 0)
+        prefix = [ (msg['role'], message_text(msg)) for msg in messages[:first+1] ]
+        key = hashlib.sha256(json.dumps(prefix).encode('utf-8')).hexdigest()[:32]
+    payload['prompt_cache_key'] = key
+    return payload
+
 def payload_oneping(content, system=None, prefill=None, prediction=None, history=None):
     content = { 'text': content } if type(content) is str else content
     return {
@@ -126,17 +242,29 @@ def response_anthropic(reply):
     content = reply['content'][0]
     return content['text']
 
+def response_responses(reply):
+    return ''.join(
+        part['text'] for item in reply['output'] if item['type'] == 'message'
+        for part in item['content'] if part['type'] == 'output_text'
+    )
+
 ##
 ## stream handlers
 ##
 
 def stream_openai(chunk):
-    return chunk['choices'][0]['delta'].get('content', '')
+    if len(choices := chunk['choices']) == 0:
+        return None # final usage chunk
+    return choices[0]['delta'].get('content', '')
 
 def stream_anthropic(chunk):
     if chunk['type'] == 'content_block_delta':
         return chunk['delta']['text']
 
+def stream_responses(chunk):
+    if chunk['type'] == 'response.output_text.delta':
+        return chunk['delta']
+
 def stream_oneping(chunk):
     return chunk
 
@@ -151,6 +279,8 @@ def response_anthropic_native(reply):
     return reply.content[0].text
 
 def stream_openai_native(chunk):
+    if len(chunk.choices) == 0:
+        return ''
     text = chunk.choices[0].delta.content
     if text is not None:
         return text
@@ -163,29 +293,122 @@ def stream_anthropic_native(chunk):
     else:
         return ''
 
+##
+## usage handlers
+##
+
+def usage_openai(reply):
+    if (usage := reply.get('usage')) is None:
+        return None
+    details = usage.get('prompt_tokens_details') or {}
+    return {
+        'input_tokens': usage.get('prompt_tokens'),
+        'output_tokens': usage.get('completion_tokens'),
+        'cache_read_tokens': details.get('cached_tokens') or 0,
+        'cache_write_tokens': 0,
+    }
+
+# input tokens include cached ones, as with the other providers
+def usage_anthropic(reply):
+    if (usage := reply.get('usage')) is None:
+        return None
+    cache_read = usage.get('cache_read_input_tokens') or 0
+    cache_write = usage.get('cache_creation_input_tokens') or 0
+    return {
+        'input_tokens': (usage.get('input_tokens') or 0) + cache_read + cache_write,
+        'output_tokens': usage.get('output_tokens'),
+        'cache_read_tokens': cache_read,
+        'cache_write_tokens': cache_write,
+    }
+
+# also reports the stored response id for continuing the conversation
+def usage_responses(reply):
+    usage = reply.get('usage') or {}
+    details = usage.get('input_tokens_details') or {}
+    return {
+        'response_id': reply.get('id'),
+        'input_tokens': usage.get('input_tokens'),
+        'output_tokens': usage.get('output_tokens'),
+        'cache_read_tokens': details.get('cached_tokens') or 0,
+        'cache_write_tokens': 0,
+    }
+
+# fill in stats with token counts (including prompt cache reads/writes)
+def record_usage(stats, usage):
+    if stats is not None and usage is not None:
+        stats.update(usage)
+
+def stream_usage_openai(chunk):
+    return usage_openai(chunk)
+
+def stream_usage_responses(chunk):
+    if chunk['type'] == 'response.completed':
+        return usage_responses(chunk['response'])
+
+def stream_usage_anthropic(chunk):
+    if chunk['type'] == 'message_start':
+        return usage_anthropic(chunk['message'])
+    elif chunk['type'] == 'message_delta':
+        return {'output_tokens': chunk['usage']['output_tokens']}
+
 ##
 ## embedding handlers
 ##
 
+# embeddings come back as float32 matrices, one row per text
+# base64 rows are decoded straight into place without going through floats
+def decode_embedding(value):
+    if type(value) is str:
+        return np.frombuffer(base64.b64decode(value), dtype='<f4')
+    return value
+
+def stack_embeddings(rows):
+    if len(rows) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    rows = [decode_embedding(r) for r in rows]
+    out = np.empty((len(rows), len(rows[0])), dtype=np.float32)
+    for i, row in enumerate(rows):
+        out[i] = row
+    return out
+
+# whole matrix as one base64 blob, used by the router
+def encode_matrix(vecs):
+    vecs = np.ascontiguousarray(vecs, dtype='<f4')
+    return {'data': base64.b64encode(vecs.tobytes()).decode(), 'shape': list(vecs.shape)}
+
+def decode_matrix(reply):
+    data = np.frombuffer(bytearray(base64.b64decode(reply['data'])), dtype='<f4')
+    return data.reshape(reply['shape'])
+
 def embed_payload_openai(text):
     return {'input': text}
 
 def embed_response_openai(reply):
-    return [
-        item['embedding'] for item in reply['data']
-    ]
+    items = sorted(reply['data'], key=lambda item: item['index'])
+    return stack_embeddings([item['embedding'] for item in items])
 
 def embed_response_openai_native(reply):
-    return [
-        item.embedding for item in reply.data
-    ]
+    items = sorted(reply.data, key=lambda item: item.index)
+    return stack_embeddings([item.embedding for item in items])
 
 def embed_payload_tei(text):
     return {'inputs': text}
 
 def embed_response_tei(reply):
+    return np.asarray(reply, dtype=np.float32)
+
+def embed_payload_oneping(text):
+    return {'text': text}
+
+# router failures come back as {'success': False, 'data': message}
+def check_oneping(reply):
+    if not reply.get('success', True):
+        raise Exception(f'Router error: {reply.get("data")}')
     return reply
 
+def embed_response_oneping(reply):
+    return decode_matrix(check_oneping(reply))
+
 ##
 ## tokenize handlers
 ##
@@ -210,6 +433,12 @@ def tokenize_payload_vllm(text):
 def tokenize_response_vllm(reply):
     return reply['tokens']
 
+def tokenize_payload_oneping(text):
+    return {'text': text}
+
+def tokenize_response_oneping(reply):
+    return check_oneping(reply)['data']
+
 ##
 ## transcribe handlers
 ##
@@ -229,40 +458,65 @@ HANDLERS = {
     'content': {
         'openai': content_openai,
         'anthropic': content_anthropic,
+        'responses': content_responses,
         'oneping': content_oneping,
     },
     'payload': {
         'openai': payload_openai,
         'anthropic': payload_anthropic,
+        'responses': payload_responses,
         'oneping': payload_oneping,
     },
+    'cache': {
+        'openai': cache_openai,
+        'anthropic': cache_anthropic,
+        'none': None,
+    },
     'response': {
         'openai': response_openai,
         'anthropic': response_anthropic,
+        'responses': response_responses,
         'oneping': response_oneping,
     },
     'stream': {
         'openai': stream_openai,
         'anthropic': stream_anthropic,
+        'responses': stream_responses,
         'oneping': stream_oneping,
     },
+    'usage': {
+        'openai': usage_openai,
+        'anthropic': usage_anthropic,
+        'responses': usage_responses,
+        'none': None,
+    },
+    'stream_usage': {
+        'openai': stream_usage_openai,
+        'anthropic': stream_usage_anthropic,
+        'responses': stream_usage_responses,
+        'none': None,
+    },
     'embed_payload': {
         'openai': embed_payload_openai,
         'tei': embed_payload_tei,
+        'oneping': embed_payload_oneping,
     },
     'embed_response': {
         'openai': embed_response_openai,
         'tei': embed_response_tei,
+        'oneping': embed_response_oneping,
     },
     'tokenize_payload': {
         'llama-cpp': tokenize_payload_llamacpp,
         'tei': tokenize_payload_tei,
         'vllm': tokenize_payload_vllm,
+        'oneping': tokenize_payload_oneping,
     },
     'tokenize_response': {
         'llama-cpp': tokenize_response_llamacpp,
         'tei': tokenize_response_tei,
         'vllm': tokenize_response_vllm,
+        'oneping': tokenize_response_oneping,
     },
 }
 
@@ -304,11 +558,36 @@ def reload():
     })
 reload()
 
+##
+## backend pools
+##
+
+# ready base urls for providers served by a pool of local servers
+BACKENDS = {}
+COUNTER = count()
+
+def register_backends(provider, urls):
+    BACKENDS[provider] = list(urls)
+
+def unregister_backends(provider):
+    BACKENDS.pop(provider, None)
+
+# round robin over registered backends
+def select_backend(provider):
+    if len(urls := BACKENDS.get(provider, [])) > 0:
+        return urls[next(COUNTER) % len(urls)]
+
+##
+## provider lookup
+##
+
 def get_provider(provider, **kwargs):
     # get full provider args
     if provider is None:
         provider = {}
     elif type(provider) is str:
+        if (base_url := select_backend(provider)) is not None:
+            kwargs = {'base_url': base_url, **kwargs}
         provider = PROVIDERS[provider]
     provider = {**PROVIDERS.default, **provider, **kwargs}
 
@@ -321,3 +600,16 @@ def get_provider(provider, **kwargs):
 
     # return realized provider args
     return Config(provider)
+
+# configured provider args, without picking one of its pooled backends
+def provider_config(provider):
+    if type(provider) is str:
+        provider = PROVIDERS[provider]
+    return get_provider(provider)
+
+# apply a provider's prompt cache hints (used by native clients)
+def cache_payload(payload, provider, key=None, prefix=None):
+    prov = get_provider(provider)
+    if (cache_func := prov.cache) is None:
+        return payload
+    return cache_func(payload, key=key, breakpoints=prov.cache_breakpoints, prefix=prefix)
@@ -1,10 +1,22 @@
 # llm servers
 
+import os
 import json
+import asyncio
+import hashlib
+import tempfile
 import subprocess
 from itertools import chain
+from contextlib import aclosing
 
-from .api import reply as reply_api, stream as stream_api
+from .state import SharedState
+from .utils import content_encodings, choose_encoding, encode_body, decode_body
+from .metrics import RouterMetrics, has_metrics
+from .providers import get_provider, encode_matrix
+from .api import (
+    reply as reply_api, stream_async as stream_async_api,
+    embed as embed_api, tokenize as tokenize_api
+)
 
 DEFAULT_ALLOW_ORIGINS = [
     'http://localhost',
@@ -30,17 +42,192 @@ def patch_payload(data):
     # return patched payload
     return data
 
-def generate_sse(stream):
-    for chunk in stream:
-        data = json.dumps(chunk)
-        yield f'data: {data}\n\n'
+##
+## micro-batching
+##
+
+# collects concurrent requests for the same upstream into one call
+# requests are grouped by key and flushed at max_batch items or after max_wait seconds
+class MicroBatcher:
+    def __init__(self, func, max_batch=64, max_wait=0.005, observe=None):
+        self.func = func
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.observe = observe
+        self.pending = {}
+        self.timers = {}
+        self.tasks = set() # strong refs so running batches aren't collected
+
+    def depth(self):
+        return sum(len(i) for batch in self.pending.values() for i, _ in batch)
+
+    async def submit(self, key, items):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        # add to pending batch for this key
+        pending = self.pending.setdefault(key, [])
+        pending.append((items, future))
+        if self.observe is not None:
+            self.observe(self.depth())
+
+        # flush if full, otherwise make sure a timer is running
+        if sum(len(i) for i, _ in pending) >= self.max_batch:
+            self.flush(key)
+        elif key not in self.timers:
+            self.timers[key] = loop.call_later(self.max_wait, self.flush, key)
+
+        # wait for our slice of the results
+        return await future
+
+    def flush(self, key):
+        if (timer := self.timers.pop(key, None)) is not None:
+            timer.cancel()
+        if (batch := self.pending.pop(key, None)) is not None:
+            task = asyncio.create_task(self.execute(key, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        if self.observe is not None:
+            self.observe(self.depth())
+
+    async def execute(self, key, batch):
+        # run one upstream request for the whole batch
+        items = [x for i, _ in batch for x in i]
+        try:
+            results = await asyncio.to_thread(self.func, items, **dict(key))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # scatter results back to waiting requests
+        pos = 0
+        for i, future in batch:
+            if not future.done():
+                future.set_result(results[pos:pos+len(i)])
+            pos += len(i)
+
+def batch_key(data):
+    return tuple(sorted(data.items()))
+
+# tokenize_batch is the number of texts per request for providers that take lists
+def tokenize_batch(texts, **kwargs):
+    prov = get_provider(kwargs.get('provider'))
+    if prov.tokenize_batch:
+        size = prov.tokenize_batch if type(prov.tokenize_batch) is int else len(texts)
+        return [t for i in range(0, len(texts), size) for t in tokenize_api(texts[i:i+size], **kwargs)]
+    else:
+        return [tokenize_api(t, **kwargs) for t in texts]
+
+##
+## compression
+##
+
+# asgi middleware that decodes compressed request bodies and
+# compresses non-streaming responses at or above minimum_size bytes
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=4096):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in scope['headers']}
+
+        # decode request body
+        if (encoding := headers.get('content-encoding')) is not None:
+            chunks, more = [], True
+            while more:
+                message = await receive()
+                chunks.append(message.get('body', b''))
+                more = message.get('more_body', False)
+            try:
+                body = decode_body(b''.join(chunks), encoding)
+            except Exception:
+                await self.reject(send)
+                return
+            receive = self.replay(body, receive)
+            scope = {**scope, 'headers': [
+                (k, v) for k, v in scope['headers'] if k not in (b'content-encoding', b'content-length')
+            ] + [(b'content-length', str(len(body)).encode('latin-1'))]}
+
+        # compress response body if it arrives in one piece
+        accept = choose_encoding(headers.get('accept-encoding', ''))
+        start = None
+        async def send_compressed(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if message['type'] == 'http.response.body' and start is not None:
+                body = message.get('body', b'')
+                resp_headers = {k.lower(): v for k, v in start['headers']}
+                streaming = message.get('more_body', False) or b'content-encoding' in resp_headers
+                if accept is not None and not streaming and len(body) >= self.minimum_size:
+                    body = encode_body(body, accept)
+                    start['headers'] = [
+                        (k, v) for k, v in start['headers'] if k.lower() != b'content-length'
+                    ] + [
+                        (b'content-length', str(len(body)).encode('latin-1')),
+                        (b'content-encoding', accept.encode('latin-1')),
+                        (b'vary', b'Accept-Encoding'),
+                    ]
+                    message = {**message, 'body': body}
+                start['headers'].append(
+                    (b'accept-encoding', ', '.join(content_encodings()).encode('latin-1'))
+                )
+                await send(start)
+                start = None
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+    # serve the decoded body once, then pass through (for disconnects)
+    @staticmethod
+    def replay(body, receive):
+        sent = False
+        async def replay_receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            return await receive()
+        return replay_receive
+
+    @staticmethod
+    async def reject(send):
+        await send({
+            'type': 'http.response.start', 'status': 415,
+            'headers': [(b'accept-encoding', ', '.join(content_encodings()).encode('latin-1'))],
+        })
+        await send({'type': 'http.response.body', 'body': b'Unsupported content encoding'})
+
+##
+## router
+##
+
+# when the client disconnects the response task is cancelled mid-await
+# or this is closed, either of which closes the upstream request
+async def generate_sse(stream):
+    async with aclosing(stream):
+        async for chunk in stream:
+            data = json.dumps(chunk)
+            yield f'data: {data}\n\n'
     yield 'data: [DONE]\n\n'
 
-def start_router(host='127.0.0.1', port=5000, allow_origins=DEFAULT_ALLOW_ORIGINS, **kwargs):
-    import uvicorn
-    from fastapi import FastAPI, status
+def request_hash(data):
+    text = json.dumps(data, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def make_router(
+    allow_origins=DEFAULT_ALLOW_ORIGINS, max_batch=64, max_wait=0.005, compress_min=4096, websocket=True, state=':memory:',
+    cache_ttl=None, rate_limit=None, breaker_threshold=None, breaker_cooldown=30, **kwargs
+):
+    from fastapi import FastAPI, WebSocket, WebSocketDisconnect, status
     from fastapi.middleware.cors import CORSMiddleware
-    from fastapi.responses import JSONResponse, StreamingResponse
+    from fastapi.responses import Response, JSONResponse, StreamingResponse
     from fastapi.exceptions import RequestValidationError
     from fastapi.requests import Request
     from pydantic import BaseModel
@@ -68,16 +255,39 @@ def start_router(host='127.0.0.1', port=5000, allow_origins=DEFAULT_ALLOW_ORIGIN
         max_tokens: int | None = None
         history: list[HistoryItem] | None = None
 
+    class TextRequest(BaseModel):
+        text: str | list[str]
+        native: bool | None = None
+        provider: str | None = None
+        model: str | None = None
+
     ## main interface
 
     # make app
     app = FastAPI()
 
+    # state shared across workers
+    shared = SharedState(state)
+
+    # prometheus metrics
+    metrics = RouterMetrics()
+
+    # batch embed/tokenize requests
+    embed_batcher = MicroBatcher(
+        embed_api, max_batch=max_batch, max_wait=max_wait,
+        observe=lambda n: metrics.queue_depth('embed', n)
+    )
+    tokenize_batcher = MicroBatcher(
+        tokenize_batch, max_batch=max_batch, max_wait=max_wait,
+        observe=lambda n: metrics.queue_depth('tokenize', n)
+    )
+
     # print out errors
     @app.exception_handler(RequestValidationError)
     async def validation_exception_handler(request: Request, exc: RequestValidationError):
         print(request)
         print(exc)
+        metrics.error(request.url.path.strip('/'), 'invalid', 'invalid')
         content = {'status_code': 10422, 'message': str(exc), 'data': None}
         return JSONResponse(content=content, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
@@ -91,21 +301,210 @@ def start_router(host='127.0.0.1', port=5000, allow_origins=DEFAULT_ALLOW_ORIGIN
             allow_headers=['*'],
         )
 
+    # check rate limits and circuit breakers, returns an error and status code
+    # state calls run in threads since sqlite may wait on other workers' locks
+    async def check_upstream(upstream):
+        if rate_limit is not None and not await asyncio.to_thread(shared.rate_limit, upstream, rate_limit):
+            return f'Rate limit exceeded for {upstream}', status.HTTP_429_TOO_MANY_REQUESTS
+        if breaker_threshold is not None and not await asyncio.to_thread(shared.breaker_allow, upstream, cooldown=breaker_cooldown):
+            return f'Circuit open for {upstream}', status.HTTP_503_SERVICE_UNAVAILABLE
+
+    async def record_upstream(upstream, success):
+        if breaker_threshold is not None:
+            await asyncio.to_thread(shared.breaker_record, upstream, success, threshold=breaker_threshold)
+
+    # record stream outcomes too, client disconnects count as neither
+    async def record_stream(stream, upstream):
+        async with aclosing(stream):
+            try:
+                async for chunk in stream:
+                    yield chunk
+            except Exception:
+                await record_upstream(upstream, False)
+                raise
+        await record_upstream(upstream, True)
+
+    # get provider and model labels for a request
+    def upstream_labels(patch):
+        provider = patch.get('provider', kwargs.get('provider', 'default'))
+        model = patch.get('model', kwargs.get('model', 'default'))
+        return provider, model
+
+    # non-streaming chat reply, returns response body
+    async def chat_reply(patch, upstream, model):
+        # check response cache
+        if cache_ttl is not None:
+            cache_key = request_hash({**kwargs, **patch})
+            cached = await asyncio.to_thread(shared.cache_get, cache_key)
+            metrics.cache_lookup('chat', cached is not None)
+            if cached is not None:
+                return {'success': True, 'data': json.loads(cached)}
+
+        # make upstream request
+        try:
+            with metrics.track('chat', upstream, model):
+                reply = await asyncio.to_thread(reply_api, **kwargs, **patch)
+        except Exception as e:
+            await record_upstream(upstream, False)
+            return {'success': False, 'data': str(e)}
+        await record_upstream(upstream, True)
+
+        # store in response cache
+        if cache_ttl is not None:
+            await asyncio.to_thread(shared.cache_set, cache_key, json.dumps(reply), cache_ttl)
+
+        return {'success': True, 'data': reply}
+
+    # batched text requests (one result per input text), returns response body
+    async def batch_reply(batcher, endpoint, patch, upstream, model):
+        text = patch.pop('text')
+        texts = [text] if type(text) is str else text
+        try:
+            with metrics.track(endpoint, upstream, model):
+                result = await batcher.submit(batch_key({**kwargs, **patch}), texts)
+        except Exception as e:
+            await record_upstream(upstream, False)
+            return {'success': False, 'data': str(e)}
+        await record_upstream(upstream, True)
+        if endpoint == 'embed':
+            return {'success': True, **encode_matrix(result)}
+        return {'success': True, 'data': result}
+
+    # compressed bodies
+    if compress_min is not None:
+        app.add_middleware(CompressionMiddleware, minimum_size=compress_min)
+
     # chat endpoint
     @app.post('/chat')
     async def chat(genreq: GenerateRequest):
         data = genreq.model_dump(exclude_none=True)
         patch = patch_payload(data)
+        upstream, model = upstream_labels(patch)
+        if (error := await check_upstream(upstream)) is not None:
+            metrics.error('chat', upstream, model)
+            message, code = error
+            return JSONResponse({'success': False, 'data': message}, status_code=code)
         if patch.pop('stream', False):
-            stream = stream_api(**kwargs, **patch)
-            sse = generate_sse(stream)
+            stream = record_stream(stream_async_api(**kwargs, **patch), upstream)
+            tracked = metrics.track_stream_async(stream, 'chat', upstream, model)
+            sse = generate_sse(tracked)
             return StreamingResponse(sse, media_type='text/event-stream')
         else:
+            result = await chat_reply(patch, upstream, model)
+            return JSONResponse(result)
+
+    # batched text endpoints
+    async def batched(batcher, endpoint, textreq):
+        data = textreq.model_dump(exclude_none=True)
+        patch = patch_payload(data)
+        upstream, model = upstream_labels(patch)
+        if (error := await check_upstream(upstream)) is not None:
+            metrics.error(endpoint, upstream, model)
+            message, code = error
+            return JSONResponse({'success': False, 'data': message}, status_code=code)
+        result = await batch_reply(batcher, endpoint, patch, upstream, model)
+        return JSONResponse(result)
+
+    # embed endpoint
+    @app.post('/embed')
+    async def embed(textreq: TextRequest):
+        return await batched(embed_batcher, 'embed', textreq)
+
+    # tokenize endpoint
+    @app.post('/tokenize')
+    async def tokenize(textreq: TextRequest):
+        return await batched(tokenize_batcher, 'tokenize', textreq)
+
+    # multiplexed websocket endpoint
+    # client sends {id, type, data} with type in chat/embed/tokenize/cancel
+    # server sends {id, type, data} with type in chunk/done/result/error
+    if websocket:
+        @app.websocket('/ws')
+        async def socket(ws: WebSocket):
+            await ws.accept()
+            tasks = {}
+            lock = asyncio.Lock()
+
+            async def send(rid, kind, data=None):
+                async with lock:
+                    await ws.send_json({'id': rid, 'type': kind, 'data': data})
+
+            async def handle(rid, kind, data):
+                try:
+                    # validate and route request
+                    model_class = GenerateRequest if kind == 'chat' else TextRequest
+                    req = model_class.model_validate(data)
+                    patch = patch_payload(req.model_dump(exclude_none=True))
+                    upstream, model = upstream_labels(patch)
+                    if (error := await check_upstream(upstream)) is not None:
+                        metrics.error(kind, upstream, model)
+                        await send(rid, 'error', error[0])
+                    elif kind == 'chat' and patch.pop('stream', False):
+                        stream = record_stream(stream_async_api(**kwargs, **patch), upstream)
+                        tracked = metrics.track_stream_async(stream, 'chat', upstream, model)
+                        async with aclosing(tracked):
+                            async for chunk in tracked:
+                                await send(rid, 'chunk', chunk)
+                        await send(rid, 'done')
+                    elif kind == 'chat':
+                        await send(rid, 'result', await chat_reply(patch, upstream, model))
+                    else:
+                        batcher = embed_batcher if kind == 'embed' else tokenize_batcher
+                        await send(rid, 'result', await batch_reply(batcher, kind, patch, upstream, model))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    await send(rid, 'error', str(e))
+                finally:
+                    tasks.pop(rid, None)
+
             try:
-                reply = reply_api(**kwargs, **patch)
-                return JSONResponse({'success': True, 'data': reply})
-            except Exception as e:
-                return JSONResponse({'success': False, 'data': str(e)})
+                while True:
+                    message = await ws.receive_json()
+                    rid, kind = message.get('id'), message.get('type')
+                    if kind == 'cancel':
+                        if (task := tasks.get(rid)) is not None:
+                            task.cancel()
+                    elif kind in ('chat', 'embed', 'tokenize'):
+                        tasks[rid] = asyncio.create_task(handle(rid, kind, message.get('data', {})))
+                    else:
+                        await send(rid, 'error', f'Unknown request type: {kind}')
+            except WebSocketDisconnect:
+                pass
+            finally:
+                for task in list(tasks.values()):
+                    task.cancel()
+
+    # metrics endpoint
+    if metrics.enabled:
+        @app.get('/metrics')
+        async def get_metrics():
+            content, media_type = metrics.render()
+            return Response(content=content, media_type=media_type)
+
+    # return app
+    return app
+
+# app factory for worker processes, reads options from the environment
+def router_factory():
+    options = json.loads(os.environ.get('ONEPING_ROUTER', '{}'))
+    return make_router(**options)
+
+def start_router(host='127.0.0.1', port=5000, workers=1, state=None, **kwargs):
+    import uvicorn
+
+    # single process state can live in memory
+    if workers == 1:
+        app = make_router(state=':memory:' if state is None else state, **kwargs)
+        uvicorn.run(app, host=host, port=port)
+        return
+
+    # multiple workers share an on-disk state file
+    if state is None:
+        state = os.path.join(tempfile.mkdtemp(prefix='oneping-'), 'state.db')
 
-    # start server
-    uvicorn.run(app, host=host, port=port)
+    # workers write metrics to a shared directory
+    if has_metrics() and 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='oneping-metrics-')
+    os.environ['ONEPING_ROUTER'] = json.dumps({'state': state, **kwargs})
+    uvicorn.run('oneping.server:router_factory', factory=True, host=host, port=port, workers=workers)
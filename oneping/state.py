@@ -0,0 +1,123 @@
+# shared router state
+
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+##
+## schema
+##
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY, value TEXT, expires REAL
+);
+CREATE TABLE IF NOT EXISTS limits (
+    key TEXT PRIMARY KEY, window REAL, count INTEGER
+);
+CREATE TABLE IF NOT EXISTS breakers (
+    key TEXT PRIMARY KEY, failures INTEGER, opened REAL
+);
+"""
+
+##
+## state store
+##
+
+# sqlite backed state that can be shared by router workers on one machine
+# use path=':memory:' for a single process or a file path for multiple workers
+class SharedState:
+    def __init__(self, path=':memory:', timeout=5.0):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.executescript(SCHEMA)
+
+    @contextmanager
+    def transact(self):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    ## response cache
+
+    def cache_get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value, expires FROM cache WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        return value if expires > time.time() else None
+
+    def cache_set(self, key, value, ttl):
+        now = time.time()
+        with self.transact() as conn:
+            conn.execute('DELETE FROM cache WHERE expires < ?', (now,))
+            conn.execute(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (key, value, now + ttl)
+            )
+
+    ## rate limits
+
+    # fixed window counter, returns False if the limit is exhausted
+    def rate_limit(self, key, limit, period=60):
+        window = time.time() // period * period
+        with self.transact() as conn:
+            row = conn.execute(
+                'SELECT window, count FROM limits WHERE key = ?', (key,)
+            ).fetchone()
+            count = row[1] if row is not None and row[0] == window else 0
+            if count >= limit:
+                return False
+            conn.execute(
+                'INSERT OR REPLACE INTO limits VALUES (?, ?, ?)', (key, window, count + 1)
+            )
+        return True
+
+    ## circuit breakers
+
+    # closed breakers allow requests, open ones allow a single trial after cooldown
+    # the trial restarts the cooldown, so concurrent requests keep failing fast
+    # until it succeeds (closing the breaker) or another cooldown passes
+    def breaker_allow(self, key, cooldown=30):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT opened FROM breakers WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return True
+        if time.time() - row[0] < cooldown:
+            return False
+
+        # claim the trial, re-checking under the write lock
+        with self.transact() as conn:
+            now = time.time()
+            claimed = conn.execute(
+                'UPDATE breakers SET opened = ? WHERE key = ? AND opened IS NOT NULL AND opened <= ?',
+                (now, key, now - cooldown)
+            ).rowcount
+        return claimed > 0
+
+    def breaker_record(self, key, success, threshold=5):
+        with self.transact() as conn:
+            if success:
+                conn.execute('DELETE FROM breakers WHERE key = ?', (key,))
+                return
+            row = conn.execute(
+                'SELECT failures FROM breakers WHERE key = ?', (key,)
+            ).fetchone()
+            failures = (row[0] if row is not None else 0) + 1
+            opened = time.time() if failures >= threshold else None
+            conn.execute(
+                'INSERT OR REPLACE INTO breakers VALUES (?, ?, ?)', (key, failures, opened)
+            )
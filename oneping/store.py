@@ -0,0 +1,213 @@
+# persistent conversation store
+
+import os
+import json
+import time
+import atexit
+import threading
+
+##
+## helpers
+##
+
+def read_jsonl(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as fid:
+        for line in fid:
+            # skip a torn final line from a crash
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                pass
+
+# open for appending, first dropping a torn final line left by a crash
+# so the next record doesn't get glued onto it
+def open_append(path, block=4096):
+    if os.path.exists(path):
+        with open(path, 'rb+') as fid:
+            end = size = fid.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(0, end - block)
+                fid.seek(start)
+                if (pos := fid.read(end - start).rfind(b'\n')) >= 0:
+                    end = start + pos + 1
+                    break
+                end = start
+            if end < size:
+                fid.truncate(end)
+    return open(path, 'a')
+
+def make_title(messages, length=60):
+    for msg in messages:
+        if msg['role'] == 'user':
+            content = msg['content']
+            text = content if type(content) is str else content.get('text', '')
+            text = ' '.join(text.split())
+            return text if len(text) <= length else text[:length-3] + '...'
+
+##
+## conversation store
+##
+
+# append-only message log per conversation plus an append-only index of
+# titles, timestamps and sizes (latest record wins, compacted when stale)
+# listing reads only the index, messages are loaded on demand
+#
+# layout:
+#   {root}/index.jsonl
+#   {root}/convos/{convo_id}.jsonl
+#
+# log records carry the history depth they were written at, so a rewound or
+# branched conversation just overwrites its tail when loaded
+class ConvoStore:
+    def __init__(self, root, sync_interval=1.0, max_open=64):
+        self.root = root = os.path.expanduser(root)
+        self.sync_interval = sync_interval
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.files = {}
+        self.dirty = set()
+
+        # load index
+        os.makedirs(os.path.join(root, 'convos'), exist_ok=True)
+        self.index_path = os.path.join(root, 'index.jsonl')
+        self.index = {}
+        lines = 0
+        for rec in read_jsonl(self.index_path):
+            self.index[rec['id']] = rec
+            lines += 1
+        if lines > 2 * len(self.index) + 64:
+            self.compact()
+        self.index_file = open_append(self.index_path)
+
+        # background fsync
+        self.closed = threading.Event()
+        self.syncer = threading.Thread(target=self.sync_loop, daemon=True)
+        self.syncer.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, convo_id):
+        return convo_id in self.index
+
+    def log_path(self, convo_id):
+        return os.path.join(self.root, 'convos', f'{convo_id}.jsonl')
+
+    ## index
+
+    # rewrite index with only the latest records
+    def compact(self):
+        temp = f'{self.index_path}.tmp'
+        with open(temp, 'w') as fid:
+            for rec in self.index.values():
+                fid.write(json.dumps(rec) + '\n')
+            fid.flush()
+            os.fsync(fid.fileno())
+        os.replace(temp, self.index_path)
+
+    # most recently updated first
+    def list(self):
+        return sorted(self.index.values(), key=lambda rec: rec['updated'], reverse=True)
+
+    def info(self, convo_id):
+        return self.index.get(convo_id)
+
+    ## logs
+
+    def open_log(self, convo_id):
+        if (fid := self.files.pop(convo_id, None)) is None:
+            if len(self.files) >= self.max_open:
+                old_id = next(iter(self.files))
+                old = self.files.pop(old_id)
+                self.sync_file(old)
+                old.close()
+                self.dirty.discard(old_id)
+            fid = open_append(self.log_path(convo_id))
+        self.files[convo_id] = fid # keep most recent last
+        return fid
+
+    # write messages at history positions start, start+1, ... (buffered until the next sync)
+    def append(self, convo_id, messages, start=0, system=None, title=None):
+        now = time.time()
+        with self.lock:
+            fid = self.open_log(convo_id)
+            rec = self.index.get(convo_id)
+            if rec is None:
+                fid.write(json.dumps({'system': system}) + '\n')
+                rec = {'id': convo_id, 'title': None, 'created': now, 'size': 0}
+            for i, msg in enumerate(messages):
+                fid.write(json.dumps({'depth': start + i, **msg}) + '\n')
+            rec = {
+                **rec, 'updated': now, 'size': start + len(messages),
+                'title': title or rec['title'] or make_title(messages),
+            }
+            self.index[convo_id] = rec
+            self.index_file.write(json.dumps(rec) + '\n')
+            self.dirty.update([convo_id, None])
+
+    def load(self, convo_id):
+        # writes are buffered until the next sync
+        with self.lock:
+            if (fid := self.files.get(convo_id)) is not None:
+                fid.flush()
+        system, messages = None, []
+        for rec in read_jsonl(self.log_path(convo_id)):
+            if 'depth' not in rec:
+                system = rec.get('system')
+                continue
+            depth = rec.pop('depth')
+            del messages[depth:]
+            messages.append(rec)
+        return {**self.index.get(convo_id, {}), 'system': system, 'messages': messages}
+
+    def delete(self, convo_id):
+        with self.lock:
+            if (fid := self.files.pop(convo_id, None)) is not None:
+                fid.close()
+            self.dirty.discard(convo_id)
+            self.index.pop(convo_id, None)
+            if os.path.exists(path := self.log_path(convo_id)):
+                os.remove(path)
+            self.compact()
+            self.index_file.close()
+            self.index_file = open_append(self.index_path)
+
+    ## durability
+
+    @staticmethod
+    def sync_file(fid):
+        fid.flush()
+        os.fsync(fid.fileno())
+
+    # fsync everything written since the last sync in one pass
+    def sync(self):
+        with self.lock:
+            for convo_id in self.dirty:
+                fid = self.index_file if convo_id is None else self.files.get(convo_id)
+                if fid is not None:
+                    self.sync_file(fid)
+            self.dirty.clear()
+
+    def sync_loop(self):
+        while not self.closed.wait(self.sync_interval):
+            self.sync()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.sync()
+        with self.lock:
+            for fid in self.files.values():
+                fid.close()
+            self.files.clear()
+            self.index_file.close()
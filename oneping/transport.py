@@ -0,0 +1,124 @@
+# multiplexed websocket transport to the router
+
+import os
+import json
+import asyncio
+import aiohttp
+
+##
+## router socket
+##
+
+# one long-lived connection per url and event loop, shared by concurrent requests
+class RouterSocket:
+    def __init__(self, url, headers=None):
+        self.url = url
+        self.headers = headers
+        self.session = None
+        self.ws = None
+        self.reader = None
+        self.queues = {}
+        self.lock = asyncio.Lock()
+
+    @property
+    def connected(self):
+        return self.ws is not None and not self.ws.closed
+
+    async def connect(self):
+        async with self.lock:
+            if self.connected:
+                return
+            if self.session is None:
+                self.session = aiohttp.ClientSession()
+            self.ws = await self.session.ws_connect(self.url, headers=self.headers, heartbeat=30)
+            self.reader = asyncio.create_task(self.read_loop(self.ws))
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.reader is not None:
+            await asyncio.gather(self.reader, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+        self.ws = self.session = self.reader = None
+
+    # dispatch incoming messages to their request queues
+    async def read_loop(self, ws):
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                message = json.loads(msg.data)
+                if (queue := self.queues.get(message['id'])) is not None:
+                    queue.put_nowait(message)
+        finally:
+            for queue in self.queues.values():
+                queue.put_nowait({'type': 'error', 'data': 'Router connection closed'})
+
+    # yields chunk data for streams or a single result, cancels upstream if closed early
+    async def request(self, kind, data):
+        await self.connect()
+        rid = os.urandom(8).hex()
+        queue = self.queues[rid] = asyncio.Queue()
+        finished = False
+        try:
+            await self.ws.send_json({'id': rid, 'type': kind, 'data': data})
+            while True:
+                message = await queue.get()
+                mtype = message['type']
+                if mtype == 'error':
+                    finished = True
+                    raise Exception(message['data'])
+                elif mtype == 'done':
+                    finished = True
+                    return
+                elif mtype == 'result':
+                    finished = True
+                    yield message['data']
+                    return
+                else:
+                    yield message['data']
+        finally:
+            self.queues.pop(rid, None)
+            if not finished and self.connected:
+                await self.ws.send_json({'id': rid, 'type': 'cancel'})
+
+    async def result(self, kind, data):
+        stream = self.request(kind, data)
+        try:
+            return await anext(stream)
+        finally:
+            await stream.aclose()
+
+##
+## connection registry
+##
+
+# keyed by url and connection headers (auth, extras), so different credentials get their own connection
+SOCKETS = {}
+
+def ws_url(url):
+    if url.startswith('http'):
+        return 'ws' + url[4:]
+    return url
+
+def socket_key(url, headers=None):
+    return url, tuple(sorted((headers or {}).items()))
+
+def get_socket(url, headers=None):
+    url = ws_url(url)
+    key = socket_key(url, headers)
+    loop = asyncio.get_running_loop()
+    sock_loop, sock = SOCKETS.get(key, (None, None))
+    if sock_loop is not loop:
+        sock = RouterSocket(url, headers=headers)
+        SOCKETS[key] = (loop, sock)
+    return sock
+
+# close connections opened on the running loop, call before the loop exits
+async def close_sockets():
+    loop = asyncio.get_running_loop()
+    for key, (sock_loop, sock) in list(SOCKETS.items()):
+        if sock_loop is loop:
+            del SOCKETS[key]
+            await sock.close()
@@ -1,9 +1,21 @@
 # general utils
 
 import re
+import json
+import gzip
+import time
 import base64
 import asyncio
 import mimetypes
+from contextlib import closing, aclosing
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
 
 ##
 ## config class
@@ -44,6 +56,153 @@ async def cumcat(stream):
         reply += chunk
         yield reply
 
+##
+## instrumentation
+##
+
+# fills in stats with ttft, latency, and chunk count as the stream is consumed
+# closing this closes the wrapped stream too (and any upstream request)
+def timed_stream(stream, stats):
+    start = time.perf_counter()
+    stats['chunks'] = 0
+    try:
+        with closing(stream):
+            for chunk in stream:
+                if stats['chunks'] == 0:
+                    stats['ttft'] = time.perf_counter() - start
+                stats['chunks'] += 1
+                yield chunk
+    finally:
+        stats['latency'] = time.perf_counter() - start
+
+async def timed_stream_async(stream, stats):
+    start = time.perf_counter()
+    stats['chunks'] = 0
+    try:
+        async with aclosing(stream):
+            async for chunk in stream:
+                if stats['chunks'] == 0:
+                    stats['ttft'] = time.perf_counter() - start
+                stats['chunks'] += 1
+                yield chunk
+    finally:
+        stats['latency'] = time.perf_counter() - start
+
+# derived per reply metrics, token rate falls back to chunks without usage info
+# pass elapsed for a reply that is still streaming
+def reply_metrics(stats, elapsed=None):
+    latency = stats.get('latency', elapsed)
+    ttft = stats.get('ttft')
+    output = stats.get('output_tokens') or stats.get('chunks')
+    inputs = stats.get('input_tokens')
+    cached = stats.get('cache_read_tokens') or 0
+    gen_time = latency - (ttft or 0) if latency is not None else None
+    return {
+        'ttft': ttft,
+        'latency': latency,
+        'input_tokens': inputs,
+        'output_tokens': output,
+        'cache_read_tokens': cached,
+        'tokens_per_second': output / gen_time if output and gen_time else None,
+        'cache_hit': cached / inputs if inputs else None,
+    }
+
+def format_metrics(metrics):
+    parts = []
+    if (ttft := metrics['ttft']) is not None:
+        parts.append(f'ttft {ttft:.2f}s')
+    if (rate := metrics['tokens_per_second']) is not None:
+        parts.append(f'{rate:.1f} tok/s')
+    if (latency := metrics['latency']) is not None:
+        parts.append(f'total {latency:.2f}s')
+    if (inputs := metrics['input_tokens']) is not None:
+        parts.append(f'in {inputs}')
+    if (output := metrics['output_tokens']) is not None:
+        parts.append(f'out {output}')
+    if (hit := metrics['cache_hit']) is not None:
+        parts.append(f'cache {hit:.0%}')
+    return ' · '.join(parts)
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+# per reply metrics for a session with aggregates
+class StatsLog:
+    def __init__(self):
+        self.replies = []
+
+    def __len__(self):
+        return len(self.replies)
+
+    def add(self, stats, **info):
+        metrics = {'time': time.time(), **info, **reply_metrics(stats)}
+        self.replies.append(metrics)
+        return metrics
+
+    @property
+    def last(self):
+        return self.replies[-1] if len(self.replies) > 0 else None
+
+    def summary(self):
+        def values(key):
+            return [m[key] for m in self.replies if m[key] is not None]
+        ttft, latency, rate = values('ttft'), values('latency'), values('tokens_per_second')
+        inputs = sum(values('input_tokens'))
+        cached = sum(values('cache_read_tokens'))
+        return {
+            'replies': len(self.replies),
+            'ttft_p50': percentile(ttft, 0.5),
+            'ttft_p95': percentile(ttft, 0.95),
+            'latency_p50': percentile(latency, 0.5),
+            'latency_p95': percentile(latency, 0.95),
+            'tokens_per_second': sum(rate) / len(rate) if len(rate) > 0 else None,
+            'input_tokens': inputs,
+            'output_tokens': sum(values('output_tokens')),
+            'cache_read_tokens': cached,
+            'cache_hit': cached / inputs if inputs > 0 else None,
+        }
+
+    def export(self, path=None):
+        data = {'summary': self.summary(), 'replies': self.replies}
+        if path is None:
+            return data
+        with open(path, 'w') as fid:
+            json.dump(data, fid, indent=2)
+
+##
+## compression
+##
+
+def content_encodings():
+    return ['zstd', 'gzip'] if zstd is not None else ['gzip']
+
+def choose_encoding(accept):
+    offered = [e.split(';')[0].strip() for e in accept.split(',')]
+    for encoding in content_encodings():
+        if encoding in offered:
+            return encoding
+
+def encode_body(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=5)
+    elif encoding == 'zstd' and zstd is not None:
+        return zstd.compress(data)
+    else:
+        raise ValueError(f'Unsupported content encoding: {encoding}')
+
+def decode_body(data, encoding):
+    if encoding is None or encoding == 'identity':
+        return data
+    elif encoding == 'gzip':
+        return gzip.decompress(data)
+    elif encoding == 'zstd' and zstd is not None:
+        return zstd.decompress(data)
+    else:
+        raise ValueError(f'Unsupported content encoding: {encoding}')
+
 ##
 ## image utils
 ##
@@ -0,0 +1,33 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+import pytest
+import requests
+
+STUB = os.path.join(os.path.dirname(__file__), 'stub_server.py')
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# tei-style stub server for embedding and tokenizing
+@pytest.fixture(scope='session')
+def stub_url():
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    proc = subprocess.Popen([sys.executable, STUB, '--port', str(port)])
+    try:
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                if requests.get(f'{url}/health', timeout=1).status_code == 200:
+                    break
+            except requests.RequestException:
+                time.sleep(0.05)
+        yield url
+    finally:
+        proc.terminate()
+        proc.wait()
@@ -0,0 +1,64 @@
+# minimal stand-in for llama-server and tei, answers /health with 200
+# and tei-style /embed ([len(text), 1] per text) and /tokenize (one token per word)
+# if the flag file passed as --model exists, it is removed and the
+# server exits with an error after --crash_after seconds
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        code = 200 if self.path == '/health' else 404
+        self.send_response(code)
+        self.end_headers()
+        self.wfile.write(b'{"status": "ok"}')
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        texts = data['inputs']
+        texts = [texts] if type(texts) is str else texts
+        if self.path == '/embed':
+            result = [[float(len(t)), 1.0] for t in texts]
+        elif self.path == '/tokenize':
+            result = [[{'id': i} for i, _ in enumerate(t.split())] for t in texts]
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def crash(delay):
+    time.sleep(delay)
+    os._exit(1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--crash_after', type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.model is not None and os.path.exists(args.model):
+        os.remove(args.model)
+        threading.Thread(target=crash, args=(args.crash_after,), daemon=True).start()
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+import pytest
+
+from oneping.cache import EmbedCache, text_key
+
+def embed_misses(cache, texts, calls):
+    space, keys, misses = cache.begin(texts, 'tei', 'm')
+    calls.append(misses)
+    vecs = np.array([[len(t), 1.0] for t in misses], dtype=np.float32).reshape(-1, 2)
+    return cache.end(space, keys, misses, vecs)
+
+def test_only_misses_embedded(tmp_path):
+    cache, calls = EmbedCache(str(tmp_path)), []
+    embed_misses(cache, ['a', 'bb'], calls)
+    vecs = embed_misses(cache, ['bb', 'ccc', 'ccc', 'a'], calls)
+    assert calls == [['a', 'bb'], ['ccc']]
+    assert vecs[:, 0].tolist() == [2, 3, 3, 1]
+
+def test_reopen(tmp_path):
+    embed_misses(EmbedCache(str(tmp_path)), ['a', 'bb'], [])
+    cache, calls = EmbedCache(str(tmp_path)), []
+    vecs = embed_misses(cache, ['bb', 'a'], calls)
+    assert calls == [[]]
+    assert vecs[:, 0].tolist() == [2, 1]
+    assert [s['model'] for s in cache.list()] == ['m']
+
+def test_spaces_separate(tmp_path):
+    cache = EmbedCache(str(tmp_path))
+    assert cache.space('tei', 'm') is not cache.space('tei', 'm', base_url='http://other')
+    assert cache.space('tei', 'm') is not cache.space('tei', 'm', dimensions=64)
+
+# a crash between the vector and key appends leaves rows without keys
+def test_torn_append_dropped(tmp_path):
+    cache = EmbedCache(str(tmp_path))
+    embed_misses(cache, ['a', 'bb'], [])
+    space = cache.space('tei', 'm')
+    with open(space.vecs_path, 'ab') as fid:
+        fid.write(np.array([[9, 9], [9, 9]], dtype='<f4').tobytes()[:12])
+    with open(space.keys_path, 'ab') as fid:
+        fid.write(text_key('zzz')[:5])
+
+    cache, calls = EmbedCache(str(tmp_path)), []
+    space = cache.space('tei', 'm')
+    assert len(space) == 2
+    assert os.path.getsize(space.vecs_path) == 2 * 8
+    assert os.path.getsize(space.keys_path) == 2 * 16
+    vecs = embed_misses(cache, ['zzz', 'a'], calls)
+    assert calls == [['zzz']]
+    assert vecs[:, 0].tolist() == [3, 1]
+
+def test_width_mismatch(tmp_path):
+    space = EmbedCache(str(tmp_path)).space('tei', 'm')
+    space.add([text_key('a')], np.ones((1, 2)))
+    with pytest.raises(ValueError):
+        space.add([text_key('b')], np.ones((1, 3)))
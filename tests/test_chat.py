@@ -0,0 +1,25 @@
+from oneping import chat as chat_module
+from oneping.chat import Chat
+
+def test_slot_restore_only_when_taken(monkeypatch):
+    calls = []
+    monkeypatch.setattr(chat_module, 'slot_restore', lambda slot, name, **kw: calls.append(name))
+    monkeypatch.setattr(chat_module, 'SLOT_OWNERS', {})
+    opts = {'provider': 'llama-cpp', 'base_url': 'http://server'}
+    chat_a = Chat(slot=0, convo_id='a')
+    chat_b = Chat(slot=0, convo_id='b')
+    chat_a.history = chat_b.history = [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'hello'}]
+
+    # first turn restores, repeated turns keep the slot
+    chat_a.slot_begin(opts)
+    chat_a.slot_begin(opts)
+    assert calls == ['a.bin']
+
+    # another conversation takes the slot, so the next turn restores again
+    chat_b.slot_begin(opts)
+    chat_a.slot_begin(opts)
+    assert calls == ['a.bin', 'b.bin', 'a.bin']
+
+    # other slots and servers are tracked separately
+    chat_a.slot_begin({**opts, 'base_url': 'http://other'})
+    assert calls[-1] == 'a.bin' and len(calls) == 4
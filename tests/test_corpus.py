@@ -0,0 +1,85 @@
+import json
+import pytest
+import numpy as np
+
+from oneping.corpus import embed_corpus, load_corpus, chunk_document, CorpusWriter
+
+def write_docs(path, n=50):
+    rng = np.random.default_rng(0)
+    words = ['alpha', 'beta', 'gamma', 'delta']
+    with open(path, 'w') as fid:
+        for i in range(n):
+            text = ' '.join(rng.choice(words, size=rng.integers(0, 120)))
+            fid.write(json.dumps({'id': f'doc{i}', 'text': text}) + '\n')
+    return {f'doc{i}': json.loads(line)['text'] for i, line in enumerate(open(path))}
+
+# stub embeddings are [len(text), 1], so every row can be checked against its span
+def check_aligned(output, docs):
+    vecs, records = load_corpus(output)
+    assert len(vecs) == len(records) > 0
+    for vec, rec in zip(vecs, records):
+        assert vec[0] == len(docs[rec['id']][rec['start']:rec['end']])
+    return vecs, records
+
+def test_chunk_limits():
+    text = 'one two three four five six seven eight nine ten'
+    chunks = chunk_document(text, max_tokens=4, overlap=1, tokenizer=str.split)
+    assert all(n <= 4 for _, _, n in chunks)
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(text)
+
+@pytest.mark.parametrize('tokenizer', [None, str.split, lambda text: text.split()])
+def test_embed_corpus(tmp_path, stub_url, tokenizer):
+    docs = write_docs(tmp_path / 'docs.jsonl')
+    output = tmp_path / 'out'
+    result = embed_corpus(
+        [str(tmp_path / 'docs.jsonl')], str(output), provider='tei', base_url=stub_url,
+        max_tokens=16, overlap=4, tokenizer=tokenizer, group=16,
+    )
+    assert result['total_docs'] == len(docs)
+    _, records = check_aligned(output, docs)
+    if tokenizer is not None:
+        assert max(r['tokens'] for r in records) <= 16
+
+def test_no_tokenize_endpoint(tmp_path):
+    with pytest.raises(ValueError, match='tokenizer='):
+        embed_corpus([], str(tmp_path / 'out'), provider='openai')
+
+def test_resume_after_torn_first_write(tmp_path, stub_url):
+    docs = write_docs(tmp_path / 'docs.jsonl')
+    output = tmp_path / 'out'
+    args = dict(provider='tei', base_url=stub_url, max_tokens=16, tokenizer=str.split, group=16, workers=0)
+
+    # crash during the first write: rows on disk, checkpoint without a dim
+    config = {'provider': 'tei', 'model': None, 'max_tokens': 16, 'overlap': 0, 'tokenizer': 'str.split'}
+    CorpusWriter(str(output), config)
+    with open(output / 'vectors.f32', 'wb') as fid:
+        fid.write(np.full((12, 2), 99, dtype='<f4').tobytes())
+    with open(output / 'chunks.jsonl', 'w') as fid:
+        fid.write('{"id": "torn"}\n')
+
+    embed_corpus([str(tmp_path / 'docs.jsonl')], str(output), **args)
+    check_aligned(output, docs)
+
+def test_resume_after_torn_later_write(tmp_path, stub_url):
+    docs = write_docs(tmp_path / 'docs.jsonl')
+    path = str(tmp_path / 'docs.jsonl')
+    args = dict(provider='tei', base_url=stub_url, max_tokens=16, tokenizer=str.split, group=16, workers=0)
+    full = tmp_path / 'full'
+    embed_corpus([path], str(full), **args)
+
+    # partial run followed by rows written after its last checkpoint
+    part = tmp_path / 'part'
+    with open(path) as fid:
+        head = fid.readlines()[:20]
+    with open(tmp_path / 'head.jsonl', 'w') as fid:
+        fid.writelines(head)
+    embed_corpus([str(tmp_path / 'head.jsonl')], str(part), **args)
+    with open(part / 'vectors.f32', 'ab') as fid:
+        fid.write(np.full((5, 2), 99, dtype='<f4').tobytes())
+    with open(part / 'chunks.jsonl', 'a') as fid:
+        fid.write('{"id": "torn"}\n')
+
+    embed_corpus([path], str(part), **args)
+    a, ra = check_aligned(full, docs)
+    b, rb = check_aligned(part, docs)
+    assert np.array_equal(a, b) and ra == rb
@@ -0,0 +1,62 @@
+import gzip
+import json
+import threading
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from oneping import curl
+from oneping.providers import PROVIDERS
+
+# records request encodings, advertising or rejecting gzip
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers['Content-Length']))
+        encoding = self.headers.get('Content-Encoding')
+        self.server.seen.append(encoding)
+        if encoding is not None and not self.server.accept:
+            self.send_response(415)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if encoding == 'gzip':
+            raw = gzip.decompress(raw)
+        texts = json.loads(raw)['inputs']
+        body = json.dumps([[float(len(t)), 1.0] for t in texts]).encode()
+        self.send_response(200)
+        if self.server.accept:
+            self.send_header('Accept-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.seen, httpd.accept = [], True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    curl.SERVER_ENCODINGS.clear()
+
+def embed(server, text):
+    host, port = server.server_address
+    prov = {**PROVIDERS['tei'], 'base_url': f'http://{host}:{port}', 'compress': 'gzip', 'compress_min': 0}
+    return curl.embed([text], provider=prov).tolist()
+
+def test_compress_after_advertised(server):
+    assert embed(server, 'a' * 100) == [[100.0, 1.0]]
+    assert embed(server, 'b' * 100) == [[100.0, 1.0]]
+    assert server.seen == [None, 'gzip']
+
+def test_retry_uncompressed_on_415(server):
+    embed(server, 'a' * 100)
+    server.accept = False
+    assert embed(server, 'b' * 100) == [[100.0, 1.0]]
+    assert embed(server, 'c' * 100) == [[100.0, 1.0]]
+    assert server.seen == [None, 'gzip', None, None]
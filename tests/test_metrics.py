@@ -0,0 +1,90 @@
+import asyncio
+import pytest
+
+from oneping.metrics import RouterMetrics
+
+pytestmark = pytest.mark.skipif(not RouterMetrics().enabled, reason='prometheus_client not installed')
+
+def sample(metrics, name, **labels):
+    return metrics.registry.get_sample_value(name, labels) or 0
+
+class Upstream:
+    def __init__(self, n=10, fail=False):
+        self.n = n
+        self.fail = fail
+        self.closed = False
+
+    async def stream(self):
+        try:
+            for i in range(self.n):
+                await asyncio.sleep(0)
+                yield f'chunk{i}'
+            if self.fail:
+                raise RuntimeError('upstream failed')
+        finally:
+            self.closed = True
+
+LABELS = dict(endpoint='chat', provider='p', model='m')
+
+def test_stream_complete():
+    metrics, upstream = RouterMetrics(), Upstream()
+    async def run():
+        return [c async for c in metrics.track_stream_async(upstream.stream(), 'chat', 'p', 'm')]
+    assert len(asyncio.run(run())) == 10
+    assert upstream.closed
+    assert sample(metrics, 'oneping_output_tokens_total', provider='p', model='m') == 10
+    assert sample(metrics, 'oneping_request_seconds_count', **LABELS) == 1
+    assert sample(metrics, 'oneping_inflight_streams', provider='p', model='m') == 0
+
+def test_stream_closed_early():
+    metrics, upstream = RouterMetrics(), Upstream()
+    async def run():
+        tracked = metrics.track_stream_async(upstream.stream(), 'chat', 'p', 'm')
+        await anext(tracked)
+        await anext(tracked)
+        await tracked.aclose()
+        return upstream.closed
+    assert asyncio.run(run())
+    assert sample(metrics, 'oneping_output_tokens_total', provider='p', model='m') == 2
+    assert sample(metrics, 'oneping_request_seconds_count', **LABELS) == 1
+    assert sample(metrics, 'oneping_inflight_streams', provider='p', model='m') == 0
+    assert sample(metrics, 'oneping_errors_total', **LABELS) == 0
+
+def test_stream_cancelled():
+    metrics, upstream = RouterMetrics(), Upstream(n=1000)
+    async def consume():
+        async for _ in metrics.track_stream_async(upstream.stream(), 'chat', 'p', 'm'):
+            await asyncio.sleep(0.001)
+    async def run():
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.02)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    # the abandoned generator is finalized by the loop at shutdown
+    asyncio.run(run())
+    assert upstream.closed
+    assert sample(metrics, 'oneping_inflight_streams', provider='p', model='m') == 0
+    assert sample(metrics, 'oneping_request_seconds_count', **LABELS) == 1
+
+def test_stream_error():
+    metrics, upstream = RouterMetrics(), Upstream(n=3, fail=True)
+    async def run():
+        return [c async for c in metrics.track_stream_async(upstream.stream(), 'chat', 'p', 'm')]
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+    assert sample(metrics, 'oneping_errors_total', **LABELS) == 1
+    assert sample(metrics, 'oneping_inflight_streams', provider='p', model='m') == 0
+
+def test_sync_stream_closed_early():
+    metrics, closed = RouterMetrics(), []
+    def upstream():
+        try:
+            yield from ['a', 'b', 'c']
+        finally:
+            closed.append(True)
+    tracked = metrics.track_stream(upstream(), 'chat', 'p', 'm')
+    next(tracked)
+    tracked.close()
+    assert closed
+    assert sample(metrics, 'oneping_request_seconds_count', **LABELS) == 1
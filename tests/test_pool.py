@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import socket
+
+from oneping.pool import LlamaPool, make_args
+from oneping.providers import BACKENDS
+
+STUB = os.path.join(os.path.dirname(__file__), 'stub_server.py')
+PROVIDER = 'stub-pool'
+
+def stub_command(model, host, port, **kwargs):
+    return [sys.executable, STUB, *make_args(model=model, host=host, port=port, **kwargs)]
+
+def free_base_port(n):
+    for base in range(20000, 30000, n):
+        try:
+            socks = []
+            for port in range(base, base + n):
+                sock = socket.socket()
+                sock.bind(('127.0.0.1', port))
+                socks.append(sock)
+            return base
+        except OSError:
+            continue
+        finally:
+            for sock in socks:
+                sock.close()
+
+def wait_for(cond, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if cond():
+            return True
+        time.sleep(0.05)
+    return False
+
+def make_pool(models):
+    return LlamaPool(
+        models, affinity=False, command=stub_command, provider=PROVIDER, base_port=free_base_port(len(models)),
+        ready_timeout=10, backoff=0.1, poll_interval=0.05,
+    )
+
+def test_ready_and_register(tmp_path):
+    models = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+    with make_pool(models) as pool:
+        assert len(pool.ready) == 2
+        assert sorted(BACKENDS[PROVIDER]) == sorted(s.url for s in pool.servers)
+        assert all('--threads' not in s.command for s in pool.servers)
+    assert PROVIDER not in BACKENDS
+    assert all(not s.alive() for s in pool.servers)
+
+def test_crash_restart(tmp_path):
+    flag = tmp_path / 'crash'
+    flag.touch()
+    models = [str(flag), str(tmp_path / 'stable')]
+    with make_pool(models) as pool:
+        crashy, stable = pool.servers
+        first = crashy.proc.pid
+
+        # taken out of rotation when it exits
+        assert wait_for(lambda: crashy.url not in BACKENDS[PROVIDER])
+        assert BACKENDS[PROVIDER] == [stable.url]
+
+        # restarted with backoff and registered again once ready
+        assert wait_for(lambda: crashy.url in BACKENDS[PROVIDER])
+        assert crashy.proc.pid != first
+        assert crashy.failures == 1
+        assert stable.failures == 0
+
+def script_command(script):
+    def command(model, host, port, **kwargs):
+        return [sys.executable, '-c', script]
+    return command
+
+def test_exit_before_ready():
+    pool = LlamaPool(
+        ['a', 'b'], affinity=False, command=script_command('import sys; sys.exit(3)'),
+        provider=PROVIDER, base_port=free_base_port(2), ready_timeout=30,
+    )
+    start = time.monotonic()
+    try:
+        pool.start()
+        assert False, 'pool started'
+    except RuntimeError as e:
+        assert 'exited (3)' in str(e)
+    assert time.monotonic() - start < 10
+    assert all(not s.alive() for s in pool.servers)
+    assert PROVIDER not in BACKENDS
+
+def test_ready_timeout_stops_servers():
+    pool = LlamaPool(
+        ['a', 'b'], affinity=False, command=script_command('import time; time.sleep(60)'),
+        provider=PROVIDER, base_port=free_base_port(2), ready_timeout=0.5,
+    )
+    try:
+        with pool:
+            assert False, 'pool started'
+    except TimeoutError:
+        pass
+    assert all(not s.alive() for s in pool.servers)
@@ -0,0 +1,100 @@
+import gzip
+import json
+import asyncio
+import pytest
+
+pytest.importorskip('fastapi')
+from fastapi.testclient import TestClient
+
+from oneping import server
+from oneping.server import make_router
+
+# upstream stand-ins for the api functions the router calls
+class Upstream:
+    def __init__(self, n=3, fail=False, delay=0):
+        self.n = n
+        self.fail = fail
+        self.delay = delay
+        self.calls = 0
+        self.closed = False
+
+    def reply(self, query, **kwargs):
+        self.calls += 1
+        return f'reply to {query}'
+
+    async def stream(self, query, **kwargs):
+        self.calls += 1
+        try:
+            for i in range(self.n):
+                await asyncio.sleep(self.delay)
+                yield f'chunk{i}'
+            if self.fail:
+                raise RuntimeError('upstream failed')
+        finally:
+            self.closed = True
+
+def make_client(monkeypatch, upstream=None, **kwargs):
+    if upstream is not None:
+        monkeypatch.setattr(server, 'reply_api', upstream.reply)
+        monkeypatch.setattr(server, 'stream_async_api', upstream.stream)
+    return TestClient(make_router(**{'provider': 'local', **kwargs}))
+
+def sample(client, name):
+    parser = pytest.importorskip('prometheus_client.parser')
+    for family in parser.text_string_to_metric_families(client.get('/metrics').text):
+        for s in family.samples:
+            if s.name == name:
+                return s.value
+
+def test_chat_cache(monkeypatch):
+    upstream = Upstream()
+    client = make_client(monkeypatch, upstream, cache_ttl=60)
+    first = client.post('/chat', json={'query': 'hi'}).json()
+    second = client.post('/chat', json={'query': 'hi'}).json()
+    client.post('/chat', json={'query': 'other'})
+    assert first == second == {'success': True, 'data': 'reply to hi'}
+    assert upstream.calls == 2
+
+def test_breaker_opens_on_stream_failure(monkeypatch):
+    upstream = Upstream(fail=True)
+    client = make_client(monkeypatch, upstream, breaker_threshold=1)
+    with pytest.raises(RuntimeError):
+        client.post('/chat', json={'query': 'hi', 'stream': True})
+    response = client.post('/chat', json={'query': 'hi', 'stream': True})
+    assert response.status_code == 503
+    assert upstream.calls == 1
+
+def test_rate_limit(monkeypatch):
+    client = make_client(monkeypatch, Upstream(), rate_limit=1)
+    assert client.post('/chat', json={'query': 'hi'}).status_code == 200
+    assert client.post('/chat', json={'query': 'hi'}).status_code == 429
+
+def test_embed_compressed(stub_url):
+    client = TestClient(make_router(provider='tei', base_url=stub_url, compress_min=0))
+    body = gzip.compress(json.dumps({'text': ['ab', 'abc']}).encode())
+    headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+    response = client.post('/embed', content=body, headers=headers)
+    assert response.status_code == 200
+    assert 'gzip' in response.headers['accept-encoding']
+    assert response.json()['shape'] == [2, 2]
+
+    headers['Content-Encoding'] = 'br'
+    response = client.post('/embed', content=body, headers=headers)
+    assert response.status_code == 415
+    assert 'gzip' in response.headers['accept-encoding']
+
+# cancelling a websocket stream closes the upstream and ends its metrics
+def test_websocket_cancel(monkeypatch):
+    pytest.importorskip('prometheus_client')
+    upstream = Upstream(n=1000, delay=0.01)
+    client = make_client(monkeypatch, upstream)
+    with client.websocket_connect('/ws') as ws:
+        ws.send_json({'id': 'r1', 'type': 'chat', 'data': {'query': 'hi', 'stream': True}})
+        assert ws.receive_json() == {'id': 'r1', 'type': 'chunk', 'data': 'chunk0'}
+        ws.send_json({'id': 'r1', 'type': 'cancel'})
+        ws.send_json({'id': 'r2', 'type': 'chat', 'data': {'query': 'hi'}})
+        while (message := ws.receive_json())['id'] != 'r2':
+            pass
+        assert message['data'] == {'success': True, 'data': 'reply to hi'}
+        assert upstream.closed
+        assert sample(client, 'oneping_inflight_streams') == 0
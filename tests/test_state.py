@@ -0,0 +1,60 @@
+import time
+import threading
+
+from oneping import state as state_module
+from oneping.state import SharedState
+
+def test_cache_expires(tmp_path, monkeypatch):
+    shared = SharedState(str(tmp_path / 'state.db'))
+    shared.cache_set('k', 'v', ttl=10)
+    assert shared.cache_get('k') == 'v'
+    now = time.time()
+    monkeypatch.setattr(state_module.time, 'time', lambda: now + 11)
+    assert shared.cache_get('k') is None
+
+def test_cache_shared_across_connections(tmp_path):
+    path = str(tmp_path / 'state.db')
+    SharedState(path).cache_set('k', 'v', ttl=60)
+    assert SharedState(path).cache_get('k') == 'v'
+
+def test_rate_limit_window(monkeypatch):
+    shared = SharedState()
+    now = 1000 * 60
+    monkeypatch.setattr(state_module.time, 'time', lambda: now)
+    assert [shared.rate_limit('up', 2) for _ in range(3)] == [True, True, False]
+    now += 60
+    assert shared.rate_limit('up', 2)
+
+def test_breaker_opens_at_threshold():
+    shared = SharedState()
+    shared.breaker_record('up', False, threshold=2)
+    assert shared.breaker_allow('up')
+    shared.breaker_record('up', False, threshold=2)
+    assert not shared.breaker_allow('up')
+
+# after the cooldown exactly one caller gets the trial, concurrent ones fail fast
+def test_breaker_half_open_single_trial(tmp_path, monkeypatch):
+    path = str(tmp_path / 'state.db')
+    shared = SharedState(path)
+    shared.breaker_record('up', False, threshold=1)
+    now = time.time() + 31
+    monkeypatch.setattr(state_module.time, 'time', lambda: now)
+
+    workers = [SharedState(path) for _ in range(8)]
+    barrier = threading.Barrier(len(workers))
+    allowed = []
+    def trial(worker):
+        barrier.wait()
+        allowed.append(worker.breaker_allow('up', cooldown=30))
+    threads = [threading.Thread(target=trial, args=(w,)) for w in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(allowed) == [False] * 7 + [True]
+
+    # a successful trial closes the breaker, a failed one restarts the cooldown
+    shared.breaker_record('up', True, threshold=1)
+    assert shared.breaker_allow('up', cooldown=30)
+    shared.breaker_record('up', False, threshold=1)
+    assert not shared.breaker_allow('up', cooldown=30)
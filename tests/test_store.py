@@ -0,0 +1,50 @@
+import os
+
+from oneping.store import ConvoStore, open_append
+
+def msg(role, text):
+    return {'role': role, 'content': text}
+
+def test_open_append_drops_torn_line(tmp_path):
+    path = tmp_path / 'log.jsonl'
+    path.write_text('{"a": 1}\n{"b": 2}\n{"c": ')
+    with open_append(path) as fid:
+        fid.write('{"d": 4}\n')
+    assert path.read_text() == '{"a": 1}\n{"b": 2}\n{"d": 4}\n'
+
+    # long torn line spanning several read blocks
+    path.write_text('{"a": 1}\n' + 'x' * 10000)
+    open_append(path, block=64).close()
+    assert path.read_text() == '{"a": 1}\n'
+
+    # nothing but a torn line
+    path.write_text('{"a"')
+    open_append(path).close()
+    assert path.read_text() == ''
+
+def test_append_after_torn_write(tmp_path):
+    root = tmp_path / 'store'
+    with ConvoStore(root) as store:
+        store.append('c1', [msg('user', 'hello'), msg('assistant', 'hi')], system='sys')
+
+    # crash mid-write in both the log and the index
+    with open(root / 'convos' / 'c1.jsonl', 'a') as fid:
+        fid.write('{"depth": 2, "role": "us')
+    with open(root / 'index.jsonl', 'a') as fid:
+        fid.write('{"id": "c1", "tit')
+
+    with ConvoStore(root) as store:
+        assert store.load('c1')['messages'] == [msg('user', 'hello'), msg('assistant', 'hi')]
+        store.append('c1', [msg('user', 'again'), msg('assistant', 'sure')], start=2)
+
+    with ConvoStore(root) as store:
+        convo = store.load('c1')
+        assert convo['system'] == 'sys'
+        assert [m['content'] for m in convo['messages']] == ['hello', 'hi', 'again', 'sure']
+        assert store.info('c1')['size'] == 4
+
+def test_rewind_overwrites_tail(tmp_path):
+    with ConvoStore(tmp_path) as store:
+        store.append('c1', [msg('user', 'a'), msg('assistant', 'b'), msg('user', 'c')])
+        store.append('c1', [msg('user', 'd')], start=1)
+        assert [m['content'] for m in store.load('c1')['messages']] == ['a', 'd']
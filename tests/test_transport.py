@@ -0,0 +1,30 @@
+import asyncio
+
+from oneping import curl, transport
+from oneping.providers import PROVIDERS, encode_matrix
+
+# answers frames locally instead of over a websocket
+async def fake_request(self, kind, data):
+    if kind == 'embed':
+        yield encode_matrix([[1.0, 2.0]])
+    elif data.get('stream'):
+        yield 'a'
+        yield 'b'
+    else:
+        yield 'ab'
+
+def test_request_kinds_share_socket(monkeypatch):
+    monkeypatch.setattr(transport.RouterSocket, 'request', fake_request)
+    prov = {**PROVIDERS['oneping'], 'base_url': 'http://router', 'transport': 'websocket', 'headers': {'X-Team': 't1'}}
+    async def run():
+        text = await curl.reply_async('hi', provider=prov)
+        chunks = [c async for c in curl.stream_async('hi', provider=prov)]
+        vecs = await curl.embed_async(['hi'], provider=prov)
+        return text, chunks, vecs.tolist()
+    try:
+        assert asyncio.run(run()) == ('ab', ['a', 'b'], [[1.0, 2.0]])
+        assert len(transport.SOCKETS) == 1
+        (_, sock), = transport.SOCKETS.values()
+        assert sock.headers == {'X-Team': 't1'}
+    finally:
+        transport.SOCKETS.clear()